@@ -0,0 +1,242 @@
+#
+# Where the scripts' SQL runs.
+#
+# By default everything runs on Redshift. The postgres backend runs the
+# same statements in a local Postgres database given by LOCAL_DB instead,
+# so that backfills and reprocessing can stage, sample, aggregate and
+# summarize on one machine without competing with the cluster's other
+# users. The Redshift-only SQL is translated on the way through, as the
+# benchmark does: column encodings and distribution and sort keys are
+# dropped, STRTOL is provided as a function and COPY from S3 becomes COPY
+# FROM STDIN, fed from the bucket. HyperLogLog sketches need Redshift, so
+# the daily summary leaves them out.
+#
+# With --export, each script then writes the tables it filled to a
+# directory of its own under the one given, as gzipped CSV along with an
+# exports.json of the days each file covers. load_exports.py replaces
+# those days in Redshift with one COPY per file, which is all the work a
+# local run leaves for the cluster.
+#
+
+from cStringIO import StringIO
+from os import path
+import csv
+import gzip
+import json
+import os
+import re
+import time
+
+import postgres
+
+import sql
+import tracing
+
+def env_or_default(variable_name, default_value):
+    if variable_name in os.environ:
+        return os.environ[variable_name]
+
+    return default_value
+
+BACKENDS = ("redshift", "postgres")
+
+LOCAL_DB = env_or_default("LOCAL_DB", "postgresql://localhost/fxa_local")
+
+EXPORTS_FILE = "exports.json"
+
+# Marks NULL in exported files, so that it can't be mistaken for an
+# empty string.
+EXPORT_NULL = "\\N"
+
+# Only handles base 16, which is all we use it for.
+Q_CREATE_STRTOL = """
+    CREATE OR REPLACE FUNCTION strtol(value TEXT, base INTEGER) RETURNS BIGINT AS $$
+      SELECT ('x' || LPAD(value, 16, '0'))::BIT(64)::BIGINT
+    $$ LANGUAGE SQL IMMUTABLE;
+"""
+
+Q_COPY_STDIN = """
+    COPY {table} ({columns})
+    FROM STDIN
+    WITH (FORMAT csv{null}{not_null});
+"""
+
+# Redshift loads an empty CSV field into a text column as an empty string,
+# unless told otherwise, where Postgres loads it as NULL.
+Q_TEXT_COLUMNS = """
+    SELECT attname
+    FROM pg_attribute
+    WHERE attrelid = %(table)s::REGCLASS
+    AND atttypid IN ('varchar'::REGTYPE, 'bpchar'::REGTYPE, 'text'::REGTYPE)
+    AND attnum > 0
+    AND NOT attisdropped;
+"""
+
+Q_GET_COLUMNS = """
+    SELECT *
+    FROM {table}
+    LIMIT 0;
+"""
+
+Q_GET_DAY_RANGE = """
+    SELECT
+      MIN({day_column})::DATE AS day_from,
+      MAX({day_column})::DATE AS day_until,
+      COUNT(*) AS row_count
+    FROM {table}
+    WHERE {condition};
+"""
+
+Q_EXPORT = """
+    COPY (
+      SELECT {columns}
+      FROM {table}
+      WHERE {condition}
+    )
+    TO STDOUT
+    WITH (FORMAT csv, NULL %(null)s);
+"""
+
+# Redshift syntax that Postgres doesn't know and can do without.
+REDSHIFT_ONLY = (
+    re.compile(r"\s+(?:DISTKEY|SORTKEY)\s*\([^)]*\)", re.IGNORECASE),
+    re.compile(r"\s+(?:DISTKEY|SORTKEY)\b", re.IGNORECASE),
+    re.compile(r"\s+DISTSTYLE\s+\w+", re.IGNORECASE),
+    re.compile(r"\s+ENCODE\s+\w+", re.IGNORECASE),
+)
+
+COPY_FROM_S3 = re.compile(r"\s*COPY\s+(?P<table>[\w.]+)\s*\((?P<columns>[^)]*)\)\s*"
+                          r"FROM\s+'s3://[^/]+/(?P<key>[^']+)'\s*"
+                          r"CREDENTIALS\s+'[^']*'(?P<options>.*)$", re.IGNORECASE | re.DOTALL)
+
+NULL_OPTION = re.compile(r"NULL\s+AS\s+'([^']*)'", re.IGNORECASE)
+
+def add_arguments(parser):
+    parser.add_argument("--backend", choices=BACKENDS, default="redshift",
+                        help="where to run the SQL: Redshift, or the local Postgres database at LOCAL_DB")
+    parser.add_argument("--export", metavar="DIRECTORY", dest="export_directory",
+                        help="write the tables the run filled to DIRECTORY, for load_exports.py")
+    parser.add_argument("--export-from", metavar="YYYY-MM-DD",
+                        help="export no days before this one, such as those a backfill "
+                             "only imported to summarize the days after them")
+
+def connect(backend, url, s3, maxconn=10):
+    """Return a connection pool for backend, reading the files COPY names from s3."""
+    if backend == "postgres":
+        db = postgres.Postgres(LOCAL_DB, maxconn=maxconn, cursor_factory=make_cursor_factory(tracing, s3))
+        db.run(Q_CREATE_STRTOL)
+        return db
+    return postgres.Postgres(url, maxconn=maxconn, cursor_factory=tracing.TracedCursor)
+
+def translate(sql):
+    """Rewrite a Redshift statement so Postgres will run it."""
+    for pattern in REDSHIFT_ONLY:
+        sql = pattern.sub("", sql)
+    return sql
+
+def decode(contents, options):
+    """Return the CSV in a file that COPY with options would read."""
+    if "GZIP" in options:
+        return gzip.GzipFile(fileobj=StringIO(contents)).read()
+    if "ZSTD" in options:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(contents)
+    if "PARQUET" in options:
+        # Redshift matches Parquet columns to the COPY's by position.
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(StringIO(contents))
+        output = StringIO()
+        writer = csv.writer(output)
+        for row in zip(*[column.to_pylist() for column in table.columns]):
+            writer.writerow(["" if value is None else value for value in row])
+        return output.getvalue()
+    return contents
+
+def make_cursor_factory(tracing, bucket):
+    """Return a traced cursor class that runs Redshift SQL on Postgres,
+    copying from bucket in place of S3.
+    """
+
+    class LocalCursor(tracing.TracedCursor):
+
+        def execute(self, sql, parameters=None):
+            match = COPY_FROM_S3.match(sql)
+            if match is None:
+                return super(LocalCursor, self).execute(translate(sql), parameters)
+            start = time.time()
+            self.copy_from_bucket(match.group("table"), match.group("columns"),
+                                  match.group("key"), match.group("options"))
+            tracing.tracer.record(sql, time.time() - start, self.rowcount)
+
+        def copy_from_bucket(self, table, columns, key_name, options):
+            options = options.upper()
+            key_names = [key_name]
+            if "MANIFEST" in options:
+                manifest = json.loads(bucket.get_key(key_name).get_contents_as_string())
+                key_names = [entry["url"].split("/", 3)[3] for entry in manifest["entries"]]
+            data = StringIO()
+            for name in key_names:
+                data.write(decode(bucket.get_key(name).get_contents_as_string(), options))
+            data.seek(0)
+            null = NULL_OPTION.search(options)
+            not_null = ""
+            if null is None and "EMPTYASNULL" not in options:
+                text_columns = self.text_columns(table)
+                not_null = ", ".join(column.strip() for column in columns.split(",")
+                                     if column.strip() in text_columns)
+                not_null = ", FORCE_NOT_NULL ({0})".format(not_null) if not_null else ""
+            self.copy_expert(Q_COPY_STDIN.format(table=table,
+                                                 columns=columns,
+                                                 null=", NULL '{0}'".format(null.group(1)) if null else "",
+                                                 not_null=not_null),
+                             data)
+
+        def text_columns(self, table):
+            # Not traced, as Redshift doesn't need it.
+            tracing.SimpleNamedTupleCursor.execute(self, Q_TEXT_COLUMNS, {"table": table})
+            return set(row[0] for row in self.fetchall())
+
+    return LocalCursor
+
+def export(db, directory, name, tables, day_from=None):
+    """Write each of tables to a gzipped CSV file in directory/name, with an
+    exports.json listing the columns and days of each.
+
+    tables holds (table, day column, condition), where condition limits
+    the rows written, and is None for all of them. With day_from, no
+    earlier days are written. Tables with nothing to write are left out.
+    """
+    directory = path.join(directory, name)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    print "EXPORTING TO", directory
+    exports = []
+    for table, day_column, condition in tables:
+        conditions = [condition or "TRUE"]
+        if day_from:
+            conditions.append(sql.bind("{0} >= %(day_from)s".format(day_column), day_from=sql.day(day_from)))
+        condition = " AND ".join(conditions)
+        with db.get_cursor() as cursor:
+            days = cursor.one(Q_GET_DAY_RANGE.format(table=table, day_column=day_column, condition=condition))
+            if not days.row_count:
+                continue
+            cursor.execute(Q_GET_COLUMNS.format(table=table))
+            columns = [column[0] for column in cursor.description]
+            filename = table + ".csv.gz"
+            print " ", table, days.row_count, "ROWS FROM", days.day_from, "UNTIL", days.day_until
+            with gzip.open(path.join(directory, filename), "wb") as output:
+                cursor.copy_expert(sql.build(Q_EXPORT, {"null": EXPORT_NULL}, table=table,
+                                             columns=", ".join(columns), condition=condition),
+                                   output)
+        exports.append({
+            "table": table,
+            "file": filename,
+            "columns": columns,
+            "day_column": day_column,
+            "condition": condition,
+            "day_from": days.day_from.strftime("%Y-%m-%d"),
+            "day_until": days.day_until.strftime("%Y-%m-%d"),
+            "row_count": days.row_count,
+        })
+    with open(path.join(directory, EXPORTS_FILE), "w") as exports_file:
+        json.dump(exports, exports_file, indent=2, sort_keys=True)
@@ -0,0 +1,232 @@
+#
+# End-to-end benchmark of the import pipeline against a local Postgres.
+#
+# Generates synthetic data with synthetic_data, uploads it to a moto
+# mock of the S3 bucket, then runs every import script and the daily
+# summary against a scratch schema in a local Postgres database, which
+# stands in for Redshift. The Redshift-only SQL is translated on the way
+# through as it is for the postgres backend, with COPY fed from the mock
+# bucket.
+#
+# For each script and each of its stages it reports wall time, rows per
+# second and statement latency, and can write them out to compare with
+# the next run. Absolute numbers say little about Redshift, but changes
+# from one run to the next are worth looking into.
+#
+# Needs moto and a database you don't mind losing the fxa_benchmark
+# schema of, given by BENCHMARK_DB.
+#
+
+from os import path
+from urlparse import urlparse
+import argparse
+import copy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+def env_or_default(variable_name, default_value):
+    if variable_name in os.environ:
+        return os.environ[variable_name]
+
+    return default_value
+
+BENCHMARK_DB = env_or_default("BENCHMARK_DB", "postgresql://localhost/fxa_benchmark")
+BENCHMARK_SCHEMA = env_or_default("BENCHMARK_SCHEMA", "fxa_benchmark")
+
+Q_RESET_SCHEMA = """
+    DROP SCHEMA IF EXISTS {schema} CASCADE;
+    CREATE SCHEMA {schema};
+""".format(schema=BENCHMARK_SCHEMA)
+
+def configure_environment(cache_directory):
+    """Point the scripts at the benchmark database and the mock bucket.
+
+    This has to happen before they're imported, because they read their
+    settings when they are.
+    """
+    url = urlparse(BENCHMARK_DB)
+    os.environ.update({
+        "REDSHIFT_USER": url.username or os.environ.get("USER", "postgres"),
+        "REDSHIFT_PASSWORD": url.password or "",
+        "REDSHIFT_HOST": url.hostname or "localhost",
+        "REDSHIFT_PORT": str(url.port or 5432),
+        "REDSHIFT_DBNAME": url.path.lstrip("/"),
+        # Every connection works in the scratch schema.
+        "PGOPTIONS": "-c search_path=" + BENCHMARK_SCHEMA,
+        "AWS_ACCESS_KEY": "benchmark",
+        "AWS_SECRET_KEY": "benchmark",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "LISTING_CACHE_DIR": cache_directory,
+    })
+
+def isolate_mock_requests():
+    """Give each request to the moto mock its own copy of the response entry.
+
+    moto's copy of HTTPretty keeps the request being answered on an entry
+    that every request to the same URL pattern shares, so the --jobs
+    threads could be answered with each other's keys.
+    """
+    from moto.packages.httpretty import core
+    get_next_entry = core.URIMatcher.get_next_entry
+    if getattr(get_next_entry, "isolated", False):
+        return
+    lock = threading.Lock()
+
+    def get_own_entry(self, method, info, request):
+        with lock:
+            return copy.copy(get_next_entry(self, method, info, request))
+
+    get_own_entry.isolated = True
+    core.URIMatcher.get_next_entry = get_own_entry
+
+def upload(bucket, directory):
+    """Upload every file under directory, keyed by its path relative to it."""
+    for root, directories, files in os.walk(directory):
+        for filename in files:
+            filename = path.join(root, filename)
+            bucket.new_key(path.relpath(filename, directory)).set_contents_from_filename(filename)
+
+def run_step(tracing, name, function, input_rows):
+    print "RUNNING", name
+    first = len(tracing.tracer.statements)
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    statements = tracing.tracer.statements[first:]
+    return {
+        "name": name,
+        "seconds": round(seconds, 3),
+        "input_rows": input_rows,
+        "rows_per_second": round(input_rows / seconds, 1) if seconds else 0,
+        "statements": len(statements),
+        "stages": tracing.stage_totals(statements),
+    }
+
+def print_results(results):
+    print
+    print "{0:<15} {1:>9} {2:>10} {3:>12} {4:>6}".format("STEP", "SECONDS", "ROWS", "ROWS/S", "STMTS")
+    for step in results["steps"]:
+        print "{name:<15} {seconds:9.2f} {input_rows:10d} {rows_per_second:12.1f} {statements:6d}".format(**step)
+        for stage in step["stages"]:
+            print "    {seconds:9.3f}s {statements:5d} statements, slowest {slowest:7.3f}s, {rows:10d} rows  {stage}".format(
+                **stage)
+
+def change(seconds, baseline_seconds):
+    if not baseline_seconds:
+        return "new"
+    return "{0:+.1f}%".format((seconds - baseline_seconds) * 100.0 / baseline_seconds)
+
+def compare(results, baseline):
+    """Print how each step and stage's time changed since baseline."""
+    baseline_steps = dict((step["name"], step) for step in baseline["steps"])
+    print
+    print "CHANGE SINCE", baseline["started_at"]
+    for step in results["steps"]:
+        baseline_step = baseline_steps.get(step["name"])
+        if baseline_step is None:
+            print "{0:<15} new".format(step["name"])
+            continue
+        print "{0:<15} {1:9.2f}s  was {2:9.2f}s  {3}".format(step["name"], step["seconds"],
+                                                            baseline_step["seconds"],
+                                                            change(step["seconds"], baseline_step["seconds"]))
+        baseline_stages = dict((stage["stage"], stage) for stage in baseline_step["stages"])
+        for stage in step["stages"]:
+            baseline_stage = baseline_stages.get(stage["stage"], {"seconds": 0})
+            print "    {0:9.3f}s  was {1:9.3f}s  {2:>8}  {3}".format(stage["seconds"], baseline_stage["seconds"],
+                                                                   change(stage["seconds"], baseline_stage["seconds"]),
+                                                                   stage["stage"])
+
+def main():
+    # Neither reads any settings when imported.
+    import preload
+    import synthetic_data
+
+    parser = argparse.ArgumentParser(description="Benchmark the import pipeline against a local Postgres")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of days to import in parallel")
+    parser.add_argument("--backfill", type=int, default=1, metavar="DAYS",
+                        help="load runs of up to DAYS consecutive days with one COPY each")
+    parser.add_argument("--engine", choices=("sql", "stream"), default="sql",
+                        help="how to aggregate flow events")
+    parser.add_argument("--preload", choices=preload.FORMATS, dest="preload_format",
+                        help="split each day's file into slices of this format before COPY")
+    parser.add_argument("--slices", type=int, default=4,
+                        help="number of slices to preload into")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="keep the tables as monthly partitions behind views")
+    parser.add_argument("--output", metavar="PATH",
+                        help="write the results to PATH as JSON")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare the results with an earlier run's --output")
+    parser.add_argument("--keep-data", metavar="DIRECTORY",
+                        help="generate the data into DIRECTORY and leave it there")
+
+    synthetic_data.add_arguments(parser)
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp()
+    data_directory = args.keep_data or path.join(work_directory, "data")
+    configure_environment(path.join(work_directory, "listings"))
+
+    from moto import mock_s3_deprecated
+    import boto.s3
+    import postgres
+
+    import backends
+    import calculate_daily_summary
+    import import_activity_events
+    import import_counts
+    import import_email_events
+    import import_events
+    import import_flow_events
+    import load_ledger
+    import tracing
+
+    mock = mock_s3_deprecated()
+    mock.start()
+    isolate_mock_requests()
+    try:
+        input_rows = synthetic_data.generate_from_args(data_directory, args)
+        bucket = boto.s3.connect_to_region("us-west-2").create_bucket(import_events.S3_BUCKET,
+                                                                      location="us-west-2")
+        upload(bucket, data_directory)
+
+        db = postgres.Postgres(import_events.DB_URI)
+        db.run(Q_RESET_SCHEMA)
+        db.run(backends.Q_CREATE_STRTOL)
+        # The scripts create their pools with tracing.TracedCursor.
+        tracing.TracedCursor = backends.make_cursor_factory(tracing, bucket)
+
+        options = {"jobs": args.jobs, "backfill": args.backfill, "partitioned": args.partitioned,
+                   "preload_format": args.preload_format, "slices": args.slices}
+        steps = (
+            ("activity", lambda: import_activity_events.run(**options), input_rows["activity"]),
+            ("flow", lambda: import_flow_events.run(engine=args.engine, **options), input_rows["flow"]),
+            ("email", lambda: import_email_events.run(**options), input_rows["email"]),
+            ("counts", lambda: import_counts.import_events(), input_rows["counts"]),
+            ("daily_summary", lambda: calculate_daily_summary.summarize_events(args.partitioned),
+             input_rows["activity"]),
+        )
+        results = {
+            "started_at": load_ledger.now(),
+            "parameters": vars(args),
+            "steps": [run_step(tracing, name, function, rows) for name, function, rows in steps],
+        }
+    finally:
+        mock.stop()
+        shutil.rmtree(work_directory)
+
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+    if args.output:
+        tracing.write_atomically(args.output, json.dumps(results, indent=2) + "\n")
+
+if __name__ == "__main__":
+    main()
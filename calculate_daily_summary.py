@@ -5,13 +5,26 @@
 #
 #  Devices active on each day: (day, uid, userAgentOS)
 #  Users who were multi-device on each day: (day, uid, userAgentOS)
+#  Sketches of the users active on each day, and over the 7 and 28 days
+#  up to it: (day, service, userAgentOS, userAgentBrowser)
+#
+# The first is filled by import_activity_events as it imports each day,
+# from the rows it has just staged. We only rebuild it from the events
+# tables if asked to, with --rebuild-devices, for days imported before
+# that was the case.
 #
 
+import argparse
 import json
 import time
 import datetime
 import os
-import postgres
+
+import backends
+import maintenance
+import partitions
+import sql
+import tracing
 
 REDSHIFT_USER = os.environ["REDSHIFT_USER"]
 REDSHIFT_PASSWORD = os.environ["REDSHIFT_PASSWORD"]
@@ -32,6 +45,7 @@ TABLE_SUFFIXES = (
 
 # For the daily device activity summary,
 # we maintain a table giving (day, uid, device_id).
+# import_activity_events clears and fills it too.
 
 Q_DAILY_DEVICES_CREATE_TABLE = """
     CREATE TABLE IF NOT EXISTS daily_activity_per_device{suffix} (
@@ -46,27 +60,25 @@ Q_DAILY_DEVICES_CREATE_TABLE = """
 """
 
 Q_DAILY_DEVICES_CLEAR = """
-    DELETE FROM daily_activity_per_device{suffix}
-    WHERE day >= '{day_from}'::DATE
-    AND day <= '{day_until}'::DATE;
+    DELETE FROM daily_activity_per_device{suffix}{partition}
+    WHERE {day_range};
 """
 
 Q_DAILY_DEVICES_SUMMARIZE = """
-    INSERT INTO daily_activity_per_device{suffix}
+    INSERT INTO daily_activity_per_device{suffix}{partition}
       (day, uid, device_id, service, ua_browser, ua_version, ua_os)
     SELECT DISTINCT
       timestamp::DATE as day,
       uid, device_id, service, ua_browser, ua_version, ua_os
     FROM activity_events{suffix}
     WHERE device_id != ''
-    AND timestamp::DATE >= '{day_from}'::DATE
-    AND timestamp::DATE <= '{day_until}'::DATE
+    AND {day_range}
     ORDER BY 1;
 """
 
 Q_DAILY_DEVICES_EXPIRE = """
     DELETE FROM daily_activity_per_device{suffix}
-    WHERE day < '{day_first}'::DATE;
+    WHERE day < %(day_first)s;
 """
 
 # For the daily multi-device-users summary, we maintain
@@ -84,29 +96,172 @@ Q_MD_USERS_CREATE_TABLE = """
 """
 
 Q_MD_USERS_CLEAR = """
-    DELETE FROM daily_multi_device_users{suffix}
-    WHERE day >= '{day_from}'::DATE
-    AND day <= '{day_until}'::DATE;
+    DELETE FROM daily_multi_device_users{suffix}{partition}
+    WHERE {day_range};
+"""
+
+# A user is multi-device on a day if any of their other devices were
+# active on that day or the seven days before it. Rather than joining
+# eight days of device activity to itself for every day, we keep a window
+# of (uid, device_id, last_day) with each device's most recent active day,
+# and move it forward one day at a time. Each day then only joins that
+# day's devices to the window.
+
+Q_MD_WINDOW_CREATE = """
+    CREATE TEMPORARY TABLE multi_device_window (
+      uid VARCHAR(64) NOT NULL DISTKEY ENCODE zstd,
+      device_id VARCHAR(32) NOT NULL ENCODE zstd,
+      last_day DATE NOT NULL SORTKEY ENCODE RAW
+    );
+"""
+
+Q_MD_WINDOW_DROP = """
+    DROP TABLE IF EXISTS multi_device_window;
+"""
+
+Q_MD_WINDOW_FILL = """
+    INSERT INTO multi_device_window (uid, device_id, last_day)
+    SELECT uid, device_id, MAX(day)
+    FROM daily_activity_per_device{suffix}
+    WHERE day >= %(day)s - 7
+    AND day < %(day)s
+    GROUP BY uid, device_id;
+"""
+
+Q_MD_WINDOW_EXPIRE = """
+    DELETE FROM multi_device_window
+    WHERE last_day < %(day)s - 7;
+"""
+
+Q_MD_WINDOW_REMOVE_DAY = """
+    DELETE FROM multi_device_window
+    USING daily_activity_per_device{suffix} AS present
+    WHERE present.day = %(day)s
+    AND multi_device_window.uid = present.uid
+    AND multi_device_window.device_id = present.device_id;
+"""
+
+Q_MD_WINDOW_ADD_DAY = """
+    INSERT INTO multi_device_window (uid, device_id, last_day)
+    SELECT DISTINCT uid, device_id, day
+    FROM daily_activity_per_device{suffix}
+    WHERE day = %(day)s;
 """
 
 Q_MD_USERS_SUMMARIZE = """
-    INSERT INTO daily_multi_device_users{suffix} (day, uid, device_now, device_prev)
-    SELECT DISTINCT present.day, present.uid, present.device_id, past.device_id
-    FROM daily_activity_per_device{suffix} as present
-    INNER JOIN daily_activity_per_device{suffix} as past
+    INSERT INTO daily_multi_device_users{suffix}{partition} (day, uid, device_now, device_prev)
+    SELECT present.last_day, present.uid, present.device_id, past.device_id
+    FROM multi_device_window AS present
+    INNER JOIN multi_device_window AS past
     ON
       present.uid = past.uid
       AND present.device_id != past.device_id
-      AND past.day <= present.day
-      AND past.day >= (present.day - '7 days'::INTERVAL)
-    WHERE present.day >= '{day_from}'::DATE
-    AND present.day <= '{day_until}'::DATE
-    ORDER BY 1;
+    WHERE present.last_day = %(day)s;
 """
 
 Q_MD_USERS_EXPIRE = """
     DELETE FROM daily_multi_device_users{suffix}
-    WHERE day < '{day_first}'::DATE;
+    WHERE day < %(day_first)s;
+"""
+
+# For active users, we keep a HyperLogLog sketch of the distinct uids
+# active on each day for each (service, ua_os, ua_browser), and the
+# sketches of those over the ROLLUP_WINDOWS days ending on each day.
+# Sketches merge, so dashboards can count the distinct users of any
+# combination of them with HLL_CARDINALITY(HLL_COMBINE(users)), reading
+# a few thousand rows instead of months of events. user_count is each
+# row's own estimate, for when there's nothing to merge. Each new day is
+# sketched from its own events and rolled up from the daily sketches, so
+# nothing is recomputed for the days before it. Sketches need Redshift,
+# so a Postgres stand-in skips them.
+
+ROLLUP_WINDOWS = (7, 28)
+
+Q_AU_SKETCHES_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS daily_active_user_sketches{suffix} (
+      day DATE NOT NULL SORTKEY ENCODE RAW,
+      service VARCHAR(40) ENCODE zstd,
+      ua_os VARCHAR(40) ENCODE zstd,
+      ua_browser VARCHAR(40) ENCODE zstd,
+      user_count BIGINT NOT NULL ENCODE zstd,
+      users HLLSKETCH NOT NULL
+    )
+    DISTSTYLE EVEN;
+"""
+
+Q_AU_ROLLUPS_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS active_user_rollups{suffix} (
+      day DATE NOT NULL SORTKEY ENCODE RAW,
+      window_days SMALLINT NOT NULL ENCODE zstd,
+      service VARCHAR(40) ENCODE zstd,
+      ua_os VARCHAR(40) ENCODE zstd,
+      ua_browser VARCHAR(40) ENCODE zstd,
+      user_count BIGINT NOT NULL ENCODE zstd,
+      users HLLSKETCH NOT NULL
+    )
+    DISTSTYLE EVEN;
+"""
+
+Q_AU_SKETCHES_CLEAR = """
+    DELETE FROM daily_active_user_sketches{suffix}
+    WHERE {day_range};
+"""
+
+Q_AU_SKETCHES_SUMMARIZE = """
+    INSERT INTO daily_active_user_sketches{suffix}
+      (day, service, ua_os, ua_browser, user_count, users)
+    SELECT
+      timestamp::DATE AS day,
+      service, ua_os, ua_browser,
+      HLL(uid),
+      HLL_CREATE_SKETCH(uid)
+    FROM activity_events{suffix}
+    WHERE {day_range}
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1;
+"""
+
+Q_AU_ROLLUPS_CLEAR = """
+    DELETE FROM active_user_rollups{suffix}
+    WHERE {day_range};
+"""
+
+# Each day in the range is rolled up from the daily sketches of the
+# window_days days that end on it, including those before the range.
+Q_AU_ROLLUPS_SUMMARIZE = """
+    INSERT INTO active_user_rollups{suffix}
+      (day, window_days, service, ua_os, ua_browser, user_count, users)
+    SELECT
+      ends.day, %(window_days)s,
+      sketches.service, sketches.ua_os, sketches.ua_browser,
+      HLL_CARDINALITY(HLL_COMBINE(sketches.users)),
+      HLL_COMBINE(sketches.users)
+    FROM (
+      SELECT DISTINCT day
+      FROM daily_active_user_sketches{suffix}
+      WHERE {day_range}
+    ) AS ends
+    INNER JOIN daily_active_user_sketches{suffix} AS sketches
+    ON
+      sketches.day > ends.day - %(window_days)s
+      AND sketches.day <= ends.day
+    GROUP BY ends.day, sketches.service, sketches.ua_os, sketches.ua_browser
+    ORDER BY 1;
+"""
+
+Q_AU_SKETCHES_EXPIRE = """
+    DELETE FROM daily_active_user_sketches{suffix}
+    WHERE day < %(day_first)s;
+"""
+
+Q_AU_ROLLUPS_EXPIRE = """
+    DELETE FROM active_user_rollups{suffix}
+    WHERE day < %(day_first)s;
+"""
+
+Q_AU_GET_FIRST_UNPROCESSED_DAY = """
+    SELECT (MAX(day) + '1 day'::INTERVAL) AS timestamp
+    FROM daily_active_user_sketches{suffix};
 """
 
 Q_GET_FIRST_AVAILABLE_DAY = """
@@ -124,19 +279,76 @@ Q_GET_LAST_AVAILABLE_DAY = """
     FROM activity_events{suffix};
 """
 
-Q_VACUUM_TABLES = """
-    END;
-    VACUUM FULL daily_activity_per_device{suffix};
-    ANALYZE daily_activity_per_device{suffix};
-    VACUUM FULL daily_multi_device_users{suffix};
-    ANALYZE daily_multi_device_users{suffix};
-"""
+def to_date(value):
+    # MAX(day) + '1 day'::INTERVAL comes back as a timestamp.
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+def days_between(day_from, day_until):
+    day = day_from
+    while day <= day_until:
+        yield day
+        day += datetime.timedelta(days=1)
+
+def summarize_multi_device_users(db, suffix, day_from, day_until, partitioned=False):
+    """Fill daily_multi_device_users for every day from day_from to day_until."""
+    # The window is a temporary table, so keep to one connection.
+    with db.get_cursor() as cursor:
+        cursor.run(Q_MD_WINDOW_DROP)
+        cursor.run(Q_MD_WINDOW_CREATE)
+        cursor.run(sql.build(Q_MD_WINDOW_FILL, {"day": day_from}, suffix=suffix))
+        for day in days_between(day_from, day_until):
+            values = {"day": day}
+            cursor.run(sql.build(Q_MD_WINDOW_EXPIRE, values))
+            cursor.run(sql.build(Q_MD_WINDOW_REMOVE_DAY, values, suffix=suffix))
+            cursor.run(sql.build(Q_MD_WINDOW_ADD_DAY, values, suffix=suffix))
+            cursor.run(sql.build(Q_MD_USERS_SUMMARIZE, values, suffix=suffix,
+                                 partition=partitions.suffix(partitioned, day)))
+        cursor.run(Q_MD_WINDOW_DROP)
+
+def summarize_active_users(db, suffix, day_first, day_until):
+    """Sketch the active users of each day after the last one sketched,
+    until day_until, and roll them up.
+    """
+    db.run(Q_AU_SKETCHES_CREATE_TABLE.format(suffix=suffix))
+    db.run(Q_AU_ROLLUPS_CREATE_TABLE.format(suffix=suffix))
+    day_from = to_date(db.one(Q_AU_GET_FIRST_UNPROCESSED_DAY.format(suffix=suffix))) or day_first
+    if day_from > day_until:
+        return
+    print "  UPDATING ACTIVE USER SKETCHES FROM", day_from, "UNTIL", day_until
+    days = sql.days(day_from, day_until)
+    # The first unprocessed day comes from the sketches, so they and
+    # their rollups go in together.
+    with db.get_cursor() as cursor:
+        cursor.run(sql.build(Q_AU_SKETCHES_CLEAR, days, suffix=suffix, day_range=sql.day_range("day")))
+        cursor.run(sql.build(Q_AU_SKETCHES_SUMMARIZE, days, suffix=suffix,
+                             day_range=sql.day_range("timestamp")))
+        cursor.run(sql.build(Q_AU_ROLLUPS_CLEAR, days, suffix=suffix, day_range=sql.day_range("day")))
+        for window_days in ROLLUP_WINDOWS:
+            cursor.run(sql.build(Q_AU_ROLLUPS_SUMMARIZE, dict(days, window_days=window_days),
+                                 suffix=suffix, day_range=sql.day_range("day")))
 
-def summarize_events():
-    db = postgres.Postgres(DB)
+def summarize_events(partitioned=False, trace_report=None, trace_textfile=None,
+                     explain=None, explain_baseline=None, db=None, rebuild_devices=False,
+                     backend="redshift", export_directory=None, export_from=None):
+    tracing.explain_statements(explain)
+    if db is None:
+        # Nothing here is copied from S3.
+        db = backends.connect(backend, DB, None)
+    tracing.default_labels(event_type="daily_summary")
+    sketches = maintenance.is_redshift(db)
+    if not sketches:
+        print "SKIPPING ACTIVE USER SKETCHES, WHICH NEED REDSHIFT"
+    export_tables = []
     for suffix in TABLE_SUFFIXES:
-        db.run(Q_DAILY_DEVICES_CREATE_TABLE.format(suffix=suffix))
-        db.run(Q_MD_USERS_CREATE_TABLE.format(suffix=suffix))
+        tracing.default_labels(suffix=suffix)
+        tables = (("daily_activity_per_device" + suffix, Q_DAILY_DEVICES_CREATE_TABLE.format(suffix=suffix)),
+                  ("daily_multi_device_users" + suffix, Q_MD_USERS_CREATE_TABLE.format(suffix=suffix)))
+        for table_name, create_query in tables:
+            db.run(create_query)
+            if partitioned:
+                partitions.migrate(db, table_name)
         day_first = db.one(Q_GET_FIRST_AVAILABLE_DAY.format(suffix=suffix))
         # Summarize the latest days that are not yet summarized.
         day_from = db.one(Q_GET_FIRST_UNPROCESSED_DAY.format(suffix=suffix))
@@ -145,27 +357,73 @@ def summarize_events():
             if day_from is None:
                 raise RuntimeError('no events in db')
         day_until = db.one(Q_GET_LAST_AVAILABLE_DAY.format(suffix=suffix))
-        days = {
-            "day_from": day_from,
-            "day_until": day_until,
-            "suffix": suffix
-        }
         print "SUMMARIZING FROM", day_from, "UNTIL", day_until, "FOR SUFFIX", suffix
-        # Update daily device activity.
-        print "  UPDATING DAILY ACTIVE DEVICES SUMMARY"
-        db.run(Q_DAILY_DEVICES_CLEAR.format(**days))
-        db.run(Q_DAILY_DEVICES_SUMMARIZE.format(**days))
+        # Partitions hold one month each, so work a month at a time.
+        if partitioned:
+            month_ranges = partitions.split_by_month(to_date(day_from), to_date(day_until))
+        else:
+            month_ranges = [(day_from, day_until)]
+        for month_from, month_until in month_ranges:
+            if partitioned:
+                for table_name, create_query in tables:
+                    partitions.ensure_partition(db, table_name, create_query, month_from)
+            if rebuild_devices:
+                days = sql.days(month_from, month_until)
+                partition = partitions.suffix(partitioned, month_from)
+                # Rebuild daily device activity from the events.
+                print "  REBUILDING DAILY ACTIVE DEVICES SUMMARY FROM", month_from, "UNTIL", month_until
+                for clear_partition in partitions.suffixes(db, tables[0][0], partitioned,
+                                                           month_from, month_until):
+                    db.run(sql.build(Q_DAILY_DEVICES_CLEAR, days, suffix=suffix, partition=clear_partition,
+                                     day_range=sql.day_range("day")))
+                db.run(sql.build(Q_DAILY_DEVICES_SUMMARIZE, days, suffix=suffix, partition=partition,
+                                 day_range=sql.day_range("timestamp")))
         # Update multi-device-user assessments.
         print "  UPDATING MULTI-DEVICE USERS SUMMARY"
-        db.run(Q_MD_USERS_CLEAR.format(**days))
-        db.run(Q_MD_USERS_SUMMARIZE.format(**days))
+        for month_from, month_until in month_ranges:
+            for partition in partitions.suffixes(db, tables[1][0], partitioned, month_from, month_until):
+                db.run(sql.build(Q_MD_USERS_CLEAR, sql.days(month_from, month_until),
+                                 suffix=suffix, partition=partition,
+                                 day_range=sql.day_range("day")))
+        summarize_multi_device_users(db, suffix, to_date(day_from), to_date(day_until), partitioned)
+        if sketches:
+            summarize_active_users(db, suffix, to_date(day_first), to_date(day_until))
         # Expire old data
         print "EXPIRING", day_first, "FOR SUFFIX", suffix
-        db.run(Q_DAILY_DEVICES_EXPIRE.format(suffix=suffix, day_first=day_first))
-        db.run(Q_MD_USERS_EXPIRE.format(suffix=suffix, day_first=day_first))
+        table_names = []
+        if partitioned:
+            for table_name, create_query in tables:
+                table_names.extend(partitions.expire(db, table_name, "day", day_first))
+        else:
+            db.run(sql.build(Q_DAILY_DEVICES_EXPIRE, {"day_first": sql.day(day_first)}, suffix=suffix))
+            db.run(sql.build(Q_MD_USERS_EXPIRE, {"day_first": sql.day(day_first)}, suffix=suffix))
+            table_names = [table_name for table_name, create_query in tables]
+        if sketches:
+            # The sketch tables are small enough to expire without partitions.
+            db.run(sql.build(Q_AU_SKETCHES_EXPIRE, {"day_first": sql.day(day_first)}, suffix=suffix))
+            db.run(sql.build(Q_AU_ROLLUPS_EXPIRE, {"day_first": sql.day(day_first)}, suffix=suffix))
+            table_names.extend(["daily_active_user_sketches" + suffix, "active_user_rollups" + suffix])
 
-        print "VACUUMING daily_activity_per_device{suffix} AND daily_multi_device_users{suffix}".format(suffix=suffix)
-        db.run(Q_VACUUM_TABLES.format(suffix=suffix))
+        maintenance.maintain(db, table_names)
+        # The activity import exports the daily devices, unless they were rebuilt here.
+        if rebuild_devices:
+            export_tables.append((tables[0][0], "day", None))
+        export_tables.append((tables[1][0], "day", None))
+    if export_directory:
+        backends.export(db, export_directory, "daily_summary", export_tables, export_from)
+    tracing.write_report(trace_report, trace_textfile, explain, explain_baseline)
 
 if __name__ == "__main__":
-    summarize_events()
+    parser = argparse.ArgumentParser(description="Calculate the daily summary tables")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="keep the tables as monthly partitions behind views, "
+                             "so that expiry drops partitions")
+    parser.add_argument("--rebuild-devices", action="store_true",
+                        help="rebuild daily_activity_per_device from the events tables "
+                             "instead of relying on the activity import to fill it")
+    backends.add_arguments(parser)
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    summarize_events(args.partitioned, args.trace_report, args.trace_textfile,
+                     args.explain, args.explain_baseline, rebuild_devices=args.rebuild_devices,
+                     backend=args.backend, export_directory=args.export_directory, export_from=args.export_from)
@@ -8,7 +8,6 @@ fi
 FILE="flow-$1.csv"
 REMOTE_DIR="s3://net-mozaws-prod-us-west-2-pipeline-analysis/fxa-flow/data/"
 REMOTE_FILE="$REMOTE_DIR$FILE"
-TMP_FILE="$FILE.tmp"
 FIXED_FILE="$FILE.fixed"
 
 # Copy data for the specified day from S3
@@ -17,36 +16,8 @@ if [ ! -e "$FILE" ]; then
 fi
 
 # Eliminate lines that look like injection attempts
-grep -v '"' "$FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "'" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v '`' "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v ";" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v ">" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "<" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "\\\\" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "\\./" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -iv "select " "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -iv "declare " "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "burpcollab" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "nslookup" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-grep -v "file:" "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
-
-# Eliminate lines that have the wrong number of fields
-grep -E '^([^,]*,){17}[^,]*$' "$FIXED_FILE" > "$TMP_FILE"
-mv "$TMP_FILE" "$FIXED_FILE"
+# or that have the wrong number of fields
+python "$(dirname "$0")/sanitize_csv.py" --event-type flow --fields 18 "$FILE" "$FIXED_FILE"
 
 echo "Now sanity check the contents of $FIXED_FILE. If it looks ok, upload it with:"
 echo "  aws s3 cp $FIXED_FILE $REMOTE_FILE"
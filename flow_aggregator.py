@@ -0,0 +1,408 @@
+#
+# Streaming alternative to the SQL that builds flow_metadata and
+# flow_experiments.
+#
+# The SQL path inserts each flow.begin row and then updates it from an
+# aggregate of the flow's later events, which on Redshift leaves a ghost
+# row behind for every row it touches. This reads the range's CSV files,
+# plus the day after's, keeps one small record per flow and writes the
+# finished rows out as CSV, ready to COPY and INSERT without updating
+# anything. Rows loaded by other ranges, for flows that were still going
+# when the range began or whose begin event was loaded by a later range,
+# are rewritten from the aggregate of the range's flows it also writes.
+#
+# It reproduces what the SQL path sees of the events tables: every row
+# of the range, plus the next day's rows, when that day is loaded, that
+# the next day's import hasn't already deleted (begin, continued and
+# experiment events). When there are more than max_flows flows, records
+# are spilled to disk by hash of flow_id and merged a partition at a time.
+#
+# Run it directly to build the rows from local files:
+#
+#   python flow_aggregator.py --day-from 2017-06-01 --day-until 2017-06-01 \
+#     --next-day flow-2017-06-02.csv flow-2017-06-01.csv output/
+#
+
+from datetime import datetime, timedelta
+from os import path
+import argparse
+import cPickle as pickle
+import csv
+import os
+import shutil
+import tempfile
+import zlib
+
+import sanitize_csv
+
+# Column order of the flow CSV files.
+COLUMNS = (
+    "timestamp",
+    "type",
+    "flow_id",
+    "flow_time",
+    "ua_browser",
+    "ua_version",
+    "ua_os",
+    "context",
+    "entrypoint",
+    "migration",
+    "service",
+    "utm_campaign",
+    "utm_content",
+    "utm_medium",
+    "utm_source",
+    "utm_term",
+    "locale",
+    "uid",
+)
+
+# Widths of the temporary table's columns. COPY truncates to these.
+WIDTHS = {
+    "type": 79,
+    "flow_id": 64,
+    "uid": 64,
+}
+DEFAULT_WIDTH = 40
+
+# The metadata columns copied from each flow.begin row.
+BEGIN_COLUMNS = (
+    "ua_browser",
+    "ua_version",
+    "ua_os",
+    "context",
+    "entrypoint",
+    "migration",
+    "service",
+    "utm_campaign",
+    "utm_content",
+    "utm_medium",
+    "utm_source",
+    "utm_term",
+)
+
+# Columns of the files we write, in the order they are written.
+METADATA_COLUMNS = ("flow_id", "begin_time", "duration", "completed", "new_account") + \
+    BEGIN_COLUMNS + ("export_date", "locale", "uid", "continued_from", "sample")
+
+EXPERIMENT_COLUMNS = ("experiment", "cohort", "timestamp", "flow_id", "uid", "export_date", "sample")
+
+AGGREGATE_COLUMNS = ("flow_id", "sample", "events", "flow_time", "locale", "uid", "completed",
+                     "new_account", "continued_from", "experiment_events", "experiment_uid")
+
+# How the files we write spell NULL, for COPY's NULL AS.
+NULL = "\\N"
+
+MAX_FLOWS = int(os.environ.get("FLOW_AGGREGATOR_MAX_FLOWS", 2000000))
+
+SPILL_PARTITIONS = 16
+
+INDEXES = dict((column, index) for index, column in enumerate(COLUMNS))
+
+def truncate(value, width):
+    """Truncate a UTF-8 string to width bytes without splitting a character."""
+    if len(value) <= width:
+        return value
+    while width > 0 and (ord(value[width]) & 0xC0) == 0x80:
+        width -= 1
+    return value[:width]
+
+def parse_row(line):
+    """Return the fields of a CSV line, truncated to fit, or None if COPY would reject it."""
+    fields = next(csv.reader([line]), None)
+    if not fields or len(fields) != len(COLUMNS):
+        return None
+    for index, column in enumerate(COLUMNS):
+        if column != "timestamp" and column != "flow_time":
+            fields[index] = truncate(fields[index], WIDTHS.get(column, DEFAULT_WIDTH))
+    try:
+        fields[0] = int(fields[0])
+        fields[3] = int(fields[3])
+    except ValueError:
+        return None
+    return fields
+
+def get_sample(flow_id):
+    # Same as STRTOL(SUBSTRING(flow_id FROM 0 FOR 8), 16) % 100.
+    return int(flow_id[:7], 16) % 100
+
+def split_part(value, index):
+    parts = value.split(".")
+    if index <= len(parts):
+        return parts[index - 1]
+    return ""
+
+def max_of(a, b):
+    # Like SQL's MAX, NULLs (None) are ignored.
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+def is_consumed(event_type):
+    return (event_type == "flow.begin" or event_type.startswith("flow.continued.")
+            or event_type.startswith("flow.experiment."))
+
+class Flow(object):
+    """Everything we need to know about one flow.
+
+    begins and experiments hold the flow's begin and experiment rows from
+    the range's files. The rest aggregates its other events in the window,
+    the way import_flow_events.Q_CREATE_FLOW_AGGREGATE does.
+    """
+
+    __slots__ = ("begins", "experiments", "events", "flow_time", "locale", "uid",
+                 "completed", "new_account", "continued_from", "experiment_events",
+                 "experiment_uid")
+
+    def __init__(self):
+        self.begins = []
+        self.experiments = []
+        self.events = 0
+        self.flow_time = None
+        self.locale = None
+        self.uid = None
+        self.completed = False
+        self.new_account = False
+        self.continued_from = None
+        self.experiment_events = 0
+        self.experiment_uid = None
+
+    def add_event(self, event_type, flow_time, locale, uid):
+        if event_type == "flow.begin":
+            return
+        self.events += 1
+        self.flow_time = max_of(self.flow_time, flow_time)
+        self.locale = max_of(self.locale, locale)
+        self.uid = max_of(self.uid, uid)
+        if event_type == "flow.complete":
+            self.completed = True
+        elif event_type == "account.created":
+            self.new_account = True
+        if event_type.startswith("flow.continued."):
+            self.continued_from = max_of(self.continued_from, event_type[15:79])
+        else:
+            self.experiment_events += 1
+            self.experiment_uid = max_of(self.experiment_uid, uid)
+
+    def merge(self, other):
+        self.begins.extend(other.begins)
+        self.experiments.extend(other.experiments)
+        self.events += other.events
+        self.flow_time = max_of(self.flow_time, other.flow_time)
+        self.locale = max_of(self.locale, other.locale)
+        self.uid = max_of(self.uid, other.uid)
+        self.completed = self.completed or other.completed
+        self.new_account = self.new_account or other.new_account
+        self.continued_from = max_of(self.continued_from, other.continued_from)
+        self.experiment_events += other.experiment_events
+        self.experiment_uid = max_of(self.experiment_uid, other.experiment_uid)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+def format_day(timestamp):
+    return datetime.strftime(datetime.utcfromtimestamp(timestamp), "%Y-%m-%d")
+
+def format_timestamp(timestamp):
+    return datetime.strftime(datetime.utcfromtimestamp(timestamp), "%Y-%m-%d %H:%M:%S")
+
+def format_value(value):
+    if value is None:
+        return NULL
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    return value
+
+class Aggregator(object):
+    """Collects flows from the range's rows and the next day's."""
+
+    def __init__(self, day_from, day_until, max_flows=MAX_FLOWS, directory=None):
+        self.day_from = day_from
+        self.day_until = day_until
+        self.next_day = datetime.strftime(datetime.strptime(day_until, "%Y-%m-%d") +
+                                           timedelta(days=1), "%Y-%m-%d")
+        self.max_flows = max_flows
+        self.directory = directory
+        self.spills = None
+        self.flows = {}
+        self.rejected = 0
+
+    def get_flow(self, flow_id):
+        flow = self.flows.get(flow_id)
+        if flow is None:
+            if len(self.flows) >= self.max_flows:
+                self.spill()
+            flow = self.flows[flow_id] = Flow()
+        return flow
+
+    def clamp(self, day):
+        return min(max(day, self.day_from), self.day_until)
+
+    def add_range_lines(self, lines):
+        """Add the rows of one of the range's own files."""
+        for line in lines:
+            row = parse_row(line)
+            if row is None:
+                self.rejected += 1
+                continue
+            timestamp, event_type, flow_id = row[0], row[1], row[2]
+            day = format_day(timestamp)
+            flow = self.get_flow(flow_id)
+            if event_type == "flow.begin":
+                flow.begins.append((timestamp,) +
+                                   tuple(row[INDEXES[column]] for column in BEGIN_COLUMNS) +
+                                   (self.clamp(day),))
+            elif event_type.startswith("flow.experiment."):
+                flow.experiments.append((split_part(event_type, 3), split_part(event_type, 4),
+                                         timestamp, row[INDEXES["uid"]], self.clamp(day)))
+            # Only rows within the range make it into the events tables.
+            if self.day_from <= day <= self.day_until:
+                flow.add_event(event_type, row[3], row[INDEXES["locale"]], row[INDEXES["uid"]])
+
+    def add_next_day_lines(self, lines):
+        """Add the rows of the next day's file, which has already been loaded."""
+        for line in lines:
+            row = parse_row(line)
+            if row is None:
+                continue
+            timestamp, event_type = row[0], row[1]
+            if is_consumed(event_type) or format_day(timestamp) != self.next_day:
+                continue
+            self.get_flow(row[2]).add_event(event_type, row[3], row[INDEXES["locale"]],
+                                            row[INDEXES["uid"]])
+
+    def spill(self):
+        """Write every flow in memory out to its partition's file."""
+        if self.spills is None:
+            self.spill_directory = tempfile.mkdtemp(dir=self.directory)
+            self.spills = [open(path.join(self.spill_directory, "{0:02d}.spill".format(index)), "w+b")
+                           for index in range(SPILL_PARTITIONS)]
+        for flow_id, flow in self.flows.iteritems():
+            pickle.dump((flow_id, flow), self.spills[zlib.crc32(flow_id) % SPILL_PARTITIONS],
+                        pickle.HIGHEST_PROTOCOL)
+        self.flows = {}
+
+    def partitions(self):
+        """Yield dicts of flow_id -> Flow, merging spilled records."""
+        if self.spills is None:
+            yield self.flows
+            return
+        self.spill()
+        try:
+            for spill in self.spills:
+                spill.seek(0)
+                flows = {}
+                while True:
+                    try:
+                        flow_id, flow = pickle.load(spill)
+                    except EOFError:
+                        break
+                    if flow_id in flows:
+                        flows[flow_id].merge(flow)
+                    else:
+                        flows[flow_id] = flow
+                yield flows
+        finally:
+            for spill in self.spills:
+                spill.close()
+            shutil.rmtree(self.spill_directory)
+            self.spills = None
+
+    def write(self, metadata, experiments, aggregate):
+        """Write the finished rows as CSV to the three file-like objects.
+
+        Returns the number of rows written to each.
+        """
+        counts = {"metadata": 0, "experiments": 0, "aggregate": 0}
+        metadata = csv.writer(metadata, lineterminator="\n")
+        experiments = csv.writer(experiments, lineterminator="\n")
+        aggregate = csv.writer(aggregate, lineterminator="\n")
+        for flows in self.partitions():
+            for flow_id, flow in flows.iteritems():
+                sample = get_sample(flow_id)
+                if flow.events:
+                    duration, locale, uid = flow.flow_time, flow.locale, flow.uid
+                else:
+                    duration, locale, uid = 0, None, None
+                for begin in flow.begins:
+                    metadata.writerow([format_value(value) for value in
+                                       (flow_id, format_timestamp(begin[0]), duration,
+                                        flow.completed, flow.new_account) +
+                                       begin[1:] +
+                                       (locale, uid, flow.continued_from, sample)])
+                    counts["metadata"] += 1
+                for experiment, cohort, timestamp, row_uid, export_date in flow.experiments:
+                    if flow.experiment_events:
+                        row_uid = flow.experiment_uid
+                    experiments.writerow([format_value(value) for value in
+                                          (experiment, cohort, format_timestamp(timestamp),
+                                           flow_id, row_uid, export_date, sample)])
+                    counts["experiments"] += 1
+                # Rows from other ranges only change for flows with events here.
+                if flow.events:
+                    aggregate.writerow([format_value(value) for value in
+                                        (flow_id, sample, flow.events, flow.flow_time,
+                                         flow.locale, flow.uid, flow.completed,
+                                         flow.new_account, flow.continued_from,
+                                         flow.experiment_events, flow.experiment_uid)])
+                    counts["aggregate"] += 1
+        return counts
+
+def aggregate_files(range_sources, next_day_source, day_from, day_until, metadata,
+                    experiments, aggregate, sanitize=False, pad=False, max_flows=MAX_FLOWS):
+    """Build the rows for a range from its files and write them out.
+
+    range_sources and next_day_source are file-like objects; the latter
+    may be None. sanitize and pad drop and pad lines the same way the
+    importer does before COPY. Returns the aggregator, with its counts.
+    """
+    aggregator = Aggregator(day_from, day_until, max_flows)
+
+    def read(source):
+        lines = sanitize_csv.read_lines(source)
+        if sanitize:
+            lines = sanitize_csv.clean_lines(lines, sanitize_csv.get_rules("flow"),
+                                             len(COLUMNS), pad)
+        return lines
+
+    for source in range_sources:
+        aggregator.add_range_lines(read(source))
+    if next_day_source is not None:
+        aggregator.add_next_day_lines(read(next_day_source))
+    aggregator.counts = aggregator.write(metadata, experiments, aggregate)
+    return aggregator
+
+def main():
+    parser = argparse.ArgumentParser(description="Build flow_metadata and flow_experiments rows")
+    parser.add_argument("--day-from", required=True)
+    parser.add_argument("--day-until", required=True)
+    parser.add_argument("--next-day", help="the next day's file, if it has been loaded")
+    parser.add_argument("--max-flows", type=int, default=MAX_FLOWS,
+                        help="flows to keep in memory before spilling to disk")
+    parser.add_argument("inputs", nargs="+")
+    parser.add_argument("output", help="directory to write the CSV files to")
+    args = parser.parse_args()
+    sources = [open(name, "rb") for name in args.inputs]
+    next_day = open(args.next_day, "rb") if args.next_day else None
+    with open(path.join(args.output, "metadata.csv"), "wb") as metadata, \
+            open(path.join(args.output, "experiments.csv"), "wb") as experiments, \
+            open(path.join(args.output, "aggregate.csv"), "wb") as aggregate:
+        aggregator = aggregate_files(sources, next_day, args.day_from, args.day_until,
+                                     metadata, experiments, aggregate, max_flows=args.max_flows)
+    for source in sources + [next_day]:
+        if source is not None:
+            source.close()
+    print "  {0} REJECTED LINES".format(aggregator.rejected)
+    for name, count in sorted(aggregator.counts.items()):
+        print "  {0} {1} ROWS".format(count, name.upper())
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
 #
 # Script to import "activity event" metrics from S3 into redshift.
 #
+# Each range's devices are summarized into daily_activity_per_device as
+# it is imported, from the staged rows, so calculate_daily_summary never
+# has to read the events tables back.
+#
 
+import calculate_daily_summary
 import import_events
+import partitions
+import sql
+
+S3_PREFIX = "fxa-retention/data/events"
 
 SCHEMA = """
     uid VARCHAR(64) NOT NULL DISTKEY ENCODE zstd,
@@ -16,10 +25,62 @@ SCHEMA = """
 
 COLUMNS = "ua_browser, ua_version, ua_os, uid, type, service, device_id"
 
-import_events.run(s3_prefix="fxa-retention/data/events",
-                  event_type="activity",
-                  temp_schema=SCHEMA,
-                  temp_columns=COLUMNS,
-                  perm_schema=SCHEMA,
-                  perm_columns=COLUMNS)
+# The same rows Q_INSERT_EVENTS puts in the events table for the rate,
+# one per device and day.
+Q_DAILY_DEVICES_INSERT = """
+    INSERT INTO daily_activity_per_device{suffix}
+      (day, uid, device_id, service, ua_browser, ua_version, ua_os)
+    SELECT DISTINCT
+      timestamp::DATE AS day,
+      uid, device_id, service, ua_browser, ua_version, ua_os
+    FROM {table_name}
+    WHERE sample < %(percent)s
+    AND device_id != ''
+    AND {day_range}
+    AND timestamp >= %(cutoff)s
+    ORDER BY 1;
+"""
+
+# The tables written by the hook below, for import_events to partition,
+# with the column their days are cleared by.
+HOOK_TABLES = (
+    ("daily_activity_per_device{suffix}", calculate_daily_summary.Q_DAILY_DEVICES_CREATE_TABLE, "day"),
+)
+
+def before_import(db, sample_rates):
+    for rate in sample_rates:
+        db.run(calculate_daily_summary.Q_DAILY_DEVICES_CREATE_TABLE.format(suffix=rate["suffix"]))
+
+# db is the range's journal.Stages, so each rate's devices are replaced
+# in a stage of their own, and a re-imported day gets its devices
+# replaced along with its events.
+def after_range(db, day_from, day_until, staged_table_name, permanent_table_name, sample_rates):
+    days = sql.days(day_from, day_until)
+    for rate in sample_rates:
+        table_name = "daily_activity_per_device" + rate["suffix"]
+        print " ", table_name + rate["partition"]
+        db.stage(table_name, [
+            sql.build(calculate_daily_summary.Q_DAILY_DEVICES_CLEAR, days,
+                      suffix=rate["suffix"], partition=partition,
+                      day_range=sql.day_range("day"))
+            for partition in partitions.suffixes(db, table_name, rate["partitioned"], day_from, day_until)
+        ] + [
+            sql.build(Q_DAILY_DEVICES_INSERT, dict(days, percent=rate["percent"], cutoff=sql.day(rate["cutoff"])),
+                      suffix=rate["suffix"] + rate["partition"], table_name=staged_table_name,
+                      day_range=sql.day_range("timestamp")),
+        ], uses=("staged",))
+
+def run(**options):
+    import_events.run(s3_prefix=S3_PREFIX,
+                      event_type="activity",
+                      temp_schema=SCHEMA,
+                      temp_columns=COLUMNS,
+                      perm_schema=SCHEMA,
+                      perm_columns=COLUMNS,
+                      before_import=before_import,
+                      after_range=after_range,
+                      hook_tables=HOOK_TABLES,
+                      **options)
 
+if __name__ == "__main__":
+    run(**import_events.command_line_options())
@@ -1,10 +1,16 @@
-from os import path
 from datetime import datetime
 import json
 import boto.s3
 import boto.provider
-import postgres
 import os
+import uuid
+
+import backends
+import load_ledger
+import maintenance
+import s3_listing
+import sql
+import tracing
 
 REDSHIFT_USER = os.environ["REDSHIFT_USER"]
 REDSHIFT_PASSWORD = os.environ["REDSHIFT_PASSWORD"]
@@ -40,6 +46,18 @@ S3_BUCKET = "net-mozaws-prod-us-west-2-pipeline-analysis"
 S3_PREFIX = "fxa-basic-metrics/"
 S3_URI = "s3://" + S3_BUCKET + "/" + S3_PREFIX + "fxa-basic-metrics-{day}.txt"
 
+# The files are a line each, so every day that needs loading goes
+# through one COPY, from a manifest listing them all. Each run names its
+# own manifest, so that concurrent runs can't replace or delete it.
+S3_STAGING_PREFIX = env_or_default("S3_STAGING_PREFIX", "fxa-activity-metrics/staging/")
+S3_MANIFEST_KEY = S3_STAGING_PREFIX + "fxa-basic-metrics-{run_id}.manifest"
+
+# Each file used to be loaded by a COPY of its own that allowed 10 bad
+# lines, so the COPY of them all allows 10 for every file it reads, up
+# to Redshift's own limit.
+MAXERROR_PER_FILE = 10
+MAXERROR_LIMIT = 100000
+
 COUNTS_BEGIN = datetime.strptime("2017-05-30", "%Y-%m-%d")
 
 Q_DROP_CSV_TABLE = "DROP TABLE IF EXISTS temporary_raw_counts;"
@@ -52,11 +70,6 @@ Q_CREATE_COUNTS_TABLE = """
     );
 """
 
-Q_CHECK_FOR_DAY = """
-    SELECT day FROM counts
-    WHERE day = '{day}';
-"""
-
 Q_CREATE_CSV_TABLE = """
     CREATE TEMPORARY TABLE IF NOT EXISTS temporary_raw_counts (
       day CHAR(10) NOT NULL UNIQUE SORTKEY,
@@ -65,19 +78,21 @@ Q_CREATE_CSV_TABLE = """
     );
 """
 
-Q_CLEAR_DAY = """
+Q_CLEAR_DAYS = """
     DELETE FROM counts
-    WHERE day = '{day}';
+    USING temporary_raw_counts
+    WHERE counts.day = temporary_raw_counts.day::DATE;
 """
 
 Q_COPY_CSV = """
     COPY temporary_raw_counts (day, accounts, verified_accounts)
-    FROM '{s3_uri}'
-    CREDENTIALS '{CREDENTIALS}'
+    FROM %(s3_path)s
+    CREDENTIALS %(credentials)s
+    MANIFEST
     FORMAT AS CSV
-    MAXERROR AS 10
+    MAXERROR AS {maxerror}
     TRUNCATECOLUMNS;
-""".format(s3_uri=S3_URI, CREDENTIALS=CREDENTIALS)
+"""
 
 Q_INSERT_COUNTS = """
     INSERT INTO counts (day, accounts, verified_accounts)
@@ -85,42 +100,82 @@ Q_INSERT_COUNTS = """
     FROM temporary_raw_counts;
 """
 
-Q_VACUUM_COUNTS = """
-    END;
-    VACUUM FULL counts;
-    ANALYZE counts;
+Q_COUNT_DAYS = """
+    SELECT day::DATE AS day, COUNT(*) AS row_count
+    FROM temporary_raw_counts
+    GROUP BY day::DATE;
 """
 
-def import_events(force_reload=False):
-    s3 = boto.s3.connect_to_region(S3_REGION).get_bucket(S3_BUCKET)
-    db = postgres.Postgres(DB_URI)
+def load_days(db, s3, days, keys):
+    """Load days' files with one COPY and merge them into counts, in one transaction."""
+    manifest = {"entries": [{"url": S3_URI.format(day=day), "mandatory": True} for day in days]}
+    manifest_key = S3_MANIFEST_KEY.format(run_id=uuid.uuid4().hex)
+    s3.new_key(manifest_key).set_contents_from_string(json.dumps(manifest))
+    try:
+        with db.get_cursor() as cursor:
+            print "  COPYING CSV"
+            cursor.run(Q_CREATE_CSV_TABLE)
+            cursor.run(sql.build(Q_COPY_CSV, {"s3_path": "s3://" + S3_BUCKET + "/" + manifest_key,
+                                              "credentials": CREDENTIALS},
+                                 maxerror=min(MAXERROR_PER_FILE * len(days), MAXERROR_LIMIT)))
+            print "  MERGING"
+            cursor.run(Q_CLEAR_DAYS)
+            cursor.run(Q_INSERT_COUNTS)
+            row_counts = {}
+            for row in cursor.all(Q_COUNT_DAYS):
+                row_counts[datetime.strftime(row.day, "%Y-%m-%d")] = row.row_count
+            load_ledger.record_all(cursor, "counts", 100,
+                                   [(day, keys[day], row_counts.get(day, 0)) for day in days])
+            cursor.run(Q_DROP_CSV_TABLE)
+    finally:
+        s3.delete_key(manifest_key)
+
+def import_events(force_reload=False, refresh_listing=False, trace_report=None, trace_textfile=None,
+                  explain=None, explain_baseline=None, db=None, s3=None, backend="redshift",
+                  export_directory=None, export_from=None):
+    tracing.explain_statements(explain)
+    if s3 is None:
+        s3 = boto.s3.connect_to_region(S3_REGION).get_bucket(S3_BUCKET)
+    if db is None:
+        db = backends.connect(backend, DB_URI, s3)
+    tracing.default_labels(event_type="counts")
     db.run(Q_DROP_CSV_TABLE)
     db.run(Q_CREATE_COUNTS_TABLE)
+    load_ledger.create_table(db)
+    load_ledger.seed(db, "counts", [(100, "counts")], day_column="day")
+    entries = load_ledger.get_entries(db, "counts")
     days = []
-    for key in s3.list(prefix=S3_PREFIX):
-        filename = path.basename(key.name)
-        day = "-".join(filename[:-4].split("-")[-3:])
+    keys = {}
+    for entry in s3_listing.list_prefix(s3, S3_PREFIX, refresh_listing):
+        day = entry.day
         date = datetime.strptime(day, "%Y-%m-%d")
         if date >= COUNTS_BEGIN:
-            if force_reload:
+            if force_reload or load_ledger.needs_import(entries, day, entry.etag, (100,)):
                 days.append(day)
-            else:
-                if not db.one(Q_CHECK_FOR_DAY.format(day=day)):
-                    days.append(day)
-    days.sort(reverse=True)
+                keys[day] = entry
+    days.sort()
     print "FOUND", len(days),  "DAYS"
-    for day in days:
-        print day
-        print "  COPYING CSV"
-        db.run(Q_CREATE_CSV_TABLE)
-        db.run(Q_COPY_CSV.format(day=day))
-        print "  CLEARING"
-        db.run(Q_CLEAR_DAY.format(day=day))
-        print "  INSERTING"
-        db.run(Q_INSERT_COUNTS)
-        db.run(Q_DROP_CSV_TABLE)
-    print "VACUUMING"
-    db.run(Q_VACUUM_COUNTS)
+    if days:
+        with tracing.labels(day_from=days[0], day_until=days[-1]):
+            load_days(db, s3, days, keys)
+    maintenance.maintain(db, ["counts"])
+    if export_directory:
+        backends.export(db, export_directory, "counts",
+                        [("counts", "day", None),
+                         ("load_ledger", "day", sql.bind("event_type = %(event_type)s", event_type="counts"))],
+                        export_from)
+    tracing.write_report(trace_report, trace_textfile, explain, explain_baseline)
 
 if __name__ == "__main__":
-    import_events()
+    import argparse
+    parser = argparse.ArgumentParser(description="Import the daily account counts")
+    parser.add_argument("--force-reload", action="store_true",
+                        help="reload every day of the counts, whatever the load ledger says")
+    parser.add_argument("--refresh-listing", action="store_true",
+                        help="list every key under the S3 prefix instead of resuming from the cache")
+    backends.add_arguments(parser)
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    import_events(args.force_reload, args.refresh_listing, args.trace_report, args.trace_textfile,
+                  args.explain, args.explain_baseline, backend=args.backend,
+                  export_directory=args.export_directory, export_from=args.export_from)
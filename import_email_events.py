@@ -3,6 +3,8 @@
 #
 
 import import_events
+
+S3_PREFIX = "fxa-email/data/email-events"
 SCHEMA = """
     flow_id VARCHAR(64) DISTKEY ENCODE zstd,
     domain VARCHAR(40) ENCODE zstd,
@@ -15,10 +17,15 @@ SCHEMA = """
 
 COLUMNS = "flow_id, domain, template, type, bounced, complaint, locale"
 
-import_events.run(s3_prefix="fxa-email/data/email-events",
-                  event_type="email",
-                  temp_schema=SCHEMA,
-                  temp_columns=COLUMNS,
-                  perm_schema=SCHEMA,
-                  perm_columns=COLUMNS,
-                  id_column="flow_id")
+def run(**options):
+    import_events.run(s3_prefix=S3_PREFIX,
+                      event_type="email",
+                      temp_schema=SCHEMA,
+                      temp_columns=COLUMNS,
+                      perm_schema=SCHEMA,
+                      perm_columns=COLUMNS,
+                      id_column="flow_id",
+                      **options)
+
+if __name__ == "__main__":
+    run(**import_events.command_line_options())
@@ -1,11 +1,29 @@
 from os import path
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import argparse
+import calendar
 import json
+import re
+import shutil
+import tempfile
+import threading
 import boto.s3
 import boto.provider
-import postgres
 import os
 
+import backends
+import journal
+import load_ledger
+import maintenance
+import partitions
+import preload
+import s3_listing
+import sanitize_csv
+import sql
+import tracing
+
 REDSHIFT_USER = os.environ["REDSHIFT_USER"]
 REDSHIFT_PASSWORD = os.environ["REDSHIFT_PASSWORD"]
 REDSHIFT_HOST = os.environ["REDSHIFT_HOST"]
@@ -37,6 +55,10 @@ else:
 
 S3_BUCKET = "net-mozaws-prod-us-west-2-pipeline-analysis"
 
+# Where we put intermediate files that COPY loads from,
+# such as the output of the CSV sanitizer.
+S3_STAGING_PREFIX = env_or_default("S3_STAGING_PREFIX", "fxa-activity-metrics/staging/")
+
 # The default data set automatically expires data at
 # three months. We also have sampled data sets that
 # cover a longer history.
@@ -47,117 +69,296 @@ SAMPLE_RATES = (
 )
 
 # The temporary table receives raw data from S3.
-# The permenant table then receives data appropriately typed.
+# The staged table then holds it appropriately typed, along with
+# each row's sample cohort, so that the permanent tables for every
+# sample rate can be filled without recomputing either.
+# With --dedup, the staged rows are copied into the marked table on the
+# way, marking the duplicates among them.
 TABLE_NAMES = {
     "temp":"temporary_raw_{event_type}_data",
+    "staged":"staged_{event_type}_data",
+    "marked":"marked_{event_type}_data",
     "perm":"{event_type}_events{suffix}"
 }
 
 Q_DROP_TEMPORARY_TABLE = """
-    DROP TABLE IF EXISTS {table};
-""".format(table=TABLE_NAMES["temp"])
+    DROP TABLE IF EXISTS {temp_table};
+"""
+
+Q_DROP_STAGED_TABLE = """
+    DROP TABLE IF EXISTS {staged_table};
+"""
+
+Q_DROP_MARKED_TABLE = """
+    DROP TABLE IF EXISTS {marked_table};
+"""
 
 Q_CREATE_EVENTS_TABLE = """
-    CREATE TABLE IF NOT EXISTS {table} (
+    CREATE TABLE IF NOT EXISTS {perm_table} (
         timestamp TIMESTAMP NOT NULL SORTKEY ENCODE RAW,
         {schema}
     );
-""".format(table=TABLE_NAMES["perm"], schema="{schema}")
+"""
 
 Q_GET_MAX_DAY = """
-    SELECT MAX(timestamp)::DATE FROM {table};
-""".format(table=TABLE_NAMES["perm"].format(event_type="{event_type}",
-                                            suffix=""))
-
-Q_CHECK_FOR_DAY = """
-    SELECT timestamp FROM {table}
-    WHERE timestamp::DATE = '{day}'::DATE
-    LIMIT 1;
-""".format(table=TABLE_NAMES["perm"].format(event_type="{event_type}",
-                                            suffix="_sampled_10"),
-           day="{day}")
+    SELECT MAX(timestamp)::DATE FROM {perm_table};
+"""
 
 Q_CREATE_CSV_TABLE = """
-    CREATE TEMPORARY TABLE IF NOT EXISTS {table} (
+    CREATE TEMPORARY TABLE IF NOT EXISTS {temp_table} (
         timestamp BIGINT NOT NULL SORTKEY,
         {schema}
     );
-""".format(table=TABLE_NAMES["temp"], schema="{schema}")
+"""
 
 Q_COPY_CSV = """
-    COPY {table} (
+    COPY {temp_table} (
         timestamp,
         {columns}
     )
-    FROM '{s3_path}'
-    CREDENTIALS '{CREDENTIALS}'
-    FORMAT AS CSV
-    MAXERROR AS 100
-    TRUNCATECOLUMNS;
-""".format(table=TABLE_NAMES["temp"],
-           columns="{columns}",
-           s3_path="{s3_path}",
-           CREDENTIALS="{CREDENTIALS}")
-
-Q_CLEAR_DAY = """
-    DELETE FROM {table}
-    WHERE timestamp::DATE = '{day}'::DATE;
-""".format(table=TABLE_NAMES["perm"], day="{day}")
+    FROM %(s3_path)s
+    CREDENTIALS %(credentials)s
+    {manifest}
+    {options};
+"""
+
+Q_CLEAR_DAYS = """
+    DELETE FROM {perm_table}
+    WHERE {day_range};
+"""
+
+Q_STAGE_EVENTS = """
+    CREATE TEMPORARY TABLE {staged_table}
+    DISTKEY({id_column})
+    SORTKEY(timestamp)
+    AS SELECT
+        'epoch'::TIMESTAMP + timestamp * '1 second'::INTERVAL AS timestamp,
+        STRTOL(SUBSTRING({id_column} FROM 0 FOR 8), 16) %% 100 AS sample,
+        {columns}
+    FROM {temp_table};
+"""
+
+# A staged row is a duplicate if an earlier staged row has the same value
+# in every column. Only the load's own rows are compared: its days are
+# cleared before they are inserted, so loading them again can't duplicate
+# rows that are already there.
+Q_MARK_DUPLICATES = """
+    CREATE TEMPORARY TABLE {marked_table}
+    DISTKEY({id_column})
+    AS SELECT
+        *,
+        ROW_NUMBER() OVER (PARTITION BY timestamp, sample, {columns} ORDER BY timestamp) > 1 AS duplicate
+    FROM {staged_table};
+"""
+
+Q_COUNT_DUPLICATES = """
+    SELECT timestamp::DATE AS day, COUNT(*) AS row_count
+    FROM {marked_table}
+    WHERE duplicate
+    GROUP BY timestamp::DATE
+    ORDER BY 1;
+"""
+
+Q_DEDUP_STAGED_EVENTS = """
+    CREATE TEMPORARY TABLE {staged_table}
+    DISTKEY({id_column})
+    SORTKEY(timestamp)
+    AS SELECT timestamp, sample, {columns}
+    FROM {marked_table}
+    WHERE NOT duplicate;
+"""
 
 Q_INSERT_EVENTS = """
     INSERT INTO {perm_table} (timestamp, {columns})
-    SELECT ts, {columns}
-    FROM (
-        SELECT
-            *,
-            'epoch'::TIMESTAMP + timestamp * '1 second'::INTERVAL AS ts,
-            STRTOL(SUBSTRING({id_column} FROM 0 FOR 8), 16) % 100 AS cohort
-        FROM {temp_table}
-    )
-    WHERE cohort < {percent}
-    AND ts::DATE = '{day}'::DATE
-    AND ts::DATE >= '{max_day}'::DATE - '{months} months'::INTERVAL;
-""".format(perm_table=TABLE_NAMES["perm"],
-           temp_table=TABLE_NAMES["temp"],
-           columns="{columns}",
-           id_column="{id_column}",
-           percent="{percent}",
-           day="{day}",
-           max_day="{max_day}",
-           months="{months}")
+    SELECT timestamp, {columns}
+    FROM {staged_table}
+    WHERE sample < %(percent)s
+    AND {day_range}
+    AND timestamp >= %(cutoff)s;
+"""
+
+Q_COUNT_DAYS = """
+    SELECT timestamp::DATE AS day, COUNT(*) AS row_count
+    FROM {perm_table}
+    WHERE {day_range}
+    GROUP BY timestamp::DATE;
+"""
 
 Q_GET_TIMESTAMP = """
-    SELECT {which}(timestamp) FROM {table};
-""".format(which="{which}", table=TABLE_NAMES["temp"])
+    SELECT {which}(timestamp) FROM {temp_table};
+"""
 
 Q_DELETE_EVENTS = """
-    DELETE FROM {table}
-    WHERE timestamp::DATE < '{day}'::DATE - '{months} months'::INTERVAL;
-""".format(table=TABLE_NAMES["perm"], day="{day}", months="{months}")
-
-Q_VACUUM_TABLES = """
-    END;
-    VACUUM FULL {table};
-    ANALYZE {table};
-""".format(table=TABLE_NAMES["perm"])
+    DELETE FROM {perm_table}
+    WHERE timestamp < %(cutoff)s;
+"""
+
+def table_fragments(event_type, suffix=""):
+    """Return the fragments naming event_type's tables, for sql.prepare."""
+    return {
+        "temp_table": TABLE_NAMES["temp"].format(event_type=event_type),
+        "staged_table": TABLE_NAMES["staged"].format(event_type=event_type),
+        "marked_table": TABLE_NAMES["marked"].format(event_type=event_type),
+        "perm_table": TABLE_NAMES["perm"].format(event_type=event_type, suffix=suffix),
+    }
 
 def nop(*args):
     pass
 
-def run(s3_prefix, event_type, temp_schema, temp_columns, perm_schema, perm_columns, id_column="uid",
-        before_import=nop, after_day=nop, after_import=nop, day_from=None, day_until=None):
+def days_between(day_from, day_until):
+    """Return every day from day_from to day_until inclusive, as YYYY-MM-DD strings."""
+    day = datetime.strptime(day_from, "%Y-%m-%d")
+    until = datetime.strptime(day_until, "%Y-%m-%d")
+    days = []
+    while day <= until:
+        days.append(datetime.strftime(day, "%Y-%m-%d"))
+        day += timedelta(days=1)
+    return days
+
+def next_day(day):
+    return datetime.strftime(datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1), "%Y-%m-%d")
+
+def months_before(day, months):
+    """Subtract months from a YYYY-MM-DD day the way Redshift does,
+    clamping to the end of shorter months.
+    """
+    date = datetime.strptime(day, "%Y-%m-%d")
+    month = date.month - 1 - months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    return "{year:04d}-{month:02d}-{day:02d}".format(
+        year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1]))
+
+def with_cutoffs(sample_rates, max_day, partitioned=False, partition=""):
+    """Copy sample_rates, adding the first day each one's tables keep as "cutoff".
+
+    Each rate also says whether the tables are partitioned and, for hooks
+    called with a range, the suffix of that range's partition ("" if not
+    partitioned), to append to the rate's suffix when writing.
+    """
+    return [dict(rate, cutoff=months_before(max_day, rate["months"]),
+                 partitioned=partitioned, partition=partition)
+            for rate in sample_rates]
+
+def group_ranges(days, max_days):
+    """Group days into runs of consecutive days, each at most max_days long.
+
+    Returns a list of (day_from, day_until) pairs, newest first.
+    """
+    ranges = []
+    for day in sorted(days):
+        if ranges:
+            day_from, day_until = ranges[-1]
+            if next_day(day_until) == day and len(days_between(day_from, day)) <= max_days:
+                ranges[-1] = (day_from, day)
+                continue
+        ranges.append((day, day))
+    ranges.reverse()
+    return ranges
+
+def each_day(after_day):
+    """Adapt an after_day hook to be called with a range of days."""
+    def after_range(db, day_from, day_until, staged_table_name, permanent_table_name, sample_rates):
+        for day in days_between(day_from, day_until):
+            after_day(db, day, staged_table_name, permanent_table_name, sample_rates)
+    return after_range
+
+def command_line_options(add_arguments=nop):
+    """Parse the options shared by every script that calls run().
+
+    add_arguments is called with the parser, for scripts with options of their own.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of days to import in parallel (flow events are copied "
+                             "in parallel, then aggregated one range at a time)")
+    parser.add_argument("--day-from", metavar="YYYY-MM-DD",
+                        help="import no days before this one")
+    parser.add_argument("--day-until", metavar="YYYY-MM-DD",
+                        help="import no days after this one")
+    parser.add_argument("--sanitize", action="store_true",
+                        help="filter out malformed and suspicious rows before COPY")
+    parser.add_argument("--pad", action="store_true",
+                        help="pad short rows with empty fields when sanitizing")
+    parser.add_argument("--backfill", type=int, default=1, metavar="DAYS",
+                        help="load runs of up to DAYS consecutive days with one COPY each")
+    parser.add_argument("--refresh-listing", action="store_true",
+                        help="list every key under the S3 prefix instead of resuming from the cache")
+    parser.add_argument("--preload", choices=preload.FORMATS, dest="preload_format",
+                        help="split each day's file into slices of this format before COPY")
+    parser.add_argument("--slices", type=int, default=0,
+                        help="number of slices to preload into (default: one per cluster slice)")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="keep the tables as monthly partitions behind views, "
+                             "so that expiry drops partitions")
+    parser.add_argument("--dedup", action="store_true",
+                        help="drop rows duplicated within a load before inserting them")
+    backends.add_arguments(parser)
+    tracing.add_arguments(parser)
+    add_arguments(parser)
+    return vars(parser.parse_args())
 
-    def drop_temporary_table():
-        db.run(Q_DROP_TEMPORARY_TABLE.format(event_type=event_type))
+def run(s3_prefix, event_type, temp_schema, temp_columns, perm_schema, perm_columns, id_column="uid",
+        before_import=nop, after_day=nop, after_range=None, after_import=nop,
+        day_from=None, day_until=None, jobs=1, sanitize=False, pad=False, backfill=1,
+        preload_format=None, slices=0, refresh_listing=False, partitioned=False, hook_tables=(),
+        dedup=False, ordered_hooks=False, trace_report=None, trace_textfile=None, explain=None, explain_baseline=None,
+        db=None, s3=None, backend="redshift", export_directory=None, export_from=None, export_tables=()):
+
+    def build(template, values=None, suffix="", **fragments):
+        """Build one of the queries above for this event type and suffix."""
+        fragments.update(table_fragments(event_type, suffix))
+        return sql.build(template, values, **fragments)
+
+    def get_partitioned_tables(rate):
+        """Return (table name, create query) for each of a rate's tables."""
+        tables = [(TABLE_NAMES["perm"].format(event_type=event_type, suffix=rate["suffix"]),
+                   build(Q_CREATE_EVENTS_TABLE, suffix=rate["suffix"], schema=perm_schema))]
+        for table_name, create_query, day_column in hook_tables:
+            tables.append((table_name.format(suffix=rate["suffix"]),
+                           create_query.format(suffix=rate["suffix"])))
+        return tables
+
+    def get_export_tables():
+        """Return (table name, day column, condition) for each table the run fills.
+
+        export_tables adds (table name, day column) for those the hooks fill
+        that hook_tables doesn't list.
+        """
+        tables = []
+        for rate in SAMPLE_RATES:
+            tables.append((TABLE_NAMES["perm"].format(event_type=event_type, suffix=rate["suffix"]),
+                           "timestamp", None))
+            for table_name, create_query, day_column in hook_tables:
+                tables.append((table_name.format(suffix=rate["suffix"]), day_column, None))
+            for table_name, day_column in export_tables:
+                tables.append((table_name.format(suffix=rate["suffix"]), day_column, None))
+        tables.append(("load_ledger", "day", sql.bind("event_type = %(event_type)s", event_type=event_type)))
+        return tables
 
     def create_events_tables():
         for rate in SAMPLE_RATES:
-            db.run(Q_CREATE_EVENTS_TABLE.format(event_type=event_type,
-                                                suffix=rate["suffix"],
-                                                schema=perm_schema))
+            db.run(build(Q_CREATE_EVENTS_TABLE, suffix=rate["suffix"], schema=perm_schema))
+        if partitioned:
+            for rate in SAMPLE_RATES:
+                for table_name, create_query in get_partitioned_tables(rate):
+                    partitions.migrate(db, table_name)
+
+    def create_partitions(day):
+        for rate in SAMPLE_RATES:
+            for table_name, create_query in get_partitioned_tables(rate):
+                partitions.ensure_partition(db, table_name, create_query, day)
+
+    def create_load_ledger():
+        journal.create_table(db)
+        load_ledger.create_table(db)
+        load_ledger.seed(db, event_type,
+                         [(rate["percent"], TABLE_NAMES["perm"].format(event_type=event_type,
+                                                                      suffix=rate["suffix"]))
+                          for rate in SAMPLE_RATES])
 
     def get_max_day():
-        result = db.one(Q_GET_MAX_DAY.format(event_type=event_type))
+        result = db.one(build(Q_GET_MAX_DAY))
         if result:
             return datetime.strftime(result, "%Y-%m-%d")
         return result
@@ -165,9 +366,6 @@ def run(s3_prefix, event_type, temp_schema, temp_columns, perm_schema, perm_colu
     def is_candidate_day(day):
         return (not day_from or day_from <= day) and (not day_until or day_until >= day)
 
-    def is_day_populated(day):
-        return bool(db.one(Q_CHECK_FOR_DAY.format(event_type=event_type, day=day)))
-
     def get_unpopulated_days():
         days = []
         message = "FINDING UNPOPULATED DAYS"
@@ -176,84 +374,292 @@ def run(s3_prefix, event_type, temp_schema, temp_columns, perm_schema, perm_colu
         if day_until:
             message += " UNTIL {day_until}".format(day_until=day_until)
         print message
-        for key in s3.list(prefix=s3_prefix):
-            filename = path.basename(key.name)
-            # Ignore the last four characters (".csv") then join the last
-            # three parts ("YYYY-MM-DD") of the hyphen-split string.
-            day = "-".join(filename[:-4].split("-")[-3:])
-            if is_candidate_day(day) and not is_day_populated(day):
+        entries = load_ledger.get_entries(db, event_type)
+        percents = [rate["percent"] for rate in SAMPLE_RATES]
+        for entry in s3_listing.list_prefix(s3, s3_prefix, refresh_listing):
+            day = entry.day
+            if day in open_days:
+                keys[day] = entry
+            elif is_candidate_day(day) and load_ledger.needs_import(entries, day, entry.etag, percents):
                 days.append(day)
+                keys[day] = entry
         return days
 
-    def get_timestamp(which):
-        return db.one(Q_GET_TIMESTAMP.format(which=which, event_type=event_type))
-
-    def print_timestamp(which):
-        print "  {which} timestamp".format(which=which), get_timestamp(which)
-
-    def import_day(day):
-        print day
+    def get_timestamp(cursor, which):
+        return cursor.one(build(Q_GET_TIMESTAMP, which=which))
+
+    def print_timestamp(cursor, which):
+        print "  {which} timestamp".format(which=which), get_timestamp(cursor, which)
+
+    def staged_key_name(day):
+        return S3_STAGING_PREFIX + path.basename(keys[day].name)
+
+    def sanitize_day(day):
+        print "  SANITIZING CSV"
+        counts = sanitize_csv.sanitize_key(s3_listing.open_entry(s3, keys[day]),
+                                           s3, staged_key_name(day),
+                                           sanitize_csv.get_rules(event_type),
+                                           len(columns) + 1,
+                                           pad)
+        sanitize_csv.print_counts(counts)
+        return "s3://" + S3_BUCKET + "/" + staged_key_name(day)
+
+    def preload_day(day):
+        """Split the day's file into slices in S3, returning their manifest entries."""
+        print "  PRELOADING", slices, preload_format.upper(), "SLICES"
+        directory = tempfile.mkdtemp()
+        try:
+            with tempfile.TemporaryFile() as rejects:
+                source = s3_listing.open_entry(s3, keys[day])
+                lines = sanitize_csv.read_lines(source)
+                if sanitize:
+                    counts = Counter()
+                    lines = sanitize_csv.clean_lines(lines, sanitize_csv.get_rules(event_type),
+                                                     len(columns) + 1, pad, counts, rejects)
+                paths = preload.split(lines, directory, path.basename(keys[day].name)[:-4],
+                                      slices, preload_format, ["timestamp"] + columns,
+                                      integer_columns, column_widths)
+                source.close()
+                if sanitize:
+                    sanitize_csv.print_counts(counts)
+                    sanitize_csv.upload_rejects(s3, rejects, staged_key_name(day))
+            return preload.upload(s3, paths, S3_STAGING_PREFIX)
+        finally:
+            shutil.rmtree(directory)
+
+    def manifest_name(days):
+        return S3_STAGING_PREFIX + "{event_type}-{day_from}-{day_until}.manifest".format(
+            event_type=event_type, day_from=days[0], day_until=days[-1])
+
+    def copy_source(days):
+        """Work out where to COPY the given days' files from.
+
+        Returns the S3 path, the manifest keyword if the path is a manifest,
+        the format of the files and the staged keys to delete afterwards.
+        """
+        if preload_format:
+            entries = []
+            for day in days:
+                entries.extend(preload_day(day))
+        elif sanitize:
+            entries = [{"url": sanitize_day(day), "mandatory": True} for day in days]
+        else:
+            entries = [{"url": s3_uri.format(day=day), "mandatory": True} for day in days]
+        staged_keys = []
+        if preload_format or sanitize:
+            staged_keys = preload.key_names(entries)
+        if len(entries) == 1 and not preload_format:
+            return entries[0]["url"], "", "csv", staged_keys
+        s3.new_key(manifest_name(days)).set_contents_from_string(json.dumps(preload.manifest(entries)))
+        staged_keys.append(manifest_name(days))
+        return ("s3://" + S3_BUCKET + "/" + manifest_name(days), "MANIFEST",
+                preload_format or "csv", staged_keys)
+
+    def record_loads(cursor, rate, days, row_count):
+        if len(days) == 1:
+            row_counts = {days[0]: row_count}
+        else:
+            row_counts = {}
+            for row in cursor.all(build(Q_COUNT_DAYS, sql.days(days[0], days[-1]),
+                                        suffix=rate["suffix"], day_range=sql.day_range("timestamp"))):
+                row_counts[datetime.strftime(row.day, "%Y-%m-%d")] = row.row_count
+        load_ledger.record_all(cursor, event_type, rate["percent"],
+                               [(day, keys[day], row_counts.get(day, 0)) for day in days])
+
+    def remove_duplicates(cursor):
+        """Drop the duplicate rows from the staged table, reporting how many
+        there were on each day.
+        """
+        print "  REMOVING DUPLICATES"
+        cursor.run(build(Q_DROP_MARKED_TABLE))
+        cursor.run(build(Q_MARK_DUPLICATES, id_column=id_column, columns=temp_columns))
+        for row in cursor.all(build(Q_COUNT_DUPLICATES)):
+            print "    REMOVED", row.row_count, "DUPLICATES FROM", datetime.strftime(row.day, "%Y-%m-%d")
+        cursor.run(build(Q_DROP_STAGED_TABLE))
+        cursor.run(build(Q_DEDUP_STAGED_EVENTS, id_column=id_column, columns=temp_columns))
+        cursor.run(build(Q_DROP_MARKED_TABLE))
+
+    def copy_range(cursor, days):
+        """COPY the given days into the staged table, on cursor's connection."""
         print "  COPYING CSV"
-        db.run(Q_CREATE_CSV_TABLE.format(event_type=event_type, schema=temp_schema))
-        s3_path = s3_uri.format(day=day)
-        db.run(Q_COPY_CSV.format(event_type=event_type,
-                                 columns=temp_columns,
-                                 s3_path=s3_path,
-                                 CREDENTIALS=CREDENTIALS))
-        print_timestamp("MIN")
-        print_timestamp("MAX")
-        for rate in SAMPLE_RATES:
-            print " ", TABLE_NAMES["perm"].format(event_type=event_type, suffix=rate["suffix"])
-            print "    CLEARING"
-            db.run(Q_CLEAR_DAY.format(event_type=event_type,
-                                      suffix=rate["suffix"],
-                                      day=day))
-            print "    INSERTING"
-            db.run(Q_INSERT_EVENTS.format(event_type=event_type,
-                                          columns=perm_columns,
-                                          id_column=id_column,
-                                          suffix=rate["suffix"],
-                                          percent=rate["percent"],
-                                          day=day,
-                                          max_day=max_day,
-                                          months=rate["months"]))
-        after_day(db, day,
-                  TABLE_NAMES["temp"].format(event_type=event_type),
-                  TABLE_NAMES["perm"].format(event_type=event_type, suffix="{suffix}"),
-                  SAMPLE_RATES)
-        drop_temporary_table()
+        cursor.run(build(Q_DROP_TEMPORARY_TABLE))
+        cursor.run(build(Q_DROP_STAGED_TABLE))
+        cursor.run(build(Q_CREATE_CSV_TABLE, schema=temp_schema))
+        s3_path, manifest, file_format, staged_keys = copy_source(days)
+        cursor.run(build(Q_COPY_CSV, {"s3_path": s3_path, "credentials": CREDENTIALS},
+                         columns=temp_columns,
+                         manifest=manifest,
+                         options=preload.COPY_OPTIONS[file_format]))
+        cursor.connection.commit()
+        if staged_keys:
+            s3.delete_keys(staged_keys)
+        print_timestamp(cursor, "MIN")
+        print_timestamp(cursor, "MAX")
+        print "  STAGING"
+        cursor.run(build(Q_STAGE_EVENTS, id_column=id_column, columns=temp_columns))
+        cursor.run(build(Q_DROP_TEMPORARY_TABLE))
+        if dedup:
+            remove_duplicates(cursor)
+        cursor.connection.commit()
+
+    def import_range(day_range):
+        day_from, day_until = day_range
+        days = days_between(day_from, day_until)
+        # Each range gets its own connection from the pool. Temporary tables
+        # are private to the session, so concurrent ranges never share one.
+        with tracing.labels(day_from=day_from, day_until=day_until), db.get_connection() as connection:
+            if day_from == day_until:
+                print day_from
+            else:
+                print day_from, "UNTIL", day_until
+            stages = journal.Stages(connection, event_type, day_from, day_until,
+                                    open_ranges.get(day_range, ()))
+            stages.prepare("staged", lambda cursor: copy_range(cursor, days))
+            # Partitioned ranges never cross a month, so they write to one partition.
+            partition = partitions.suffix(partitioned, day_from)
+            if partitioned:
+                create_partitions(day_from)
+            for rate in SAMPLE_RATES:
+                table_name = TABLE_NAMES["perm"].format(event_type=event_type, suffix=rate["suffix"])
+                print " ", table_name + partition
+                # Clearing, inserting and recording the load happen in one
+                # stage so the ledger never disagrees with the table. The
+                # days are cleared from every partition that can hold them,
+                # which after a migration includes the legacy one.
+                with tracing.labels(suffix=rate["suffix"]):
+                    stages.stage(table_name, [
+                        build(Q_CLEAR_DAYS, sql.days(day_from, day_until),
+                              suffix=rate["suffix"] + clear_partition,
+                              day_range=sql.day_range("timestamp"))
+                        for clear_partition in partitions.suffixes(stages, table_name, partitioned,
+                                                                   day_from, day_until)
+                    ] + [
+                        build(Q_INSERT_EVENTS,
+                              dict(sql.days(day_from, day_until),
+                                   percent=rate["percent"],
+                                   cutoff=sql.day(months_before(max_day, rate["months"]))),
+                              suffix=rate["suffix"] + partition,
+                              columns=perm_columns,
+                              day_range=sql.day_range("timestamp")),
+                        lambda cursor, rate=rate: record_loads(cursor, rate, days, cursor.rowcount),
+                    ], uses=("staged",))
+            take_turn(day_range)
+            after_range(stages, day_from, day_until,
+                        TABLE_NAMES["staged"].format(event_type=event_type),
+                        TABLE_NAMES["perm"].format(event_type=event_type, suffix="{suffix}"),
+                        with_cutoffs(SAMPLE_RATES, max_day, partitioned, partition))
+            stages.run(build(Q_DROP_STAGED_TABLE))
+            stages.finish()
+
+    def take_turn(day_range):
+        """Wait until every range before day_range in turns has run its hook."""
+        with turn:
+            while day_range in turns and turns[0] != day_range:
+                if turns[0] in abandoned_turns:
+                    raise RuntimeError("giving up on {0} after {1} failed".format(day_range, turns[0]))
+                turn.wait()
+
+    def end_turn(day_range, failed):
+        with turn:
+            if day_range in turns:
+                if failed:
+                    # The ranges after it wait for it forever, so they give up too.
+                    abandoned_turns.add(day_range)
+                else:
+                    turns.remove(day_range)
+                turn.notify_all()
+
+    def import_range_in_turn(day_range):
+        finished = False
+        try:
+            import_range(day_range)
+            finished = True
+        finally:
+            end_turn(day_range, not finished)
+
+    def import_ranges(ranges):
+        if jobs <= 1:
+            for day_range in ranges:
+                import_range(day_range)
+            return
+        print "IMPORTING", jobs, "RANGES AT A TIME"
+        if ordered_hooks:
+            print "  RUNNING THEIR", event_type.upper(), "HOOKS ONE AT A TIME, NEWEST FIRST"
+            turns.extend(ranges)
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(tracing.carry_labels(import_range_in_turn), ranges, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
     def expire_events():
+        table_names = []
         for rate in SAMPLE_RATES:
             table_name = TABLE_NAMES["perm"].format(event_type=event_type, suffix=rate["suffix"])
             print "EXPIRING", table_name, "FOR", max_day, "+", rate["months"], "MONTHS"
-            db.run(Q_DELETE_EVENTS.format(event_type=event_type,
-                                          suffix=rate["suffix"],
-                                          day=max_day,
-                                          months=rate["months"]))
-            print "VACUUMING AND ANALYZING", table_name
-            db.run(Q_VACUUM_TABLES.format(event_type=event_type,
-                                          suffix=rate["suffix"]))
-
-    s3 = boto.s3.connect_to_region("us-west-2").get_bucket(S3_BUCKET)
-    db = postgres.Postgres(DB_URI)
+            if partitioned:
+                table_names.extend(partitions.expire(db, table_name, "timestamp",
+                                                     months_before(max_day, rate["months"])))
+                continue
+            db.run(build(Q_DELETE_EVENTS, {"cutoff": sql.day(months_before(max_day, rate["months"]))},
+                         suffix=rate["suffix"]))
+            table_names.append(table_name)
+        maintenance.maintain(db, table_names)
+
+    # run_pipeline passes in the bucket and connection pool it shares
+    # between scripts.
+    tracing.explain_statements(explain)
+    if s3 is None:
+        s3 = boto.s3.connect_to_region("us-west-2").get_bucket(S3_BUCKET)
+    if db is None:
+        # One connection per worker, plus one for the rest of the run.
+        db = backends.connect(backend, DB_URI, s3, maxconn=max(jobs, 1) + 1)
+    tracing.default_labels(event_type=event_type)
     s3_uri = "s3://" + S3_BUCKET + "/" + s3_prefix + "-{day}.csv"
-
+    keys = {}
+    # With ordered_hooks and more than one job, ranges are still copied and
+    # staged in parallel, but each waits for the ranges before it to have
+    # run their after_range hooks before running its own. turns holds the
+    # ranges whose hooks are still to run, in order.
+    turns = []
+    turn = threading.Condition()
+    abandoned_turns = set()
+    columns = [column.strip() for column in temp_columns.split(",")]
+    integer_columns = ["timestamp"] + re.findall(r"(\w+)\s+BIGINT", temp_schema)
+    column_widths = dict((column, int(width))
+                         for column, width in re.findall(r"(\w+)\s+VARCHAR\((\d+)\)", temp_schema))
+    if after_range is None:
+        after_range = each_day(after_day)
+
+    if preload_format and not slices:
+        slices = preload.get_slice_count(db)
     before_import(db, SAMPLE_RATES)
-    drop_temporary_table()
     create_events_tables()
+    create_load_ledger()
     max_extant_day = get_max_day()
     if not day_from:
         day_from = max_extant_day
+    # Ranges that an earlier run left unfinished are resumed as they were,
+    # whatever the load ledger says about their days.
+    open_ranges = journal.get_open_ranges(db, event_type)
+    open_days = set()
+    for day_range in open_ranges:
+        open_days.update(days_between(*day_range))
     unpopulated_days = get_unpopulated_days()
     unpopulated_days.sort(reverse=True)
-    if max_extant_day > unpopulated_days[0]:
-        max_day = max_extant_day
-    else:
-        max_day = unpopulated_days[0]
+    max_day = max([max_extant_day] + unpopulated_days + list(open_days))
+    if open_ranges:
+        print "RESUMING", len(open_ranges), "UNFINISHED RANGES"
     print "FOUND", len(unpopulated_days), "DAYS"
-    for day in unpopulated_days:
-        import_day(day)
+    ranges = group_ranges(unpopulated_days, backfill)
+    if partitioned:
+        ranges = [month_range for day_range in ranges
+                  for month_range in reversed(partitions.split_by_month(*day_range))]
+    import_ranges(sorted(list(open_ranges) + ranges, reverse=True))
     expire_events()
-    after_import(db, SAMPLE_RATES, max_day)
+    after_import(db, with_cutoffs(SAMPLE_RATES, max_day, partitioned), max_day)
+    if export_directory:
+        backends.export(db, export_directory, event_type, get_export_tables(), export_from)
+    tracing.write_report(trace_report, trace_textfile, explain, explain_baseline)
 
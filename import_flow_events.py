@@ -2,7 +2,21 @@
 # Script to import "flow event" metrics from S3 into redshift.
 #
 
+from datetime import timedelta
+from os import path
+import shutil
+import tempfile
+import boto.s3
+
+import flow_aggregator
 import import_events
+import load_ledger
+import maintenance
+import partitions
+import preload
+import sql
+
+S3_PREFIX = "fxa-flow/data/flow"
 
 # flow_id is VARCHAR(64) because it's 32 bytes hex-encoded
 # type is VARCHAR(79) so it can contain `flow.continued.${flow_id}`
@@ -101,9 +115,9 @@ Q_CREATE_EXPERIMENTS_TABLE = """
     );
 """
 
-Q_CLEAR_DAY = """
+Q_CLEAR_DAYS = """
     DELETE FROM flow_{table}{suffix}
-    WHERE export_date = '{day}';
+    WHERE {day_range};
 """
 
 Q_INSERT_METADATA = """
@@ -126,7 +140,7 @@ Q_INSERT_METADATA = """
     )
     SELECT
       flow_id,
-      'epoch'::TIMESTAMP + timestamp * '1 second'::INTERVAL,
+      timestamp,
       ua_browser,
       ua_version,
       ua_os,
@@ -139,69 +153,54 @@ Q_INSERT_METADATA = """
       utm_medium,
       utm_source,
       utm_term,
-      '{day}'::DATE
-    FROM (
-      SELECT *, STRTOL(SUBSTRING(flow_id FROM 0 FOR 8), 16) % 100 AS sample
-      FROM {table_name}
-    )
-    WHERE sample < {percent}
+      LEAST(GREATEST(timestamp::DATE, %(day_from)s), %(day_until)s)
+    FROM {table_name}
+    WHERE sample < %(percent)s
     AND type = 'flow.begin';
 """
 
-Q_DELETE_BEGIN_EVENTS = """
-    DELETE FROM {table_name}
-    WHERE timestamp::DATE <= '{day}'
-    AND type = 'flow.begin';
-"""
-
-Q_UPDATE_METADATA = """
-    UPDATE flow_metadata{suffix}
-    SET
-      duration = events.flow_time,
-      locale = events.locale,
-      uid = events.uid
-    FROM (
-      SELECT
-        flow_id,
-        MAX(flow_time) AS flow_time,
-        MAX(locale) AS locale,
-        MAX(uid) AS uid
-      FROM {table_name}
-      WHERE {table_name}.timestamp::DATE = '{day}'
-        OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
-      GROUP BY flow_id
-    ) AS events
-    WHERE flow_metadata{suffix}.flow_id = events.flow_id;
+# Everything the metadata and experiments tables need from the events
+# that follow each flow's begin event, read in one pass over the window
+# from day_from until the end of the day after day_until. Begin events
+# are excluded throughout; continued events are excluded from what the
+# experiments need. The counts tell us whether a flow had any such
+# events at all, because flows without any are left untouched.
+Q_CREATE_FLOW_AGGREGATE = """
+    CREATE TEMPORARY TABLE flow_aggregate
+    DISTKEY(flow_id)
+    AS SELECT
+      flow_id,
+      STRTOL(SUBSTRING(flow_id FROM 0 FOR 8), 16) %% 100 AS sample,
+      SUM(CASE WHEN type <> 'flow.begin' THEN 1 ELSE 0 END) AS events,
+      MAX(CASE WHEN type <> 'flow.begin' THEN flow_time END) AS flow_time,
+      MAX(CASE WHEN type <> 'flow.begin' THEN locale END) AS locale,
+      MAX(CASE WHEN type <> 'flow.begin' THEN uid END) AS uid,
+      MAX(CASE WHEN type = 'flow.complete' THEN 1 ELSE 0 END) = 1 AS completed,
+      MAX(CASE WHEN type = 'account.created' THEN 1 ELSE 0 END) = 1 AS new_account,
+      MAX(CASE WHEN type LIKE 'flow.continued.%%' THEN SUBSTRING(type, 16, 64) END) AS continued_from,
+      SUM(CASE WHEN type <> 'flow.begin' AND type NOT LIKE 'flow.continued.%%' THEN 1 ELSE 0 END) AS experiment_events,
+      MAX(CASE WHEN type <> 'flow.begin' AND type NOT LIKE 'flow.continued.%%' THEN uid END) AS experiment_uid
+    FROM {table_name}
+    WHERE {day_range}
+    GROUP BY flow_id;
 """
 
-Q_UPDATE_COMPLETED = """
-    UPDATE flow_metadata{suffix}
-    SET completed = TRUE
-    FROM (
-      SELECT flow_id
-      FROM {table_name}
-      WHERE type = 'flow.complete'
-        AND (
-          {table_name}.timestamp::DATE = '{day}'
-          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
-        )
-    ) AS complete
-    WHERE flow_metadata{suffix}.flow_id = complete.flow_id;
+Q_DROP_FLOW_AGGREGATE = """
+    DROP TABLE IF EXISTS flow_aggregate;
 """
 
-Q_UPDATE_NEW_ACCOUNT = """
+Q_UPDATE_METADATA = """
     UPDATE flow_metadata{suffix}
-    SET new_account = TRUE
-    FROM (
-      SELECT flow_id
-      FROM {table_name}
-      WHERE type = 'account.created'
-        AND (
-          {table_name}.timestamp::DATE = '{day}'
-          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
-        )
-    ) AS created
-    WHERE flow_metadata{suffix}.flow_id = created.flow_id;
+    SET
+      duration = (CASE WHEN flows.events > 0 THEN flows.flow_time ELSE flow_metadata{suffix}.duration END),
+      locale = (CASE WHEN flows.events > 0 THEN flows.locale ELSE flow_metadata{suffix}.locale END),
+      uid = (CASE WHEN flows.events > 0 THEN flows.uid ELSE flow_metadata{suffix}.uid END),
+      completed = flow_metadata{suffix}.completed OR flows.completed,
+      new_account = flow_metadata{suffix}.new_account OR flows.new_account,
+      continued_from = COALESCE(flows.continued_from, flow_metadata{suffix}.continued_from)
+    FROM flow_aggregate AS flows
+    WHERE flows.sample < %(percent)s
+    AND flow_metadata{suffix}.flow_id = flows.flow_id;
 """
 
 Q_UPDATE_METRICS_CONTEXT = """
@@ -229,37 +228,13 @@ Q_UPDATE_METRICS_CONTEXT = """
         MAX(utm_medium) AS utm_medium,
         MAX(utm_source) AS utm_source,
         MAX(utm_term) AS utm_term
-      FROM (
-        SELECT *, STRTOL(SUBSTRING(flow_id FROM 0 FOR 8), 16) % 100 AS sample
-        FROM {table_name}
-      )
-      WHERE sample < {percent}
+      FROM {table_name}
+      WHERE sample < %(percent)s
       GROUP BY flow_id
     ) AS metrics_context
     WHERE flow_metadata{suffix}.flow_id = metrics_context.flow_id;
 """
 
-Q_UPDATE_CONTINUED_FROM = """
-    UPDATE flow_metadata{suffix}
-    SET continued_from = SUBSTRING(continued.type, 16, 64)
-    FROM (
-      SELECT flow_id, type
-      FROM {table_name}
-      WHERE type LIKE 'flow.continued.%'
-        AND (
-          {table_name}.timestamp::DATE = '{day}'
-          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
-        )
-    ) AS continued
-    WHERE flow_metadata{suffix}.flow_id = continued.flow_id;
-"""
-
-Q_DELETE_CONTINUED_EVENTS = """
-    DELETE FROM {table_name}
-    WHERE timestamp::DATE <= '{day}'
-    AND type LIKE 'flow.continued.%';
-"""
-
 Q_INSERT_EXPERIMENTS = """
     INSERT INTO flow_experiments{suffix} (
       experiment,
@@ -272,127 +247,812 @@ Q_INSERT_EXPERIMENTS = """
     SELECT
       SPLIT_PART(type, '.', 3) AS experiment,
       SPLIT_PART(type, '.', 4) AS cohort,
-      'epoch'::TIMESTAMP + timestamp * '1 second'::INTERVAL,
+      timestamp,
       flow_id,
       uid,
-      '{day}'::DATE
-    FROM (
-      SELECT *, STRTOL(SUBSTRING(flow_id FROM 0 FOR 8), 16) % 100 AS sample
-      FROM {table_name}
-    )
-    WHERE sample < {percent}
-    AND type LIKE 'flow.experiment.%';
+      LEAST(GREATEST(timestamp::DATE, %(day_from)s), %(day_until)s)
+    FROM {table_name}
+    WHERE sample < %(percent)s
+    AND type LIKE 'flow.experiment.%%';
 """
 
 Q_UPDATE_EXPERIMENTS = """
     UPDATE flow_experiments{suffix}
-    SET uid = events.uid
-    FROM (
-      SELECT flow_id, MAX(uid) AS uid
-      FROM {table_name}
-      WHERE {table_name}.timestamp::DATE = '{day}'
-        OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
-      GROUP BY flow_id
-    ) AS events
-    WHERE flow_experiments{suffix}.flow_id = events.flow_id;
+    SET uid = flows.experiment_uid
+    FROM flow_aggregate AS flows
+    WHERE flows.sample < %(percent)s
+    AND flows.experiment_events > 0
+    AND flow_experiments{suffix}.flow_id = flows.flow_id;
+"""
+
+# Tables for the rows built by flow_aggregator. They are loaded with
+# COPY, then inserted into each sample rate's tables filtered on sample.
+Q_CREATE_METADATA_ROWS = """
+    CREATE TEMPORARY TABLE flow_metadata_rows (
+      LIKE flow_metadata{partition}
+    );
+    ALTER TABLE flow_metadata_rows ADD COLUMN sample SMALLINT;
+"""
+
+Q_CREATE_EXPERIMENT_ROWS = """
+    CREATE TEMPORARY TABLE flow_experiment_rows (
+      LIKE flow_experiments{partition}
+    );
+    ALTER TABLE flow_experiment_rows ADD COLUMN sample SMALLINT;
+"""
+
+Q_CREATE_AGGREGATE_ROWS = """
+    CREATE TEMPORARY TABLE flow_aggregate (
+      flow_id VARCHAR(64) NOT NULL DISTKEY ENCODE zstd,
+      sample SMALLINT NOT NULL ENCODE zstd,
+      events BIGINT NOT NULL ENCODE zstd,
+      flow_time BIGINT ENCODE zstd,
+      locale VARCHAR(40) ENCODE zstd,
+      uid VARCHAR(64) ENCODE zstd,
+      completed BOOLEAN NOT NULL ENCODE zstd,
+      new_account BOOLEAN NOT NULL ENCODE zstd,
+      continued_from VARCHAR(64) ENCODE zstd,
+      experiment_events BIGINT NOT NULL ENCODE zstd,
+      experiment_uid VARCHAR(64) ENCODE zstd
+    );
+"""
+
+Q_DROP_ROWS = """
+    DROP TABLE IF EXISTS flow_metadata_rows;
+    DROP TABLE IF EXISTS flow_experiment_rows;
+    DROP TABLE IF EXISTS flow_aggregate;
+"""
+
+Q_COPY_ROWS = """
+    COPY {table_name} ({columns})
+    FROM %(s3_path)s
+    CREDENTIALS %(credentials)s
+    FORMAT AS CSV NULL AS '\\N';
+"""
+
+Q_INSERT_METADATA_ROWS = """
+    INSERT INTO flow_metadata{suffix} ({columns})
+    SELECT {columns}
+    FROM flow_metadata_rows
+    WHERE sample < %(percent)s;
+"""
+
+Q_INSERT_EXPERIMENT_ROWS = """
+    INSERT INTO flow_experiments{suffix} ({columns})
+    SELECT {columns}
+    FROM flow_experiment_rows
+    WHERE sample < %(percent)s;
+"""
+
+# Rows loaded by other ranges, for flows that were still going when the
+# range began or whose begin event was loaded by a later range, take the
+# range's events too. Rather than being updated, they are copied with
+# the aggregate applied as Q_UPDATE_METADATA and Q_UPDATE_EXPERIMENTS
+# would, deleted and inserted again.
+Q_DROP_REWRITES = """
+    DROP TABLE IF EXISTS flow_metadata_rewrites;
+    DROP TABLE IF EXISTS flow_experiment_rewrites;
+"""
+
+Q_CREATE_METADATA_REWRITES = """
+    CREATE TEMPORARY TABLE flow_metadata_rewrites
+    DISTKEY(flow_id)
+    AS SELECT
+      metadata.flow_id,
+      metadata.begin_time,
+      (CASE WHEN flows.events > 0 THEN flows.flow_time ELSE metadata.duration END) AS duration,
+      metadata.completed OR flows.completed AS completed,
+      metadata.new_account OR flows.new_account AS new_account,
+      metadata.ua_browser,
+      metadata.ua_version,
+      metadata.ua_os,
+      metadata.context,
+      metadata.entrypoint,
+      metadata.migration,
+      metadata.service,
+      metadata.utm_campaign,
+      metadata.utm_content,
+      metadata.utm_medium,
+      metadata.utm_source,
+      metadata.utm_term,
+      metadata.export_date,
+      (CASE WHEN flows.events > 0 THEN flows.locale ELSE metadata.locale END) AS locale,
+      (CASE WHEN flows.events > 0 THEN flows.uid ELSE metadata.uid END) AS uid,
+      COALESCE(flows.continued_from, metadata.continued_from) AS continued_from
+    FROM flow_metadata{suffix} AS metadata
+    INNER JOIN flow_aggregate AS flows
+    ON flows.flow_id = metadata.flow_id
+    WHERE flows.sample < %(percent)s
+    AND NOT ({day_range});
+"""
+
+Q_CREATE_EXPERIMENT_REWRITES = """
+    CREATE TEMPORARY TABLE flow_experiment_rewrites
+    DISTKEY(flow_id)
+    AS SELECT
+      experiments.experiment,
+      experiments.cohort,
+      experiments.timestamp,
+      experiments.flow_id,
+      flows.experiment_uid AS uid,
+      experiments.export_date
+    FROM flow_experiments{suffix} AS experiments
+    INNER JOIN flow_aggregate AS flows
+    ON flows.flow_id = experiments.flow_id
+    WHERE flows.sample < %(percent)s
+    AND flows.experiment_events > 0
+    AND NOT ({day_range});
+"""
+
+Q_DELETE_REWRITTEN = """
+    DELETE FROM flow_{table}{suffix}
+    WHERE flow_id IN (SELECT flow_id FROM {rewrites})
+    AND NOT ({day_range});
+"""
+
+Q_INSERT_REWRITES = """
+    INSERT INTO flow_{table}{suffix} ({columns})
+    SELECT {columns}
+    FROM {rewrites};
+"""
+
+# For funnel dashboards, flows are counted by day and by everything they
+# are broken down by, along with how many completed, how long those took
+# and how many created an account. Durations are in milliseconds, and
+# the duration columns only count completed flows.
+Q_CREATE_FUNNEL_TABLE = """
+    CREATE TABLE IF NOT EXISTS flow_funnel_daily{suffix} (
+      day DATE NOT NULL SORTKEY ENCODE RAW,
+      entrypoint VARCHAR(40) ENCODE zstd,
+      service VARCHAR(40) ENCODE zstd,
+      context VARCHAR(40) ENCODE zstd,
+      utm_campaign VARCHAR(40) ENCODE zstd,
+      utm_content VARCHAR(40) ENCODE zstd,
+      utm_medium VARCHAR(40) ENCODE zstd,
+      utm_source VARCHAR(40) ENCODE zstd,
+      utm_term VARCHAR(40) ENCODE zstd,
+      ua_os VARCHAR(40) ENCODE zstd,
+      locale VARCHAR(40) ENCODE zstd,
+      flows BIGINT NOT NULL ENCODE zstd,
+      completed BIGINT NOT NULL ENCODE zstd,
+      new_accounts BIGINT NOT NULL ENCODE zstd,
+      completion_rate REAL NOT NULL ENCODE zstd,
+      duration_p50 BIGINT ENCODE zstd,
+      duration_p90 BIGINT ENCODE zstd,
+      completed_under_10s BIGINT NOT NULL ENCODE zstd,
+      completed_10s_to_1m BIGINT NOT NULL ENCODE zstd,
+      completed_1m_to_5m BIGINT NOT NULL ENCODE zstd,
+      completed_5m_to_30m BIGINT NOT NULL ENCODE zstd,
+      completed_over_30m BIGINT NOT NULL ENCODE zstd
+    )
+    DISTSTYLE EVEN;
+"""
+
+Q_CLEAR_FUNNEL = """
+    DELETE FROM flow_funnel_daily{suffix}
+    WHERE {day_range};
+"""
+
+Q_INSERT_FUNNEL = """
+    INSERT INTO flow_funnel_daily{suffix} (
+      day,
+      entrypoint,
+      service,
+      context,
+      utm_campaign,
+      utm_content,
+      utm_medium,
+      utm_source,
+      utm_term,
+      ua_os,
+      locale,
+      flows,
+      completed,
+      new_accounts,
+      completion_rate,
+      duration_p50,
+      duration_p90,
+      completed_under_10s,
+      completed_10s_to_1m,
+      completed_1m_to_5m,
+      completed_5m_to_30m,
+      completed_over_30m
+    )
+    SELECT
+      export_date,
+      entrypoint,
+      service,
+      context,
+      utm_campaign,
+      utm_content,
+      utm_medium,
+      utm_source,
+      utm_term,
+      ua_os,
+      locale,
+      COUNT(*),
+      SUM(CASE WHEN completed THEN 1 ELSE 0 END),
+      SUM(CASE WHEN new_account THEN 1 ELSE 0 END),
+      SUM(CASE WHEN completed THEN 1 ELSE 0 END)::FLOAT / COUNT(*),
+      PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY CASE WHEN completed THEN duration END),
+      PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY CASE WHEN completed THEN duration END),
+      SUM(CASE WHEN completed AND duration < 10000 THEN 1 ELSE 0 END),
+      SUM(CASE WHEN completed AND duration >= 10000 AND duration < 60000 THEN 1 ELSE 0 END),
+      SUM(CASE WHEN completed AND duration >= 60000 AND duration < 300000 THEN 1 ELSE 0 END),
+      SUM(CASE WHEN completed AND duration >= 300000 AND duration < 1800000 THEN 1 ELSE 0 END),
+      SUM(CASE WHEN completed AND duration >= 1800000 THEN 1 ELSE 0 END)
+    FROM flow_metadata{suffix}
+    WHERE {day_range}
+    GROUP BY
+      export_date,
+      entrypoint,
+      service,
+      context,
+      utm_campaign,
+      utm_content,
+      utm_medium,
+      utm_source,
+      utm_term,
+      ua_os,
+      locale
+    ORDER BY 1;
+"""
+
+Q_EXPIRE_FUNNEL = """
+    DELETE FROM flow_funnel_daily{suffix}
+    WHERE day < %(cutoff)s;
+"""
+
+# Continued flows are resolved into chains. flow_chains has a row for
+# each flow in a chain, naming the flow at the start of the chain and how
+# many continuations away from it the flow is; the flow at the start has
+# a row too, with a depth of 0. flow_chain_totals adds up the flows of
+# each chain, so whole journeys can be read or grouped by root_flow_id.
+Q_CREATE_CHAINS_TABLE = """
+    CREATE TABLE IF NOT EXISTS flow_chains{suffix} (
+      flow_id VARCHAR(64) NOT NULL UNIQUE DISTKEY ENCODE zstd,
+      root_flow_id VARCHAR(64) NOT NULL ENCODE zstd,
+      chain_depth INTEGER NOT NULL ENCODE zstd,
+      export_date DATE NOT NULL SORTKEY ENCODE RAW
+    );
+"""
+
+Q_CREATE_CHAIN_TOTALS_TABLE = """
+    CREATE TABLE IF NOT EXISTS flow_chain_totals{suffix} (
+      root_flow_id VARCHAR(64) NOT NULL UNIQUE DISTKEY ENCODE zstd,
+      flows BIGINT NOT NULL ENCODE zstd,
+      chain_depth INTEGER NOT NULL ENCODE zstd,
+      total_duration BIGINT NOT NULL ENCODE zstd,
+      completed BOOLEAN NOT NULL ENCODE zstd,
+      new_account BOOLEAN NOT NULL ENCODE zstd,
+      first_date DATE NOT NULL SORTKEY ENCODE RAW,
+      last_date DATE NOT NULL ENCODE zstd
+    );
+"""
+
+# Chains are extended incrementally, from the links to parent flows that
+# a range added. Each link starts out pointing at its parent, one step
+# away. Links whose parent is already in a chain jump straight to that
+# chain's root. Then each link repeatedly jumps to wherever the link it
+# points at points, adding up the steps, which halves the distance left
+# each time, until none points at another link. Flows that were at the
+# start of a chain until now are moved, along with their chain, to the
+# root their new link found.
+Q_DROP_CHAIN_LINKS = """
+    DROP TABLE IF EXISTS flow_chain_links;
+    DROP TABLE IF EXISTS flow_chain_roots;
+"""
+
+Q_CREATE_CHAIN_LINKS = """
+    CREATE TEMPORARY TABLE flow_chain_links
+    DISTKEY(flow_id)
+    AS SELECT
+      flow_id,
+      continued_from AS root_flow_id,
+      1 AS chain_depth,
+      export_date
+    FROM flow_metadata{suffix}
+    WHERE continued_from IS NOT NULL
+    AND continued_from != flow_id
+    AND {day_range};
+"""
+
+Q_JOIN_CHAINS = """
+    UPDATE flow_chain_links
+    SET
+      root_flow_id = chains.root_flow_id,
+      chain_depth = flow_chain_links.chain_depth + chains.chain_depth
+    FROM flow_chains{suffix} AS chains
+    WHERE chains.flow_id = flow_chain_links.root_flow_id
+    AND chains.flow_id NOT IN (SELECT flow_id FROM flow_chain_links);
+"""
+
+Q_JUMP_CHAIN_LINKS = """
+    UPDATE flow_chain_links
+    SET
+      root_flow_id = parents.root_flow_id,
+      chain_depth = flow_chain_links.chain_depth + parents.chain_depth
+    FROM flow_chain_links AS parents
+    WHERE parents.flow_id = flow_chain_links.root_flow_id;
+"""
+
+Q_MOVE_CHAINS = """
+    UPDATE flow_chains{suffix}
+    SET
+      root_flow_id = links.root_flow_id,
+      chain_depth = flow_chains{suffix}.chain_depth + links.chain_depth
+    FROM flow_chain_links AS links
+    WHERE flow_chains{suffix}.root_flow_id = links.flow_id;
+"""
+
+Q_CLEAR_CHAIN_LINKS = """
+    DELETE FROM flow_chains{suffix}
+    USING flow_chain_links AS links
+    WHERE flow_chains{suffix}.flow_id = links.flow_id;
+"""
+
+Q_INSERT_CHAIN_LINKS = """
+    INSERT INTO flow_chains{suffix} (flow_id, root_flow_id, chain_depth, export_date)
+    SELECT flow_id, root_flow_id, chain_depth, export_date
+    FROM flow_chain_links;
+"""
+
+# The flows at the start of chains get their rows once they're in
+# flow_metadata, which may be after their continuations when days are
+# imported out of order.
+Q_INSERT_CHAIN_ROOTS = """
+    INSERT INTO flow_chains{suffix} (flow_id, root_flow_id, chain_depth, export_date)
+    SELECT DISTINCT metadata.flow_id, metadata.flow_id, 0, metadata.export_date
+    FROM flow_metadata{suffix} AS metadata
+    INNER JOIN flow_chains{suffix} AS members
+    ON members.root_flow_id = metadata.flow_id
+    LEFT JOIN flow_chains{suffix} AS chains
+    ON chains.flow_id = metadata.flow_id
+    WHERE chains.flow_id IS NULL
+    AND (
+      {day_range}
+      OR metadata.flow_id IN (SELECT root_flow_id FROM flow_chain_links)
+    );
+"""
+
+# The chains whose totals change are those with flows in the range, and
+# those that were just moved to another root.
+Q_CREATE_CHAIN_ROOTS = """
+    CREATE TEMPORARY TABLE flow_chain_roots
+    DISTKEY(root_flow_id)
+    AS SELECT DISTINCT root_flow_id
+    FROM flow_chains{suffix}
+    WHERE {day_range};
 """
 
-Q_DELETE_EXPERIMENT_EVENTS = """
+Q_CLEAR_CHAIN_TOTALS = """
+    DELETE FROM flow_chain_totals{suffix}
+    WHERE root_flow_id IN (SELECT root_flow_id FROM flow_chain_roots)
+    OR root_flow_id IN (SELECT flow_id FROM flow_chain_links);
+"""
+
+Q_INSERT_CHAIN_TOTALS = """
+    INSERT INTO flow_chain_totals{suffix} (
+      root_flow_id,
+      flows,
+      chain_depth,
+      total_duration,
+      completed,
+      new_account,
+      first_date,
+      last_date
+    )
+    SELECT
+      chains.root_flow_id,
+      COUNT(*),
+      MAX(chains.chain_depth),
+      SUM(metadata.duration),
+      MAX(CASE WHEN metadata.completed THEN 1 ELSE 0 END) = 1,
+      MAX(CASE WHEN metadata.new_account THEN 1 ELSE 0 END) = 1,
+      MIN(metadata.export_date),
+      MAX(metadata.export_date)
+    FROM flow_chain_roots AS roots
+    INNER JOIN flow_chains{suffix} AS chains
+    ON chains.root_flow_id = roots.root_flow_id
+    INNER JOIN flow_metadata{suffix} AS metadata
+    ON metadata.flow_id = chains.flow_id
+    GROUP BY chains.root_flow_id;
+"""
+
+Q_EXPIRE_CHAINS = """
+    DELETE FROM flow_chains{suffix}
+    WHERE export_date < %(cutoff)s;
+"""
+
+Q_EXPIRE_CHAIN_TOTALS = """
+    DELETE FROM flow_chain_totals{suffix}
+    WHERE last_date < %(cutoff)s;
+"""
+
+# Each jump halves the distance left, so this allows for chains far
+# longer than any real one, and stops bad data that loops from looping
+# forever.
+MAX_CHAIN_JUMPS = 32
+
+# Once they are in the metadata and experiments tables, these
+# events are no longer needed in the events tables.
+Q_DELETE_CONSUMED_EVENTS = """
     DELETE FROM {table_name}
-    WHERE timestamp::DATE <= '{day}'
-    AND type LIKE 'flow.experiment.%';
+    WHERE {day_range}
+    AND (
+      type = 'flow.begin'
+      OR type LIKE 'flow.continued.%%'
+      OR type LIKE 'flow.experiment.%%'
+    );
 """
 
 Q_EXPIRE = """
     DELETE FROM {table_name}
-    WHERE export_date < '{max_day}'::DATE - '{months} months'::INTERVAL;
+    WHERE export_date < %(cutoff)s;
 """
 
-Q_VACUUM = """
-    END;
-    VACUUM FULL {table_name};
-    ANALYZE {table_name};
-"""
+# The tables written by the hooks below, for import_events to partition,
+# with the column their days are cleared and expired by.
+HOOK_TABLES = (
+    ("flow_metadata{suffix}", Q_CREATE_METADATA_TABLE, "export_date"),
+    ("flow_experiments{suffix}", Q_CREATE_EXPERIMENTS_TABLE, "export_date"),
+)
+
+# The other tables they fill by day, for import_events to export. The
+# chains aren't exported, because a chain can begin before the first day
+# a local run imports, and only Redshift knows where.
+EXPORT_TABLES = (
+    ("flow_funnel_daily{suffix}", "day"),
+)
 
 def before_import(db, sample_rates):
     for rate in sample_rates:
         db.run(Q_CREATE_METADATA_TABLE.format(suffix=rate["suffix"]))
         db.run(Q_CREATE_EXPERIMENTS_TABLE.format(suffix=rate["suffix"]))
+        db.run(Q_CREATE_FUNNEL_TABLE.format(suffix=rate["suffix"]))
+        db.run(Q_CREATE_CHAINS_TABLE.format(suffix=rate["suffix"]))
+        db.run(Q_CREATE_CHAIN_TOTALS_TABLE.format(suffix=rate["suffix"]))
+
+def get_source_rate(sample_rates, day):
+    """Return the most complete sample rate whose events tables still
+    hold day, falling back to the one with the longest history.
+    """
+    rates = [rate for rate in sample_rates if rate["cutoff"] <= day]
+    if rates:
+        return max(rates, key=lambda rate: rate["percent"])
+    return max(sample_rates, key=lambda rate: rate["months"])
 
-def after_day(db, day, temporary_table_name, permanent_table_name, sample_rates):
+# Flow events are attributed to the day of the file they came from,
+# exported as export_date. When a range of days is loaded with one COPY
+# we no longer know which file each row came from, so we use the row's
+# own day, clamped to the range. For a single day that is just the day.
+#
+# The events are aggregated per flow once, from the most complete events
+# table, and every sample rate's tables are updated from that aggregate,
+# filtered on the flow's sample cohort. The events it consumed are only
+# deleted once every rate has been updated, so if the import is resumed
+# partway through, the aggregate can be rebuilt as it was.
+#
+# db is the range's journal.Stages, so each step below is a stage.
+def after_range(db, day_from, day_until, staged_table_name, permanent_table_name, sample_rates):
+    days = sql.days(day_from, day_until)
+    source_rate = get_source_rate(sample_rates, day_from)
+    source_table_name = permanent_table_name.format(suffix=source_rate["suffix"])
+
+    def create_flow_aggregate(cursor):
+        print "  AGGREGATING", source_table_name
+        cursor.run(Q_DROP_FLOW_AGGREGATE)
+        # The window runs until the end of the day after day_until.
+        cursor.run(sql.build(Q_CREATE_FLOW_AGGREGATE,
+                             dict(days, window_until=sql.next_day(day_until)),
+                             table_name=source_table_name,
+                             day_range=sql.day_range("timestamp", day_until="window_until")))
+
+    db.prepare("flow_aggregate", create_flow_aggregate)
     for rate in sample_rates:
-        print "  flow_metadata{suffix}".format(suffix=rate["suffix"])
-        print "    CLEARING"
-        db.run(Q_CLEAR_DAY.format(table="metadata", suffix=rate["suffix"], day=day))
-        table_name = permanent_table_name.format(suffix=rate["suffix"])
+        metadata = "flow_metadata{suffix}".format(suffix=rate["suffix"])
+        experiments = "flow_experiments{suffix}".format(suffix=rate["suffix"])
+        print " ", metadata
         print "    INSERTING"
-        db.run(Q_INSERT_METADATA.format(suffix=rate["suffix"],
-                                        day=day,
-                                        table_name=temporary_table_name,
-                                        percent=rate["percent"]))
-        db.run(Q_DELETE_BEGIN_EVENTS.format(table_name=table_name, day=day))
-        print "    UPDATING"
-        db.run(Q_UPDATE_METADATA.format(suffix=rate["suffix"],
-                                        table_name=table_name,
-                                        day=day))
-        db.run(Q_UPDATE_COMPLETED.format(suffix=rate["suffix"],
-                                         table_name=table_name,
-                                         day=day))
-        db.run(Q_UPDATE_NEW_ACCOUNT.format(suffix=rate["suffix"],
-                                           table_name=table_name,
-                                           day=day))
-        if day < '2016-10-25':
+        suffix = rate["suffix"] + rate["partition"]
+        metadata_suffixes = partitions.suffixes(db, metadata, rate["partitioned"])
+        db.stage(metadata + " insert", clear_days(db, "metadata", rate, days) + [
+            sql.build(Q_INSERT_METADATA, dict(days, percent=rate["percent"]),
+                      suffix=suffix, table_name=staged_table_name),
+        ], uses=("staged",))
+        if day_from < '2016-10-25':
             # This query only exists because, once upon a time, metrics context
             # data was not emitted reliably with the flow.begin event. There's no
             # need to execute it on data emitted since train 71 shipped. I think
             # that was around the 14th October 2016 but I'm not certain, hence
             # the conservative estimate used here.
-            db.run(Q_UPDATE_METRICS_CONTEXT.format(suffix=rate["suffix"],
-                                                   table_name=temporary_table_name,
-                                                   percent=rate["percent"]))
-        db.run(Q_UPDATE_CONTINUED_FROM.format(suffix=rate["suffix"],
-                                              table_name=table_name,
-                                              day=day))
-        db.run(Q_DELETE_CONTINUED_EVENTS.format(table_name=table_name, day=day))
-        print "  flow_experiments{suffix}".format(suffix=rate["suffix"])
-        print "    CLEARING"
-        db.run(Q_CLEAR_DAY.format(table="experiments", suffix=rate["suffix"], day=day))
+            db.stage(metadata + " metrics_context", [
+                sql.build(Q_UPDATE_METRICS_CONTEXT, {"percent": rate["percent"]},
+                          suffix=rate["suffix"] + partition, table_name=staged_table_name)
+                for partition in metadata_suffixes
+            ], uses=("staged",))
+        print "    UPDATING"
+        db.stage(metadata + " update", [
+            sql.build(Q_UPDATE_METADATA, {"percent": rate["percent"]},
+                      suffix=rate["suffix"] + partition)
+            for partition in metadata_suffixes
+        ], uses=("flow_aggregate",))
+        print " ", experiments
         print "    INSERTING"
-        db.run(Q_INSERT_EXPERIMENTS.format(suffix=rate["suffix"],
-                                           day=day,
-                                           table_name=temporary_table_name,
-                                           percent=rate["percent"]))
+        db.stage(experiments + " insert", clear_days(db, "experiments", rate, days) + [
+            sql.build(Q_INSERT_EXPERIMENTS, dict(days, percent=rate["percent"]),
+                      suffix=suffix, table_name=staged_table_name),
+        ], uses=("staged",))
         print "    UPDATING"
-        db.run(Q_UPDATE_EXPERIMENTS.format(suffix=rate["suffix"],
-                                           table_name=table_name,
-                                           day=day))
-        db.run(Q_DELETE_EXPERIMENT_EVENTS.format(table_name=table_name, day=day))
+        db.stage(experiments + " update", [
+            sql.build(Q_UPDATE_EXPERIMENTS, {"percent": rate["percent"]},
+                      suffix=rate["suffix"] + partition)
+            for partition in partitions.suffixes(db, experiments, rate["partitioned"])
+        ], uses=("flow_aggregate",))
+    update_funnel(db, days, sample_rates)
+    update_chains(db, days, sample_rates)
+    delete_consumed_events(db, days, permanent_table_name, sample_rates)
+    db.run(Q_DROP_FLOW_AGGREGATE)
+
+def clear_days(db, table, rate, days):
+    """Return the queries that clear the days from every partition of a
+    rate's table that can hold them, the legacy one included.
+    """
+    table_name = "flow_{table}{suffix}".format(table=table, suffix=rate["suffix"])
+    return [sql.build(Q_CLEAR_DAYS, days, table=table, suffix=rate["suffix"] + partition,
+                      day_range=sql.day_range("export_date"))
+            for partition in partitions.suffixes(db, table_name, rate["partitioned"],
+                                                 days["day_from"], days["day_until"])]
+
+def rewrite_other_ranges(table, suffix, percent, days, columns):
+    """Return the queries that rewrite the rows of a partition of table
+    loaded by other ranges, from the streaming hook's flow_aggregate.
+    """
+    create_query, rewrites = {
+        "metadata": (Q_CREATE_METADATA_REWRITES, "flow_metadata_rewrites"),
+        "experiments": (Q_CREATE_EXPERIMENT_REWRITES, "flow_experiment_rewrites"),
+    }[table]
+    return [
+        Q_DROP_REWRITES,
+        sql.build(create_query, dict(days, percent=percent), suffix=suffix,
+                  day_range=sql.day_range("{0}.export_date".format(table))),
+        sql.build(Q_DELETE_REWRITTEN, days, table=table, suffix=suffix, rewrites=rewrites,
+                  day_range=sql.day_range("export_date")),
+        sql.prepare(Q_INSERT_REWRITES, table=table, suffix=suffix, rewrites=rewrites, columns=columns),
+        Q_DROP_REWRITES,
+    ]
+
+def touched_days(days):
+    """Return the values to bind for a touched_range.
+
+    Besides the range's own flows, the updates above touch those of the
+    day before, which can complete on its first day, and those of the day
+    after, whose events the aggregate window reads when the days are
+    imported out of order.
+    """
+    return dict(days, window_from=days["day_from"] - timedelta(days=1),
+                window_until=days["day_until"] + timedelta(days=1))
+
+def touched_range(column):
+    return sql.day_range(column, day_from="window_from", day_until="window_until")
+
+def update_funnel(db, days, sample_rates):
+    """Rebuild the funnel for the days whose flows the range added or updated."""
+    for rate in sample_rates:
+        funnel = "flow_funnel_daily{suffix}".format(suffix=rate["suffix"])
+        print " ", funnel
+        db.stage(funnel, [
+            sql.build(query, touched_days(days), suffix=rate["suffix"], day_range=touched_range(day_column))
+            for query, day_column in ((Q_CLEAR_FUNNEL, "day"), (Q_INSERT_FUNNEL, "export_date"))
+        ])
+
+def jump_chain_links(cursor):
+    for jump in range(MAX_CHAIN_JUMPS):
+        cursor.run(Q_JUMP_CHAIN_LINKS)
+        if cursor.rowcount == 0:
+            return
+    print "    GAVE UP RESOLVING CHAINS AFTER", MAX_CHAIN_JUMPS, "JUMPS"
+
+def update_chains(db, days, sample_rates):
+    """Add the continuations of flows the range added or updated to their
+    chains, and add up those chains again.
+    """
+    for rate in sample_rates:
+        chains = "flow_chains{suffix}".format(suffix=rate["suffix"])
+        print " ", chains
+
+        def build(query, day_column="export_date"):
+            return sql.build(query, touched_days(days), suffix=rate["suffix"],
+                             day_range=touched_range(day_column))
+
+        db.stage(chains, [
+            Q_DROP_CHAIN_LINKS,
+            build(Q_CREATE_CHAIN_LINKS),
+            build(Q_JOIN_CHAINS),
+            jump_chain_links,
+            build(Q_MOVE_CHAINS),
+            build(Q_CLEAR_CHAIN_LINKS),
+            build(Q_INSERT_CHAIN_LINKS),
+            build(Q_INSERT_CHAIN_ROOTS, "metadata.export_date"),
+            build(Q_CREATE_CHAIN_ROOTS),
+            build(Q_CLEAR_CHAIN_TOTALS),
+            build(Q_INSERT_CHAIN_TOTALS),
+            Q_DROP_CHAIN_LINKS,
+        ])
+
+def delete_consumed_events(db, days, permanent_table_name, sample_rates):
+    # Older consumed events were deleted when their own days were imported,
+    # so only the range's days need looking at. Older ranges being imported
+    # alongside this one haven't been aggregated yet, so theirs are left be.
+    for rate in sample_rates:
+        table_name = permanent_table_name.format(suffix=rate["suffix"])
+        print "  DELETING CONSUMED EVENTS FROM", table_name
+        db.stage(table_name + " delete", [
+            sql.build(Q_DELETE_CONSUMED_EVENTS, days, table_name=table_name + partition,
+                      day_range=sql.day_range("timestamp"))
+            for partition in partitions.suffixes(db, table_name, rate["partitioned"],
+                                                 days["day_from"], days["day_until"])
+        ])
+
+def get_key_name(day):
+    return S3_PREFIX + "-{day}.csv".format(day=day)
+
+def streaming_after_range(s3, sanitize=False, pad=False):
+    """Return an after_range hook that builds the metadata and experiments
+    rows with flow_aggregator instead of updating them in SQL, so that
+    it runs no UPDATE statements.
+
+    Ranges old enough to need Q_UPDATE_METRICS_CONTEXT still go through
+    after_range.
+    """
+    def build_rows(cursor, day_from, day_until, source_rate, partition):
+        next_day = import_events.next_day(day_until)
+        # The SQL path only sees the next day's events once they are loaded.
+        entries = load_ledger.get_entries(cursor, "flow")
+        if (next_day, source_rate["percent"]) in entries:
+            next_day_key = s3.get_key(get_key_name(next_day))
+        else:
+            next_day_key = None
+        print "  AGGREGATING FLOWS"
+        directory = tempfile.mkdtemp()
+        try:
+            names = {}
+            for name in ("metadata", "experiments", "aggregate"):
+                names[name] = path.join(directory, "flow-{name}-{day_from}-{day_until}.csv".format(
+                    name=name, day_from=day_from, day_until=day_until))
+            sources = [s3.new_key(get_key_name(day))
+                       for day in import_events.days_between(day_from, day_until)]
+            with open(names["metadata"], "wb") as metadata, \
+                    open(names["experiments"], "wb") as experiments, \
+                    open(names["aggregate"], "wb") as aggregate:
+                aggregator = flow_aggregator.aggregate_files(sources, next_day_key, day_from,
+                                                             day_until, metadata, experiments,
+                                                             aggregate, sanitize, pad)
+            for source in sources + [next_day_key]:
+                if source is not None:
+                    source.close()
+            print "  {0} REJECTED LINES".format(aggregator.rejected)
+            entries = {}
+            for name in names:
+                entries[name] = preload.upload(s3, [names[name]], import_events.S3_STAGING_PREFIX)[0]
+        finally:
+            shutil.rmtree(directory)
+        cursor.run(Q_DROP_ROWS)
+        cursor.run(Q_CREATE_METADATA_ROWS.format(partition=partition))
+        cursor.run(Q_CREATE_EXPERIMENT_ROWS.format(partition=partition))
+        cursor.run(Q_CREATE_AGGREGATE_ROWS)
+        for table_name, name, columns in (
+                ("flow_metadata_rows", "metadata", flow_aggregator.METADATA_COLUMNS),
+                ("flow_experiment_rows", "experiments", flow_aggregator.EXPERIMENT_COLUMNS),
+                ("flow_aggregate", "aggregate", flow_aggregator.AGGREGATE_COLUMNS)):
+            cursor.run(sql.build(Q_COPY_ROWS,
+                                 {"s3_path": entries[name]["url"], "credentials": import_events.CREDENTIALS},
+                                 table_name=table_name,
+                                 columns=", ".join(columns)))
+        s3.delete_keys(preload.key_names(entries.values()))
+
+    def after_streaming_range(db, day_from, day_until, staged_table_name, permanent_table_name,
+                              sample_rates):
+        if day_from < '2016-10-25':
+            return after_range(db, day_from, day_until, staged_table_name,
+                               permanent_table_name, sample_rates)
+        days = sql.days(day_from, day_until)
+        source_rate = get_source_rate(sample_rates, day_from)
+        db.prepare("flow_rows", lambda cursor: build_rows(cursor, day_from, day_until, source_rate,
+                                                          source_rate["partition"]))
+        metadata_columns = ", ".join(flow_aggregator.METADATA_COLUMNS[:-1])
+        experiment_columns = ", ".join(flow_aggregator.EXPERIMENT_COLUMNS[:-1])
+        for rate in sample_rates:
+            metadata = "flow_metadata{suffix}".format(suffix=rate["suffix"])
+            experiments = "flow_experiments{suffix}".format(suffix=rate["suffix"])
+            print " ", metadata
+            print "    INSERTING"
+            suffix = rate["suffix"] + rate["partition"]
+            db.stage(metadata + " insert", clear_days(db, "metadata", rate, days) + [
+                sql.build(Q_INSERT_METADATA_ROWS, {"percent": rate["percent"]},
+                          suffix=suffix, columns=metadata_columns),
+            ], uses=("flow_rows",))
+            print "    REWRITING OTHER RANGES"
+            db.stage(metadata + " update", [
+                query
+                for partition in partitions.suffixes(db, metadata, rate["partitioned"])
+                for query in rewrite_other_ranges("metadata", rate["suffix"] + partition,
+                                                  rate["percent"], days, metadata_columns)
+            ], uses=("flow_rows",))
+            print " ", experiments
+            print "    INSERTING"
+            db.stage(experiments + " insert", clear_days(db, "experiments", rate, days) + [
+                sql.build(Q_INSERT_EXPERIMENT_ROWS, {"percent": rate["percent"]},
+                          suffix=suffix, columns=experiment_columns),
+            ], uses=("flow_rows",))
+            print "    REWRITING OTHER RANGES"
+            db.stage(experiments + " update", [
+                query
+                for partition in partitions.suffixes(db, experiments, rate["partitioned"])
+                for query in rewrite_other_ranges("experiments", rate["suffix"] + partition,
+                                                  rate["percent"], days, experiment_columns)
+            ], uses=("flow_rows",))
+        update_funnel(db, days, sample_rates)
+        update_chains(db, days, sample_rates)
+        delete_consumed_events(db, days, permanent_table_name, sample_rates)
+        db.run(Q_DROP_ROWS)
+
+    return after_streaming_range
 
 def expire(db, table_name, max_day, months):
     print "EXPIRING", table_name, "FOR", max_day, "+", months, "MONTHS"
-    db.run(Q_EXPIRE.format(table_name=table_name, max_day=max_day, months=months))
-
-def vacuum(db, table_name):
-    print "VACUUMING AND ANALYZING", table_name
-    db.run(Q_VACUUM.format(table_name=table_name))
+    db.run(sql.build(Q_EXPIRE, {"cutoff": sql.day(import_events.months_before(max_day, months))},
+                     table_name=table_name))
 
 def after_import(db, sample_rates, max_day):
+    table_names = []
     for rate in sample_rates:
-        table_name = "flow_metadata{suffix}".format(suffix=rate["suffix"])
-        expire(db, table_name, max_day, rate["months"])
-        vacuum(db, table_name)
-        table_name = "flow_experiments{suffix}".format(suffix=rate["suffix"])
-        expire(db, table_name, max_day, rate["months"])
-        vacuum(db, table_name)
-
-import_events.run(s3_prefix="fxa-flow/data/flow",
-                  event_type="flow",
-                  temp_schema=TEMPORARY_SCHEMA,
-                  temp_columns=TEMPORARY_COLUMNS,
-                  perm_schema=EVENT_SCHEMA,
-                  perm_columns=EVENT_COLUMNS,
-                  id_column="flow_id",
-                  before_import=before_import,
-                  after_day=after_day,
-                  after_import=after_import)
+        for table_name, create_query, day_column in HOOK_TABLES:
+            table_name = table_name.format(suffix=rate["suffix"])
+            if rate["partitioned"]:
+                print "EXPIRING", table_name, "FOR", max_day, "+", rate["months"], "MONTHS"
+                table_names.extend(partitions.expire(db, table_name, day_column, rate["cutoff"]))
+            else:
+                expire(db, table_name, max_day, rate["months"])
+                table_names.append(table_name)
+        funnel = "flow_funnel_daily{suffix}".format(suffix=rate["suffix"])
+        print "EXPIRING", funnel, "AND CHAINS FOR", max_day, "+", rate["months"], "MONTHS"
+        for query in (Q_EXPIRE_FUNNEL, Q_EXPIRE_CHAINS, Q_EXPIRE_CHAIN_TOTALS):
+            db.run(sql.build(query, {"cutoff": sql.day(rate["cutoff"])}, suffix=rate["suffix"]))
+        table_names.extend([funnel, "flow_chains" + rate["suffix"], "flow_chain_totals" + rate["suffix"]])
+    maintenance.maintain(db, table_names)
+
+def run(engine="sql", **options):
+    if engine == "stream":
+        # The hook reads the files from the same bucket as the import.
+        if options.get("s3") is None:
+            options["s3"] = boto.s3.connect_to_region("us-west-2").get_bucket(import_events.S3_BUCKET)
+        hook = streaming_after_range(options["s3"], options.get("sanitize", False),
+                                     options.get("pad", False))
+    else:
+        hook = after_range
+    import_events.run(s3_prefix=S3_PREFIX,
+                      event_type="flow",
+                      temp_schema=TEMPORARY_SCHEMA,
+                      temp_columns=TEMPORARY_COLUMNS,
+                      perm_schema=EVENT_SCHEMA,
+                      perm_columns=EVENT_COLUMNS,
+                      id_column="flow_id",
+                      before_import=before_import,
+                      after_range=hook,
+                      after_import=after_import,
+                      hook_tables=HOOK_TABLES,
+                      export_tables=EXPORT_TABLES,
+                      # A range's flows are completed by the next day's events,
+                      # so with --jobs the ranges are copied in parallel but
+                      # aggregated one at a time, newest first.
+                      ordered_hooks=True,
+                      **options)
+
+def add_arguments(parser):
+    parser.add_argument("--engine", choices=("sql", "stream"), default="sql",
+                        help="build flow_metadata and flow_experiments in SQL, or by streaming "
+                             "the CSV files through flow_aggregator")
 
+if __name__ == "__main__":
+    run(**import_events.command_line_options(add_arguments))
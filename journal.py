@@ -0,0 +1,136 @@
+#
+# Stage journal shared by the import scripts.
+#
+# Importing a range of days happens in stages: inserting into each
+# sample rate's events table, then whatever the script's after_range
+# hook does. Each stage commits in one transaction along with its entry
+# in the journal, so a stage is either finished and journalled or not
+# applied at all. If a run dies partway through a range, the next run
+# resumes that range at its first unfinished stage instead of starting
+# the whole range again. Once every stage of a range has finished, its
+# entries are cleared.
+#
+# COPY and staging aren't journalled, because they load into temporary
+# tables that don't outlive the session. They are redone, lazily, only
+# when a stage that reads the staged table still has to run. Hooks can
+# register their own temporary tables the same way, with prepare.
+#
+
+from datetime import datetime
+
+import load_ledger
+import sql
+import tracing
+
+Q_CREATE_JOURNAL_TABLE = """
+    CREATE TABLE IF NOT EXISTS import_journal (
+      event_type VARCHAR(40) NOT NULL ENCODE zstd,
+      day_from DATE NOT NULL SORTKEY ENCODE RAW,
+      day_until DATE NOT NULL ENCODE zstd,
+      stage VARCHAR(128) NOT NULL ENCODE zstd,
+      finished_at TIMESTAMP NOT NULL ENCODE zstd
+    )
+    DISTSTYLE ALL;
+"""
+
+Q_GET_STAGES = """
+    SELECT day_from, day_until, stage
+    FROM import_journal
+    WHERE event_type = %(event_type)s;
+"""
+
+Q_FINISH_STAGE = """
+    INSERT INTO import_journal (event_type, day_from, day_until, stage, finished_at)
+    VALUES (%(event_type)s, %(day_from)s, %(day_until)s, %(stage)s, %(finished_at)s::TIMESTAMP);
+"""
+
+Q_CLEAR_RANGE = """
+    DELETE FROM import_journal
+    WHERE event_type = %(event_type)s
+    AND day_from = %(day_from)s
+    AND day_until = %(day_until)s;
+"""
+
+def create_table(db):
+    db.run(Q_CREATE_JOURNAL_TABLE)
+
+def get_open_ranges(db, event_type):
+    """Return a dict of (day_from, day_until) -> set of finished stages.
+
+    Only ranges that were left unfinished have any entries.
+    """
+    ranges = {}
+    for row in db.all(sql.build(Q_GET_STAGES, {"event_type": event_type})):
+        day_range = (datetime.strftime(row.day_from, "%Y-%m-%d"),
+                     datetime.strftime(row.day_until, "%Y-%m-%d"))
+        ranges.setdefault(day_range, set()).add(row.stage)
+    return ranges
+
+class Stages(object):
+    """Runs the stages of one range on a connection, skipping finished ones.
+
+    This is what the after_range hooks receive as their db argument. Plain
+    run, one and all calls go straight to the connection and commit with
+    the next stage.
+    """
+
+    def __init__(self, connection, event_type, day_from, day_until, finished=()):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.event_type = event_type
+        self.day_from = day_from
+        self.day_until = day_until
+        self.finished = set(finished)
+        self.preparations = {}
+
+    def prepare(self, name, function):
+        """Register function to be called with the cursor before the first
+        stage that uses name, if there is one.
+        """
+        self.preparations[name] = function
+
+    def run(self, *args, **kwargs):
+        return self.cursor.run(*args, **kwargs)
+
+    def one(self, *args, **kwargs):
+        return self.cursor.one(*args, **kwargs)
+
+    def all(self, *args, **kwargs):
+        return self.cursor.all(*args, **kwargs)
+
+    def is_finished(self, name):
+        return name in self.finished
+
+    def stage(self, name, queries, uses=()):
+        """Run queries as the stage called name, unless it already finished.
+
+        queries may be SQL strings or functions to call with the cursor.
+        uses names the preparations the queries depend on. Returns True if
+        the stage ran.
+        """
+        if name in self.finished:
+            print "    SKIPPING FINISHED STAGE", name
+            return False
+        for preparation in uses:
+            if preparation in self.preparations:
+                with tracing.labels(stage=preparation):
+                    self.preparations.pop(preparation)(self.cursor)
+        with tracing.labels(stage=name):
+            for query in queries:
+                if callable(query):
+                    query(self.cursor)
+                else:
+                    self.cursor.run(query)
+        self.cursor.run(sql.build(Q_FINISH_STAGE, dict(sql.days(self.day_from, self.day_until),
+                                                       event_type=self.event_type,
+                                                       stage=name,
+                                                       finished_at=load_ledger.now())))
+        self.connection.commit()
+        self.finished.add(name)
+        return True
+
+    def finish(self):
+        """Commit anything outstanding and forget the range's stages."""
+        self.cursor.run(sql.build(Q_CLEAR_RANGE, dict(sql.days(self.day_from, self.day_until),
+                                                      event_type=self.event_type)))
+        self.connection.commit()
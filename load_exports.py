@@ -0,0 +1,89 @@
+#
+# Script to load the tables a local run exported into Redshift.
+#
+# Each script run with --export writes its own directory under the one
+# given, holding an exports.json that describes the files in it. For
+# each file, the days it covers are deleted from the Redshift table and
+# the file is loaded with one COPY, in one transaction. Each script's
+# load ledger comes after its tables, so that if this is interrupted,
+# the days that aren't loaded yet aren't recorded as loaded either.
+#
+
+from os import path
+import argparse
+import json
+import os
+
+import boto.s3
+
+import backends
+import import_events
+import maintenance
+import partitions
+import sql
+import tracing
+
+Q_CLEAR_DAYS = """
+    DELETE FROM {table}
+    WHERE {day_range}
+    AND {condition};
+"""
+
+Q_COPY_EXPORT = """
+    COPY {table} ({columns})
+    FROM %(s3_path)s
+    CREDENTIALS %(credentials)s
+    FORMAT AS CSV GZIP NULL AS %(null)s TIMEFORMAT 'auto';
+"""
+
+def get_exports(directory):
+    """Return (directory, export) for every file exported under directory."""
+    exports = []
+    for name in sorted(os.listdir(directory)):
+        exports_file = path.join(directory, name, backends.EXPORTS_FILE)
+        if path.isfile(exports_file):
+            with open(exports_file) as exports_json:
+                exports.extend((path.join(directory, name), export) for export in json.load(exports_json))
+    return exports
+
+def load_exports(directory, trace_report=None, trace_textfile=None, explain=None, explain_baseline=None,
+                 db=None, s3=None):
+    tracing.explain_statements(explain)
+    if s3 is None:
+        s3 = boto.s3.connect_to_region("us-west-2").get_bucket(import_events.S3_BUCKET)
+    if db is None:
+        db = backends.connect("redshift", import_events.DB_URI, s3)
+    exports = get_exports(directory)
+    if not exports:
+        raise RuntimeError("nothing exported under " + directory)
+    table_names = []
+    for export_directory, export in exports:
+        table = export["table"]
+        if partitions.is_partitioned(db, table):
+            raise RuntimeError("can't load into " + table + ", which is partitioned")
+        print "LOADING", export["row_count"], "ROWS INTO", table,
+        print "FROM", export["day_from"], "UNTIL", export["day_until"]
+        key_name = import_events.S3_STAGING_PREFIX + path.basename(export_directory) + "-" + export["file"]
+        s3.new_key(key_name).set_contents_from_filename(path.join(export_directory, export["file"]))
+        try:
+            with tracing.labels(stage=table), db.get_cursor() as cursor:
+                cursor.run(sql.build(Q_CLEAR_DAYS, sql.days(export["day_from"], export["day_until"]),
+                                     table=table, day_range=sql.day_range(export["day_column"]),
+                                     condition=export["condition"]))
+                cursor.run(sql.build(Q_COPY_EXPORT, {"s3_path": "s3://" + import_events.S3_BUCKET + "/" + key_name,
+                                                     "credentials": import_events.CREDENTIALS,
+                                                     "null": backends.EXPORT_NULL},
+                                     table=table, columns=", ".join(export["columns"])))
+        finally:
+            s3.delete_key(key_name)
+        if table not in table_names:
+            table_names.append(table)
+    maintenance.maintain(db, table_names)
+    tracing.write_report(trace_report, trace_textfile, explain, explain_baseline)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the tables exported by a local run into Redshift")
+    parser.add_argument("directory", help="the directory given to --export")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    load_exports(args.directory, args.trace_report, args.trace_textfile, args.explain, args.explain_baseline)
@@ -0,0 +1,132 @@
+#
+# Bookkeeping shared by the import scripts.
+#
+# For each event type, day and sample rate we record which S3 object
+# was loaded, its ETag and size, how many rows it produced and when.
+# Working out which days still need importing is then one query against
+# this table, diffed in memory against the S3 listing, rather than one
+# probe of the events tables per file.
+#
+
+from datetime import datetime
+
+import sql
+
+Q_CREATE_LEDGER_TABLE = """
+    CREATE TABLE IF NOT EXISTS load_ledger (
+      event_type VARCHAR(40) NOT NULL ENCODE zstd,
+      day DATE NOT NULL SORTKEY ENCODE RAW,
+      sample_rate SMALLINT NOT NULL ENCODE zstd,
+      s3_key VARCHAR(256) ENCODE zstd,
+      etag VARCHAR(64) ENCODE zstd,
+      size BIGINT ENCODE zstd,
+      row_count BIGINT ENCODE zstd,
+      loaded_at TIMESTAMP NOT NULL ENCODE zstd
+    )
+    DISTSTYLE ALL;
+"""
+
+Q_COUNT_ENTRIES = """
+    SELECT COUNT(*) FROM load_ledger
+    WHERE event_type = %(event_type)s;
+"""
+
+# Seeds the ledger from a table that was populated before the ledger
+# existed. We don't know the ETags of those loads, so they are left NULL
+# and treated as matching whatever is currently in S3.
+Q_SEED_ENTRIES = """
+    INSERT INTO load_ledger (event_type, day, sample_rate, row_count, loaded_at)
+    SELECT %(event_type)s, {day_column}::DATE, %(percent)s, COUNT(*), %(loaded_at)s::TIMESTAMP
+    FROM {table}
+    GROUP BY {day_column}::DATE;
+"""
+
+Q_GET_ENTRIES = """
+    SELECT day, sample_rate, etag
+    FROM load_ledger
+    WHERE event_type = %(event_type)s;
+"""
+
+Q_CLEAR_ENTRIES = """
+    DELETE FROM load_ledger
+    WHERE event_type = %(event_type)s
+    AND sample_rate = %(percent)s
+    AND day IN ({days});
+"""
+
+Q_INSERT_ENTRIES = """
+    INSERT INTO load_ledger (event_type, day, sample_rate, s3_key, etag, size, row_count, loaded_at)
+    VALUES {values};
+"""
+
+Q_ENTRY_VALUES = """
+      (%(event_type)s, %(day)s, %(percent)s, %(s3_key)s, %(etag)s, %(size)s, %(row_count)s, %(loaded_at)s::TIMESTAMP)"""
+
+def now():
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+def create_table(db):
+    db.run(Q_CREATE_LEDGER_TABLE)
+
+def seed(db, event_type, tables, day_column="timestamp"):
+    """Populate the ledger for event_type from existing tables.
+
+    tables is a sequence of (percent, table_name) pairs. Nothing happens if
+    the ledger already has entries for event_type.
+    """
+    if db.one(sql.build(Q_COUNT_ENTRIES, {"event_type": event_type})):
+        return
+    print "SEEDING LOAD LEDGER FOR", event_type
+    loaded_at = now()
+    for percent, table in tables:
+        db.run(sql.build(Q_SEED_ENTRIES, {"event_type": event_type, "percent": percent, "loaded_at": loaded_at},
+                         day_column=day_column, table=table))
+
+def get_entries(db, event_type):
+    """Return a dict of (day, percent) -> ETag for everything loaded so far."""
+    entries = {}
+    for row in db.all(sql.build(Q_GET_ENTRIES, {"event_type": event_type})):
+        day = datetime.strftime(row.day, "%Y-%m-%d")
+        entries[(day, row.sample_rate)] = row.etag
+    return entries
+
+def needs_import(entries, day, etag, percents):
+    """Is any sample rate for day missing, or loaded from a different object?"""
+    for percent in percents:
+        key = (day, percent)
+        if key not in entries:
+            return True
+        if entries[key] is not None and entries[key] != etag:
+            return True
+    return False
+
+def record(db, event_type, day, percent, key, row_count):
+    """Replace the ledger entry for (event_type, day, percent).
+
+    key is the s3_listing.Entry that was loaded.
+
+    Run this on the same cursor as the load itself, so the entry commits
+    or rolls back along with the data.
+    """
+    record_all(db, event_type, percent, [(day, key, row_count)])
+
+def record_all(db, event_type, percent, loads):
+    """Replace the ledger entries for a batch of days in two statements.
+
+    loads is a sequence of (day, key, row_count) triples, as for record.
+    """
+    if not loads:
+        return
+    loaded_at = now()
+    days = ", ".join(sql.literal(sql.day(day)) for day, key, row_count in loads)
+    db.run(sql.bind(Q_CLEAR_ENTRIES.format(days=days), event_type=event_type, percent=percent))
+    # Each row is bound on its own, so the statement is complete once they're joined.
+    db.run(Q_INSERT_ENTRIES.format(values=",".join(sql.build(Q_ENTRY_VALUES, {"event_type": event_type,
+                                                                              "day": sql.day(day),
+                                                                              "percent": percent,
+                                                                              "s3_key": key.name,
+                                                                              "etag": key.etag,
+                                                                              "size": key.size,
+                                                                              "row_count": row_count,
+                                                                              "loaded_at": loaded_at})
+                                                   for day, key, row_count in loads)))
@@ -0,0 +1,173 @@
+#
+# Decide how much VACUUM and ANALYZE each table actually needs.
+#
+# Rather than running VACUUM FULL and ANALYZE on every table after
+# every import, we read the table's statistics and pick the cheapest
+# operation that deals with whatever is wrong with it. On Redshift the
+# statistics come from svv_table_info; on a plain Postgres stand-in
+# they come from pg_stat_user_tables, which has no notion of sortedness.
+#
+# The thresholds are percentages and can be overridden from the
+# environment.
+#
+# When run_pipeline runs every script in one process, it defers their
+# maintenance and does it all at the end, once per table.
+#
+
+import os
+import threading
+
+import sql
+
+def env_or_default(variable_name, default_value):
+    if variable_name in os.environ:
+        return os.environ[variable_name]
+
+    return default_value
+
+THRESHOLDS = {
+    # Vacuum to reclaim space once this much of the table is deleted rows.
+    "deleted": float(env_or_default("VACUUM_DELETED_PERCENT", 5)),
+    # Vacuum to re-sort once this much of the table is unsorted.
+    "unsorted": float(env_or_default("VACUUM_UNSORTED_PERCENT", 5)),
+    # Analyze once the planner's statistics are this far out of date.
+    "stats_off": float(env_or_default("ANALYZE_STATS_OFF_PERCENT", 10)),
+}
+
+# Table names waiting for maintain_deferred, or None when not deferring.
+deferred = None
+deferred_lock = threading.Lock()
+
+Q_GET_VERSION = "SELECT version();"
+
+Q_GET_REDSHIFT_TABLE_INFO = """
+    SELECT
+      tbl_rows AS total_rows,
+      tbl_rows - estimated_visible_rows AS deleted_rows,
+      unsorted,
+      stats_off
+    FROM svv_table_info
+    WHERE "table" = %(table_name)s
+    AND schema = current_schema();
+"""
+
+Q_GET_POSTGRES_TABLE_INFO = """
+    SELECT
+      n_live_tup + n_dead_tup AS total_rows,
+      n_dead_tup AS deleted_rows,
+      NULL AS unsorted,
+      n_mod_since_analyze * 100.0 / GREATEST(n_live_tup, 1) AS stats_off
+    FROM pg_stat_user_tables
+    WHERE relname = %(table_name)s
+    AND schemaname = current_schema();
+"""
+
+Q_VACUUM = "VACUUM {mode} {table_name};"
+
+Q_ANALYZE = "ANALYZE {table_name};"
+
+# Postgres' plain VACUUM is the equivalent of Redshift's DELETE ONLY.
+# It keeps no sort order, so there is never anything to re-sort.
+POSTGRES_VACUUM_MODES = {
+    "FULL": "FULL",
+    "DELETE ONLY": "",
+    "SORT ONLY": None,
+}
+
+def is_redshift(db):
+    return "Redshift" in db.one(Q_GET_VERSION)
+
+def get_table_info(db, table_name, redshift):
+    if redshift:
+        query = Q_GET_REDSHIFT_TABLE_INFO
+    else:
+        query = Q_GET_POSTGRES_TABLE_INFO
+    return db.one(sql.build(query, {"table_name": table_name}))
+
+def percent(value):
+    return float(value or 0)
+
+def plan(info, thresholds=THRESHOLDS):
+    """Return (vacuum_mode, analyze, reasons) for a table's statistics.
+
+    vacuum_mode is one of None, "DELETE ONLY", "SORT ONLY" or "FULL".
+    """
+    if info is None or not info.total_rows:
+        return None, False, ["no statistics, table is empty"]
+    deleted = info.deleted_rows * 100.0 / info.total_rows
+    unsorted = percent(info.unsorted)
+    stats_off = percent(info.stats_off)
+    reasons = []
+    needs_delete = deleted >= thresholds["deleted"]
+    needs_sort = unsorted >= thresholds["unsorted"]
+    reasons.append("deleted {0:.1f}% {1} {2:.1f}%".format(
+        deleted, ">=" if needs_delete else "<", thresholds["deleted"]))
+    reasons.append("unsorted {0:.1f}% {1} {2:.1f}%".format(
+        unsorted, ">=" if needs_sort else "<", thresholds["unsorted"]))
+    analyze = stats_off >= thresholds["stats_off"]
+    reasons.append("stats_off {0:.1f}% {1} {2:.1f}%".format(
+        stats_off, ">=" if analyze else "<", thresholds["stats_off"]))
+    if needs_delete and needs_sort:
+        mode = "FULL"
+    elif needs_delete:
+        mode = "DELETE ONLY"
+    elif needs_sort:
+        mode = "SORT ONLY"
+    else:
+        mode = None
+    return mode, analyze, reasons
+
+def describe(mode, analyze):
+    actions = []
+    if mode:
+        actions.append("VACUUM " + mode)
+    if analyze:
+        actions.append("ANALYZE")
+    if not actions:
+        return "SKIPPING MAINTENANCE OF"
+    return " AND ".join(actions)
+
+def run_outside_transaction(db, statement):
+    # VACUUM refuses to run inside a transaction block.
+    with db.get_connection() as connection:
+        connection.autocommit = True
+        connection.cursor().execute(statement)
+
+def vacuum_statement(mode, table_name, redshift):
+    if not redshift:
+        mode = POSTGRES_VACUUM_MODES[mode]
+        if mode is None:
+            return None
+    return Q_VACUUM.format(mode=mode, table_name=table_name)
+
+def maintain(db, table_names, thresholds=THRESHOLDS):
+    """Vacuum and/or analyze each of table_names as its statistics require."""
+    if deferred is not None:
+        with deferred_lock:
+            for table_name in table_names:
+                if table_name not in deferred:
+                    deferred.append(table_name)
+        return
+    redshift = is_redshift(db)
+    for table_name in table_names:
+        info = get_table_info(db, table_name, redshift)
+        mode, analyze, reasons = plan(info, thresholds)
+        print describe(mode, analyze), table_name, "({reasons})".format(reasons=", ".join(reasons))
+        if mode:
+            statement = vacuum_statement(mode, table_name, redshift)
+            if statement:
+                run_outside_transaction(db, statement)
+        if analyze:
+            run_outside_transaction(db, Q_ANALYZE.format(table_name=table_name))
+
+def defer():
+    """Collect the tables passed to maintain from now on, instead of maintaining them."""
+    global deferred
+    deferred = []
+
+def maintain_deferred(db, thresholds=THRESHOLDS):
+    """Maintain every table collected since defer, and stop deferring."""
+    global deferred
+    with deferred_lock:
+        table_names, deferred = deferred or [], None
+    maintain(db, table_names, thresholds)
@@ -16,7 +16,7 @@ if [ ! -e "$FILE" ]; then
 fi
 
 # Ensure every line has the correct number of fields
-awk 'BEGIN {FS = OFS = ","} {$18 = $18; print}' "$FILE" > "$FIXED_FILE"
+python "$(dirname "$0")/sanitize_csv.py" --event-type none --fields 18 --pad "$FILE" "$FIXED_FILE"
 
 echo "Now sanity check the contents of $FIXED_FILE. If it looks ok, upload it with:"
 echo "  aws s3 cp $FIXED_FILE $REMOTE_FILE"
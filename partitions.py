@@ -0,0 +1,207 @@
+#
+# Optional monthly partitioning of the big tables.
+#
+# A partitioned table is a set of physical tables, one per month and
+# named {table}_pYYYYMM, behind a UNION ALL view with the table's own
+# name. Reads go through the view as before. Loads write to the month's
+# partition directly, and expiry drops whole months, so neither needs a
+# large DELETE or the VACUUM that follows it. Only the month the expiry
+# cutoff falls in is trimmed with a DELETE.
+#
+# A table that already exists when it is first partitioned is renamed to
+# {table}_p000000, the legacy partition, and kept behind the view until
+# expiry has emptied it.
+#
+# On Redshift the view is late-binding, so partitions can be dropped and
+# created underneath it.
+#
+
+from datetime import date, datetime, timedelta
+import re
+import threading
+
+import maintenance
+import sql
+
+LEGACY_MONTH = "000000"
+
+Q_GET_TABLES = """
+    SELECT tablename
+    FROM pg_tables
+    WHERE schemaname = current_schema()
+    AND tablename LIKE %(pattern)s;
+"""
+
+Q_GET_SCHEMA = "SELECT current_schema();"
+
+Q_RENAME_TABLE = """
+    ALTER TABLE {table} RENAME TO {partition};
+"""
+
+Q_CREATE_VIEW = """
+    CREATE OR REPLACE VIEW {table} AS
+    {selects}
+    {binding};
+"""
+
+Q_DROP_TABLE = """
+    DROP TABLE IF EXISTS {partition};
+"""
+
+Q_EXPIRE_ROWS = """
+    DELETE FROM {partition}
+    WHERE {day_column} < %(cutoff)s;
+"""
+
+Q_COUNT_ROWS = "SELECT COUNT(*) FROM {partition};"
+
+# Creating partitions and replacing views from several import workers at
+# once would race, so it happens one table at a time.
+lock = threading.Lock()
+
+def to_day(value):
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+def month_of(day):
+    return to_day(day)[:7].replace("-", "")
+
+def partition_name(table, day):
+    return "{table}_p{month}".format(table=table, month=month_of(day))
+
+def suffix(partitioned, day):
+    """Return what to append to a table's name to write day's rows, "" if not partitioned."""
+    if partitioned:
+        return "_p" + month_of(day)
+    return ""
+
+def month_bounds(month):
+    """Return the first and last days of a YYYYMM month."""
+    first = datetime.strptime(month, "%Y%m")
+    following = (first + timedelta(days=32)).replace(day=1)
+    return (first.strftime("%Y-%m-%d"),
+            (following - timedelta(days=1)).strftime("%Y-%m-%d"))
+
+def split_by_month(day_from, day_until):
+    """Split a range of days into (day_from, day_until) pairs within one month each."""
+    day_from, day_until = to_day(day_from), to_day(day_until)
+    ranges = []
+    while day_from <= day_until:
+        month_until = min(month_bounds(month_of(day_from))[1], day_until)
+        ranges.append((day_from, month_until))
+        day_from = (datetime.strptime(month_until, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    return ranges
+
+def get_tables(db, table):
+    """Return the names of the tables whose names start with table's."""
+    return db.all(sql.build(Q_GET_TABLES, {"pattern": table + "%"}))
+
+def get_partitions(db, table):
+    """Return the names of table's partitions, oldest first."""
+    pattern = re.compile("^" + re.escape(table) + r"_p\d{6}$")
+    return sorted(name for name in get_tables(db, table) if pattern.match(name))
+
+def tables(db, table, day_from, day_until):
+    """Return the partitions that can hold rows for day_from to day_until."""
+    month_from, month_until = month_of(day_from), month_of(day_until)
+    return [name for name in get_partitions(db, table)
+            if name[-6:] == LEGACY_MONTH or month_from <= name[-6:] <= month_until]
+
+def suffixes(db, table, partitioned, day_from=None, day_until=None):
+    """Return what to append to table's name to write to each of its partitions,
+    or to those that can hold day_from to day_until.
+
+    That's just "" if the table isn't partitioned.
+    """
+    if not partitioned:
+        return [""]
+    if day_from is None:
+        names = get_partitions(db, table)
+    else:
+        names = tables(db, table, day_from, day_until)
+    return [name[len(table):] for name in names]
+
+def is_partitioned(db, table):
+    return table not in get_tables(db, table)
+
+def refresh_view(db, table, partitions=None):
+    """Point table's view at partitions, by default all of its current ones."""
+    if partitions is None:
+        partitions = get_partitions(db, table)
+    schema = db.one(Q_GET_SCHEMA)
+    selects = "\n    UNION ALL\n    ".join(
+        "SELECT * FROM {schema}.{partition}".format(schema=schema, partition=partition)
+        for partition in partitions)
+    if maintenance.is_redshift(db):
+        binding = "WITH NO SCHEMA BINDING"
+    else:
+        binding = ""
+    db.run(Q_CREATE_VIEW.format(table=table, selects=selects, binding=binding))
+
+def migrate(db, table):
+    """Turn an ordinary table into the legacy partition of a partitioned one."""
+    with lock:
+        if is_partitioned(db, table):
+            return
+        print "PARTITIONING", table
+        db.run(Q_RENAME_TABLE.format(table=table,
+                                     partition="{table}_p{month}".format(table=table,
+                                                                         month=LEGACY_MONTH)))
+        refresh_view(db, table)
+
+def ensure_partition(db, table, create_query, day):
+    """Create the partition of table for day's month, if need be, and return its name.
+
+    create_query is the CREATE TABLE IF NOT EXISTS statement for table itself.
+    """
+    partition = partition_name(table, day)
+    with lock:
+        if partition not in get_partitions(db, table):
+            print "CREATING PARTITION", partition
+            db.run(create_query.replace(" " + table + " ", " " + partition + " ", 1))
+            refresh_view(db, table)
+    return partition
+
+def expire(db, table, day_column, cutoff):
+    """Remove rows from before cutoff, dropping whole partitions where possible.
+
+    Returns the partitions that were trimmed with a DELETE, which might
+    want maintenance.
+    """
+    cutoff = to_day(cutoff)
+    trimmed = []
+    with lock:
+        partitions = get_partitions(db, table)
+        dropped = []
+        for partition in partitions:
+            month = partition[-6:]
+            if month != LEGACY_MONTH:
+                first_day, last_day = month_bounds(month)
+                if last_day < cutoff:
+                    dropped.append(partition)
+                    continue
+                if first_day >= cutoff:
+                    continue
+            db.run(sql.build(Q_EXPIRE_ROWS, {"cutoff": sql.day(cutoff)},
+                             partition=partition, day_column=day_column))
+            trimmed.append(partition)
+            if month == LEGACY_MONTH and not db.one(Q_COUNT_ROWS.format(partition=partition)):
+                dropped.append(partition)
+                trimmed.remove(partition)
+        # The view needs at least one partition to select from, so the
+        # newest is kept and emptied instead.
+        if partitions and len(dropped) == len(partitions):
+            kept = dropped.pop()
+            if kept not in trimmed:
+                db.run(sql.build(Q_EXPIRE_ROWS, {"cutoff": sql.day(cutoff)},
+                                 partition=kept, day_column=day_column))
+                trimmed.append(kept)
+        if dropped:
+            print "DROPPING", len(dropped), "EXPIRED PARTITIONS OF", table
+            # Take the partitions out of the view before dropping them.
+            refresh_view(db, table, [partition for partition in partitions
+                                     if partition not in dropped])
+            for partition in dropped:
+                db.run(Q_DROP_TABLE.format(partition=partition))
+    return trimmed
@@ -0,0 +1,194 @@
+#
+# Query plans for --explain.
+#
+# With --explain, TracedCursor asks Redshift for the EXPLAIN plan of each
+# query before running it. The plans are summarized by stage, the same
+# way tracing totals their timings: the cost of the stage's statements,
+# the node types that account for most of it, the joins that redistribute
+# or broadcast rows (the DS_DIST_* and DS_BCAST_* markers) and any tables
+# Redshift says are missing statistics.
+#
+# Given the plans file of an earlier run as a baseline, compare flags the
+# stages whose cost grew by more than EXPLAIN_COST_THRESHOLD times or that
+# started broadcasting a table. Either is usually the first sign of stale
+# statistics or of a join that no longer lines up with the distribution
+# keys, and shows up here before it shows up in the timings.
+#
+
+from collections import OrderedDict
+import json
+import os
+import re
+
+def env_or_default(variable_name, default_value):
+    if variable_name in os.environ:
+        return os.environ[variable_name]
+
+    return default_value
+
+EXPLAIN_COST_THRESHOLD = float(env_or_default("EXPLAIN_COST_THRESHOLD", 2))
+
+# How many node types to list for each stage.
+TOP_NODE_TYPES = 5
+
+Q_EXPLAIN = "EXPLAIN {statement}"
+
+# The statements that Redshift will EXPLAIN.
+EXPLAINABLE = re.compile(r"\s*(?:SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+# Catalog queries run on the leader node and have no plan worth keeping.
+SYSTEM_TABLES = re.compile(r"\b(?:pg|svv|stv|stl|svl)_\w+", re.IGNORECASE)
+
+# A node of a plan, e.g.
+# "  ->  XN Hash Join DS_BCAST_INNER  (cost=0.00..12.50 rows=100 width=8)".
+PLAN_NODE = re.compile(r"^(?P<indent>\s*)(?:->\s+)?(?:XN\s+|LD\s+)?(?P<description>.+?)\s+"
+                       r"\(cost=[\d.]+\.\.(?P<cost>[\d.]+) rows=\d+ width=\d+\)")
+
+NODE_TYPE = re.compile(r"[A-Z]\w*(?: (?!DS_)[A-Z]\w*)*")
+
+SCANNED_TABLE = re.compile(r"\bon (\w[\w.]*)")
+
+REDISTRIBUTION = re.compile(r"\bDS_(?:DIST|BCAST)_\w+")
+
+MISSING_STATISTICS = re.compile(r"Tables missing statistics: ([\w., ]+?)\s*-*\s*$")
+
+def is_explainable(sql):
+    # EXPLAIN takes a single statement.
+    return (EXPLAINABLE.match(sql) is not None and ";" not in sql.strip().rstrip(";")
+            and SYSTEM_TABLES.search(sql) is None)
+
+def parse(lines):
+    """Parse the lines of a plan into a tree of nodes, returning the root
+    and the tables missing statistics.
+    """
+    root = None
+    stack = []
+    missing_statistics = []
+    for line in lines:
+        match = PLAN_NODE.match(line)
+        if match is None:
+            missing = MISSING_STATISTICS.search(line)
+            if missing:
+                missing_statistics.extend(table.strip() for table in missing.group(1).split(","))
+            continue
+        description = match.group("description")
+        node_type = NODE_TYPE.match(description)
+        table = SCANNED_TABLE.search(description)
+        node = {
+            "indent": len(match.group("indent")),
+            "type": node_type.group(0) if node_type else description,
+            "table": table.group(1) if table else None,
+            "markers": REDISTRIBUTION.findall(description),
+            "cost": float(match.group("cost")),
+            "children": [],
+        }
+        while stack and stack[-1]["indent"] >= node["indent"]:
+            stack.pop()
+        if stack:
+            stack[-1]["children"].append(node)
+        elif root is None:
+            root = node
+        stack.append(node)
+    return root, missing_statistics
+
+def scanned_tables(node):
+    tables = [node["table"]] if node["table"] else []
+    for child in node["children"]:
+        tables.extend(scanned_tables(child))
+    return tables
+
+def walk(node):
+    yield node
+    for child in node["children"]:
+        for descendant in walk(child):
+            yield descendant
+
+def summarize(lines):
+    """Return the cost of a plan, the cost of each node type in it, its
+    redistribution markers and the tables it broadcasts or is missing
+    statistics for.
+    """
+    root, missing_statistics = parse(lines)
+    summary = {"cost": 0.0, "node_types": {}, "redistribution": [], "broadcast": [],
+               "missing_statistics": sorted(set(missing_statistics))}
+    if root is None:
+        return summary
+    summary["cost"] = root["cost"]
+    for node in walk(root):
+        # Costs include the node's children, so take those off to find
+        # what the node itself adds.
+        own_cost = max(node["cost"] - sum(child["cost"] for child in node["children"]), 0.0)
+        summary["node_types"][node["type"]] = summary["node_types"].get(node["type"], 0.0) + own_cost
+        summary["redistribution"].extend(node["markers"])
+        if "DS_BCAST_INNER" in node["markers"] and node["children"]:
+            summary["broadcast"].extend(scanned_tables(node["children"][-1]))
+    summary["redistribution"] = sorted(set(summary["redistribution"]))
+    summary["broadcast"] = sorted(set(summary["broadcast"]))
+    return summary
+
+def stage_plans(explained):
+    """Return the plans of each stage of explained statements, most expensive first.
+
+    A statement that ran more than once in a stage, for several days or
+    ranges, is represented by its most expensive plan.
+    """
+    stages = OrderedDict()
+    for statement in explained:
+        key = (statement.get("event_type", ""), statement.get("stage", statement["statement"]))
+        stage = stages.setdefault(key, OrderedDict([("event_type", key[0]), ("stage", key[1]),
+                                                    ("statements", OrderedDict())]))
+        summary = dict(summarize(statement["plan"]), statement=statement["statement"],
+                       plan=statement["plan"], runs=1)
+        previous = stage["statements"].get(statement["statement"])
+        if previous is not None:
+            summary["runs"] += previous["runs"]
+            if previous["cost"] >= summary["cost"]:
+                summary = dict(previous, runs=summary["runs"])
+        stage["statements"][statement["statement"]] = summary
+
+    for stage in stages.values():
+        statements = stage.pop("statements").values()
+        node_types = {}
+        for statement in statements:
+            for node_type, cost in statement["node_types"].items():
+                node_types[node_type] = node_types.get(node_type, 0.0) + cost
+        stage["cost"] = sum(statement["cost"] for statement in statements)
+        stage["node_types"] = sorted(node_types.items(), key=lambda node_type: -node_type[1])[:TOP_NODE_TYPES]
+        for field in ("redistribution", "broadcast", "missing_statistics"):
+            stage[field] = sorted(set(value for statement in statements for value in statement[field]))
+        stage["statements"] = [OrderedDict([("statement", statement["statement"]),
+                                            ("runs", statement["runs"]),
+                                            ("cost", statement["cost"]),
+                                            ("plan", statement["plan"])])
+                               for statement in statements]
+    return sorted(stages.values(), key=lambda stage: -stage["cost"])
+
+def load(filename):
+    """Return the stages of a plans file written by an earlier run."""
+    with open(filename) as plans_file:
+        return json.load(plans_file)["stages"]
+
+def compare(stages, baseline, threshold=EXPLAIN_COST_THRESHOLD):
+    """Return the stages whose plans got worse since baseline, with what changed.
+
+    Stages that aren't in baseline have nothing to compare with and are
+    left out.
+    """
+    previous = dict(((stage["event_type"], stage["stage"]), stage) for stage in baseline)
+    regressions = []
+    for stage in stages:
+        before = previous.get((stage["event_type"], stage["stage"]))
+        if before is None:
+            continue
+        changes = []
+        if stage["cost"] > max(before["cost"], 1.0) * threshold:
+            changes.append("cost went from {0:.0f} to {1:.0f}".format(before["cost"], stage["cost"]))
+        for table in sorted(set(stage["broadcast"]) - set(before["broadcast"])):
+            changes.append("started broadcasting " + table)
+        for table in sorted(set(stage["missing_statistics"]) - set(before["missing_statistics"])):
+            changes.append("statistics missing for " + table)
+        if changes:
+            regressions.append(OrderedDict([("event_type", stage["event_type"]),
+                                            ("stage", stage["stage"]),
+                                            ("changes", changes)]))
+    return regressions
@@ -0,0 +1,218 @@
+#
+# Pre-load stage that reshapes a day's CSV so Redshift can COPY it in parallel.
+#
+# Redshift only spreads a COPY across its slices when the input is
+# split into several files, so we stream the day's file into N slices,
+# ideally one per slice in the cluster. Each slice is either gzip or
+# zstd compressed CSV, or typed Parquet with dictionary encoding for the
+# low-cardinality columns. The slices are uploaded to a staging prefix
+# and listed in a manifest that COPY loads from.
+#
+# Everything here works on plain file-like objects and boto buckets, so
+# it can be exercised against local files and an S3 stand-in.
+#
+
+import csv
+import gzip
+import os
+
+FORMATS = ("csv", "gzip", "zstd", "parquet")
+
+EXTENSIONS = {
+    "csv": ".csv",
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+    "parquet": ".parquet",
+}
+
+# How many bad lines a day's slices can have before loading them fails.
+MAXERROR = 100
+
+# The options COPY needs to read each format, following the MANIFEST keyword.
+# COPY from Parquet can neither truncate values nor skip bad rows, so the
+# Parquet slices are truncated and checked as they're written instead.
+COPY_OPTIONS = {
+    "csv": "FORMAT AS CSV MAXERROR AS {0} TRUNCATECOLUMNS".format(MAXERROR),
+    "gzip": "FORMAT AS CSV GZIP MAXERROR AS {0} TRUNCATECOLUMNS".format(MAXERROR),
+    "zstd": "FORMAT AS CSV ZSTD MAXERROR AS {0} TRUNCATECOLUMNS".format(MAXERROR),
+    "parquet": "FORMAT AS PARQUET",
+}
+
+# Columns with few distinct values, which Parquet should dictionary-encode.
+DICTIONARY_COLUMNS = (
+    "type",
+    "ua_browser",
+    "ua_version",
+    "ua_os",
+    "service",
+    "context",
+    "entrypoint",
+    "locale",
+)
+
+# How many rows to buffer per slice before writing a Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 100000
+
+Q_GET_SLICE_COUNT = "SELECT COUNT(*) FROM stv_slices;"
+
+def get_slice_count(db):
+    return db.one(Q_GET_SLICE_COUNT)
+
+def truncate(value, width):
+    """Cut a UTF-8 value down to width bytes, as TRUNCATECOLUMNS does,
+    without leaving part of a character at the end.
+    """
+    if len(value) <= width:
+        return value
+    return value[:width].decode("utf8", "ignore").encode("utf8")
+
+class CompressedSlice(object):
+    """One output file of compressed or plain CSV."""
+
+    # COPY rejects bad lines from these itself.
+    rejected = 0
+
+    def __init__(self, path, file_format):
+        self.path = path
+        if file_format == "gzip":
+            self.file = gzip.open(path, "wb")
+        elif file_format == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd slices need the zstandard package")
+            self.raw = open(path, "wb")
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.file = open(path, "wb")
+
+    def write(self, line):
+        self.file.write(line + "\n")
+
+    def close(self):
+        self.file.close()
+        if hasattr(self, "raw"):
+            self.raw.close()
+
+class ParquetSlice(object):
+    """One output file of typed Parquet, written a row group at a time.
+
+    Values are truncated to the widths of their columns, and lines that
+    COPY would reject from a CSV file, those with the wrong number of
+    fields or a non-integer in an integer column, are left out and counted
+    as rejected.
+    """
+
+    def __init__(self, path, columns, integer_columns, widths=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("parquet slices need the pyarrow package")
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = columns
+        self.integer_columns = integer_columns
+        self.widths = widths or {}
+        self.rejected = 0
+        self.types = dict((column, pyarrow.int64() if column in integer_columns else pyarrow.string())
+                          for column in columns)
+        self.schema = pyarrow.schema([(column, self.types[column]) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema,
+            use_dictionary=[column for column in columns if column in DICTIONARY_COLUMNS],
+            compression="snappy")
+        self.rows = []
+
+    def write(self, line):
+        row = self.parse(line)
+        if row is None:
+            self.rejected += 1
+            return
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def parse(self, line):
+        """Return line's typed values, or None if COPY would reject it."""
+        values = next(csv.reader([line]), [])
+        if len(values) != len(self.columns):
+            return None
+        row = []
+        for column, value in zip(self.columns, values):
+            if column in self.integer_columns:
+                try:
+                    value = int(value) if value else None
+                except ValueError:
+                    return None
+            elif column in self.widths:
+                value = truncate(value, self.widths[column])
+            row.append(value)
+        return row
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = []
+        for index, column in enumerate(self.columns):
+            values = [row[index] for row in self.rows]
+            arrays.append(self.pyarrow.array(values, type=self.types[column]))
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def split(lines, directory, name, slices, file_format, columns=None, integer_columns=(), widths=None):
+    """Write lines round-robin into slices files under directory.
+
+    Returns the local paths of the files that were written. columns,
+    integer_columns and widths, a dict of the VARCHAR columns' widths, are
+    only needed for Parquet. Fails if more than MAXERROR lines were left
+    out, as COPY would.
+    """
+    if file_format not in FORMATS:
+        raise ValueError("unknown preload format {0}".format(file_format))
+    outputs = []
+    for index in range(max(slices, 1)):
+        path = os.path.join(directory, "{name}.{index:04d}{extension}".format(
+            name=name, index=index, extension=EXTENSIONS[file_format]))
+        if file_format == "parquet":
+            outputs.append(ParquetSlice(path, columns, integer_columns, widths))
+        else:
+            outputs.append(CompressedSlice(path, file_format))
+    try:
+        for index, line in enumerate(lines):
+            outputs[index % len(outputs)].write(line)
+    finally:
+        for output in outputs:
+            output.close()
+    rejected = sum(output.rejected for output in outputs)
+    if rejected:
+        print "  REJECTED", rejected, "LINES"
+    if rejected > MAXERROR:
+        raise ValueError("{0} lines of {1} couldn't be loaded, more than the {2} allowed".format(
+            rejected, name, MAXERROR))
+    return [output.path for output in outputs]
+
+def upload(bucket, paths, prefix):
+    """Upload local files under prefix, returning their manifest entries."""
+    entries = []
+    for path in paths:
+        key = bucket.new_key(prefix + os.path.basename(path))
+        key.set_contents_from_filename(path)
+        entries.append({
+            "url": "s3://{bucket}/{key}".format(bucket=bucket.name, key=key.name),
+            "mandatory": True,
+            # Required by COPY for columnar formats, harmless for the rest.
+            "meta": {"content_length": os.path.getsize(path)},
+        })
+    return entries
+
+def manifest(entries):
+    return {"entries": entries}
+
+def key_names(entries):
+    """Return the S3 key names of a manifest's entries, for cleaning up."""
+    return [entry["url"].split("/", 3)[3] for entry in entries]
@@ -0,0 +1,124 @@
+#
+# Run every import script and the daily summary in one process.
+#
+# The scripts run as a graph of steps rather than one after another:
+# the daily summary waits for the activity import, which is all it reads,
+# while the flow, email and counts imports run alongside them. They share
+# one connection pool, one S3 bucket and one listing of each prefix, and
+# their VACUUM and ANALYZE is left until everything has finished, so each
+# table is maintained once.
+#
+# Takes the same options as the import scripts, which apply to each of
+# them, plus --concurrency for how many steps run at a time.
+#
+
+import threading
+import traceback
+
+import boto.s3
+
+import backends
+import calculate_daily_summary
+import import_activity_events
+import import_counts
+import import_email_events
+import import_events
+import import_flow_events
+import journal
+import load_ledger
+import maintenance
+import s3_listing
+import tracing
+
+def run_steps(steps, concurrency):
+    """Run each step once its dependencies have, up to concurrency at a time.
+
+    steps is a sequence of (name, dependencies, function), in the order to
+    start them in when several are ready. A step whose dependency fails is
+    skipped. Returns the names of the steps that failed or were skipped.
+    """
+    condition = threading.Condition()
+    pending = list(steps)
+    running = set()
+    finished = set()
+    failed = []
+
+    def run_step(name, function):
+        try:
+            function()
+        except Exception:
+            traceback.print_exc()
+            print "FAILED", name
+            outcome = failed.append
+        else:
+            print "FINISHED", name
+            outcome = finished.add
+        with condition:
+            running.remove(name)
+            outcome(name)
+            condition.notify()
+
+    with condition:
+        while pending or running:
+            for step in list(pending):
+                name, dependencies, function = step
+                if set(dependencies).intersection(failed):
+                    print "SKIPPING", name, "AFTER", ", ".join(set(dependencies).intersection(failed))
+                    pending.remove(step)
+                    failed.append(name)
+                elif finished.issuperset(dependencies) and len(running) < concurrency:
+                    print "STARTING", name
+                    pending.remove(step)
+                    running.add(name)
+                    threading.Thread(target=run_step, args=(name, function)).start()
+            if not running:
+                if pending:
+                    raise ValueError("steps with unknown dependencies: " +
+                                     ", ".join(name for name, dependencies, function in pending))
+                break
+            condition.wait()
+    return failed
+
+def run(concurrency=2, engine="sql", force_reload=False, trace_report=None, trace_textfile=None,
+        explain=None, explain_baseline=None, backend="redshift", export_directory=None, export_from=None,
+        **options):
+    tracing.explain_statements(explain)
+    s3 = boto.s3.connect_to_region("us-west-2").get_bucket(import_events.S3_BUCKET)
+    # One connection per worker, plus one for the rest of each step that runs at once.
+    db = backends.connect(backend, import_events.DB_URI, s3,
+                          maxconn=(max(options["jobs"], 1) + 1) * concurrency)
+    s3_listing.list_prefixes(s3, [import_activity_events.S3_PREFIX,
+                                  import_flow_events.S3_PREFIX,
+                                  import_email_events.S3_PREFIX,
+                                  import_counts.S3_PREFIX],
+                             options.pop("refresh_listing"))
+    # Every step creates the tables they share if need be, which would
+    # race if they did it at the same time.
+    journal.create_table(db)
+    load_ledger.create_table(db)
+    maintenance.defer()
+    exports = {"export_directory": export_directory, "export_from": export_from}
+    options.update(exports, db=db, s3=s3)
+    steps = (
+        ("activity", (), lambda: import_activity_events.run(**options)),
+        ("daily_summary", ("activity",),
+         lambda: calculate_daily_summary.summarize_events(options["partitioned"], db=db, **exports)),
+        ("flow", (), lambda: import_flow_events.run(engine=engine, **options)),
+        ("email", (), lambda: import_email_events.run(**options)),
+        ("counts", (), lambda: import_counts.import_events(force_reload, db=db, s3=s3, **exports)),
+    )
+    failed = run_steps(steps, concurrency)
+    maintenance.maintain_deferred(db)
+    tracing.write_report(trace_report, trace_textfile, explain, explain_baseline)
+    if failed:
+        raise RuntimeError("failed steps: " + ", ".join(failed))
+
+def add_arguments(parser):
+    import_flow_events.add_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=2,
+                        help="number of steps to run at the same time")
+    parser.add_argument("--force-reload", action="store_true",
+                        help="reload every day of the counts, whatever the load ledger says")
+
+if __name__ == "__main__":
+    run(**import_events.command_line_options(add_arguments))
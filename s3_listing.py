@@ -0,0 +1,148 @@
+#
+# Incremental S3 listing shared by the import scripts.
+#
+# Each prefix's listing (key, day, ETag, size and last-modified time) is
+# cached in a local JSON file. The next listing resumes after the last
+# key that is older than LISTING_LOOKBACK_DAYS before the newest day we
+# know about, so only recent keys are listed again. Re-uploads within
+# that window are still noticed. So that older re-uploads are noticed
+# too, the whole prefix is listed again once the last full listing is
+# LISTING_REFRESH_DAYS old; pass refresh=True to list everything now.
+#
+# Run this module directly to refresh the listings of every import
+# script's prefix at once.
+#
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from os import path
+import json
+import os
+import re
+
+def env_or_default(variable_name, default_value):
+    if variable_name in os.environ:
+        return os.environ[variable_name]
+
+    return default_value
+
+LISTING_CACHE_DIR = env_or_default("LISTING_CACHE_DIR",
+                                   path.join(path.expanduser("~"), ".cache", "fxa-activity-metrics"))
+
+LISTING_LOOKBACK_DAYS = int(env_or_default("LISTING_LOOKBACK_DAYS", 7))
+LISTING_REFRESH_DAYS = float(env_or_default("LISTING_REFRESH_DAYS", 7))
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Listings made by this process, by bucket and prefix, so that scripts
+# run together by run_pipeline list each prefix once between them.
+listings = {}
+
+Entry = namedtuple("Entry", ("name", "day", "etag", "size", "last_modified"))
+
+def day_of(key_name):
+    """Parse the day out of a key like "fxa-flow/data/flow-2017-06-01.csv"."""
+    filename = path.basename(key_name)
+    # Ignore the last four characters (".csv") then join the last
+    # three parts ("YYYY-MM-DD") of the hyphen-split string.
+    return "-".join(filename[:-4].split("-")[-3:])
+
+def entry_of(key):
+    # boto returns ETags wrapped in double quotes.
+    return Entry(key.name, day_of(key.name), key.etag.strip('"'), key.size, key.last_modified)
+
+def cache_path(bucket_name, prefix):
+    return path.join(LISTING_CACHE_DIR,
+                     re.sub(r"[^\w.-]", "_", bucket_name + "-" + prefix) + ".json")
+
+def load_cache(bucket_name, prefix):
+    """Return the cached entries and when they were last all listed, or
+    no entries and None if nothing is cached.
+    """
+    try:
+        with open(cache_path(bucket_name, prefix)) as cache:
+            cached = json.load(cache)
+    except (IOError, ValueError):
+        return [], None
+    return [Entry(*entry) for entry in cached["entries"]], cached["refreshed_at"]
+
+def save_cache(bucket_name, prefix, entries, refreshed_at):
+    if not path.isdir(LISTING_CACHE_DIR):
+        os.makedirs(LISTING_CACHE_DIR)
+    filename = cache_path(bucket_name, prefix)
+    with open(filename + ".tmp", "w") as cache:
+        json.dump({"refreshed_at": refreshed_at, "entries": [list(entry) for entry in entries]}, cache)
+    os.rename(filename + ".tmp", filename)
+
+def is_due(refreshed_at, refresh_days):
+    """Return whether a listing last refreshed at refreshed_at should be refreshed now."""
+    if refreshed_at is None:
+        return True
+    age = datetime.utcnow() - datetime.strptime(refreshed_at, TIMESTAMP_FORMAT)
+    return age >= timedelta(days=refresh_days)
+
+def get_marker(entries, lookback_days):
+    """Return the key to resume listing after, or "" to list everything."""
+    if not entries:
+        return ""
+    newest = datetime.strptime(max(entry.day for entry in entries), "%Y-%m-%d")
+    resume_from = datetime.strftime(newest - timedelta(days=lookback_days), "%Y-%m-%d")
+    older = [entry.name for entry in entries if entry.day < resume_from]
+    if not older:
+        return ""
+    return max(older)
+
+def list_prefix(bucket, prefix, refresh=False, lookback_days=LISTING_LOOKBACK_DAYS,
+                refresh_days=LISTING_REFRESH_DAYS):
+    """Return the Entry for every key under prefix, sorted by key."""
+    if not refresh and (bucket.name, prefix) in listings:
+        return listings[(bucket.name, prefix)]
+    cached, refreshed_at = load_cache(bucket.name, prefix)
+    if refresh or is_due(refreshed_at, refresh_days):
+        cached = []
+    marker = get_marker(cached, lookback_days)
+    if not marker:
+        refreshed_at = datetime.strftime(datetime.utcnow(), TIMESTAMP_FORMAT)
+    entries = [entry for entry in cached if entry.name <= marker]
+    listed = [entry_of(key) for key in bucket.list(prefix=prefix, marker=marker)]
+    print "LISTED", len(listed), "KEYS UNDER", prefix, "AFTER", marker or "THE START"
+    entries.extend(listed)
+    entries.sort()
+    save_cache(bucket.name, prefix, entries, refreshed_at)
+    listings[(bucket.name, prefix)] = entries
+    return entries
+
+def list_prefixes(bucket, prefixes, refresh=False):
+    """List several prefixes at once, returning a dict of prefix -> entries."""
+    pool = ThreadPool(len(prefixes))
+    try:
+        results = pool.map(lambda prefix: list_prefix(bucket, prefix, refresh), prefixes)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(prefixes, results))
+
+def open_entry(bucket, entry):
+    """Return a readable boto key for entry."""
+    return bucket.new_key(entry.name)
+
+if __name__ == "__main__":
+    import argparse
+    import boto.s3
+    import import_activity_events
+    import import_counts
+    import import_email_events
+    import import_events
+    import import_flow_events
+
+    parser = argparse.ArgumentParser(description="Refresh the cached S3 listings")
+    parser.add_argument("--refresh", action="store_true",
+                        help="list every key again instead of resuming")
+    args = parser.parse_args()
+    list_prefixes(boto.s3.connect_to_region("us-west-2").get_bucket(import_events.S3_BUCKET),
+                  [import_activity_events.S3_PREFIX,
+                   import_flow_events.S3_PREFIX,
+                   import_email_events.S3_PREFIX,
+                   import_counts.S3_PREFIX],
+                  args.refresh)
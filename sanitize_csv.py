@@ -0,0 +1,172 @@
+#
+# Streaming sanitizer for the CSV files we import from S3.
+#
+# Reads its input once, in chunks, and splits it into clean lines and
+# rejected lines. A line is rejected if it matches any of the rules for
+# its event type or if it has the wrong number of fields. Short lines
+# can optionally be padded with empty fields first, and long lines let
+# through. The importers can
+# run this before COPY (see import_events.run's sanitize option), or it
+# can be run by hand:
+#
+#   python sanitize_csv.py --event-type flow flow-2017-06-01.csv flow-2017-06-01.csv.fixed
+#
+
+from collections import Counter
+import argparse
+import re
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# Each rule is (name, pattern, ignore_case). Lines that look like
+# injection attempts are rejected outright.
+INJECTION_RULES = (
+    ("double_quote", '"', False),
+    ("single_quote", "'", False),
+    ("backtick", "`", False),
+    ("semicolon", ";", False),
+    ("greater_than", ">", False),
+    ("less_than", "<", False),
+    ("backslash", r"\\", False),
+    ("dot_slash", r"\./", False),
+    ("select", "select ", True),
+    ("declare", "declare ", True),
+    ("burpcollab", "burpcollab", False),
+    ("nslookup", "nslookup", False),
+    ("file", "file:", False),
+)
+
+RULES = {
+    "flow": INJECTION_RULES,
+    "none": (),
+}
+
+FIELD_COUNT_RULE = "field_count"
+
+def get_rules(event_type):
+    return RULES.get(event_type, ())
+
+def ignore_case(pattern):
+    # Python 2 has no scoped (?i:...) groups, so spell out each letter.
+    return "".join("[{0}{1}]".format(c.lower(), c.upper()) if c.isalpha() else c
+                   for c in pattern)
+
+def compile_rules(rules):
+    """Combine rules into a single regex with one named group per rule."""
+    if not rules:
+        return None
+    alternatives = []
+    for name, pattern, case_insensitive in rules:
+        if case_insensitive:
+            pattern = ignore_case(pattern)
+        alternatives.append("(?P<{name}>{pattern})".format(name=name, pattern=pattern))
+    return re.compile("|".join(alternatives))
+
+def read_lines(stream, chunk_size=CHUNK_SIZE):
+    """Yield the lines of a file-like object, without line terminators."""
+    remainder = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    if remainder:
+        yield remainder
+
+def check_line(line, regex, fields, pad, keep_long=False):
+    """Return (line, rule), where rule names the reason for rejection or is None."""
+    if regex is not None:
+        match = regex.search(line)
+        if match:
+            return line, match.lastgroup
+    if fields:
+        separators = line.count(",")
+        if pad and separators < fields - 1:
+            line += "," * (fields - 1 - separators)
+            separators = fields - 1
+        if separators < fields - 1 or (separators > fields - 1 and not keep_long):
+            return line, FIELD_COUNT_RULE
+    return line, None
+
+def clean_lines(lines, rules, fields, pad=False, counts=None, rejects=None, keep_long=False):
+    """Yield the lines that pass every rule.
+
+    Lines are counted per rule in counts, if given, with clean lines
+    counted as "clean". Rejected lines are written to rejects, prefixed
+    with the name of the rule, if that is given.
+    """
+    regex = compile_rules(rules)
+    for line in lines:
+        line, rule = check_line(line, regex, fields, pad, keep_long)
+        if rule is None:
+            if counts is not None:
+                counts["clean"] += 1
+            yield line
+            continue
+        if counts is not None:
+            counts[rule] += 1
+        if rejects is not None:
+            rejects.write(rule + "\t" + line + "\n")
+
+def sanitize(source, clean, rejects, rules, fields, pad=False, keep_long=False):
+    """Copy the clean lines of source to clean and the rest to rejects.
+
+    Returns a Counter of rejected lines per rule, plus a "clean" count.
+    """
+    counts = Counter()
+    for line in clean_lines(read_lines(source), rules, fields, pad, counts, rejects, keep_long):
+        clean.write(line + "\n")
+    return counts
+
+def sanitize_key(key, bucket, staged_name, rules, fields, pad=False):
+    """Sanitize an S3 object into a new object, staged_name, in bucket.
+
+    Rejected lines, if there are any, go to staged_name + ".rejects".
+    """
+    with tempfile.TemporaryFile() as clean, tempfile.TemporaryFile() as rejects:
+        counts = sanitize(key, clean, rejects, rules, fields, pad)
+        clean.seek(0)
+        bucket.new_key(staged_name).set_contents_from_file(clean)
+        upload_rejects(bucket, rejects, staged_name)
+    key.close()
+    return counts
+
+def upload_rejects(bucket, rejects, staged_name):
+    """Upload the rejects file, if anything was written to it, next to staged_name."""
+    if rejects.tell():
+        rejects.seek(0)
+        bucket.new_key(staged_name + ".rejects").set_contents_from_file(rejects)
+
+def print_counts(counts):
+    print "  {clean} CLEAN LINES".format(clean=counts["clean"])
+    for rule, count in sorted(counts.items()):
+        if rule != "clean":
+            print "  {count} REJECTED BY {rule}".format(count=count, rule=rule)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sanitize an event CSV file")
+    parser.add_argument("--event-type", default="flow",
+                        help="which rule set to apply ({rules})".format(rules=", ".join(sorted(RULES))))
+    parser.add_argument("--fields", type=int, default=18,
+                        help="expected number of fields, or 0 to skip the check")
+    parser.add_argument("--pad", action="store_true",
+                        help="pad short lines with empty fields and leave long lines alone")
+    parser.add_argument("--rejects", help="file to write rejected lines to")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    args = parser.parse_args()
+    rejects_path = args.rejects or args.output + ".rejects"
+    with open(args.input, "rb") as source, open(args.output, "wb") as clean, \
+            open(rejects_path, "wb") as rejects:
+        # Unlike the importers, whose COPY can't load them, a file fixed
+        # up by hand keeps its long lines.
+        counts = sanitize(source, clean, rejects, get_rules(args.event_type),
+                          args.fields, args.pad, keep_long=args.pad)
+    print_counts(counts)
+
+if __name__ == "__main__":
+    main()
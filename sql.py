@@ -0,0 +1,77 @@
+#
+# Query building shared by the scripts.
+#
+# A query is a template with two kinds of placeholder. {name} stands for
+# a table name, column list or other piece of SQL and is filled in by
+# prepare, which caches the text it returns. Each template is formatted
+# once for each event type and sample suffix, however many days and rates
+# a run goes through. %(name)s stands for a value and is filled in by
+# bind, which has psycopg2 quote it, so values are never pasted into
+# statements as they are. As with psycopg2, a literal % in a template is
+# written %%.
+#
+# Days are filtered with day_range, which compares the column itself
+# with a half-open range. Casting the column to DATE instead would stop
+# Redshift from using the zone maps of a sort key, so every block of the
+# table would be scanned.
+#
+
+from datetime import date, datetime, timedelta
+import threading
+
+import psycopg2.extensions
+
+statements = {}
+statements_lock = threading.Lock()
+
+def prepare(template, **fragments):
+    """Fill in template's {placeholders}, leaving its %(values)s for bind."""
+    key = (template, tuple(sorted(fragments.items())))
+    with statements_lock:
+        statement = statements.get(key)
+        if statement is None:
+            statement = statements[key] = template.format(**fragments)
+    return statement
+
+def day(value):
+    """Return a YYYY-MM-DD string, date or datetime as a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+def literal(value):
+    """Quote value for use in a statement, as psycopg2 does when binding it.
+
+    Strings are escaped by libpq, which follows whether the server that
+    was last connected to treats backslashes as escapes, as Redshift does.
+    """
+    quoted = psycopg2.extensions.adapt(value)
+    if hasattr(quoted, "encoding"):
+        # Without a connection to ask, psycopg2 would encode as Latin-1.
+        quoted.encoding = "utf8"
+    return quoted.getquoted()
+
+def bind(statement, **values):
+    """Fill in a prepared statement's %(values)s."""
+    return statement % dict((name, literal(value)) for name, value in values.items())
+
+def build(template, values=None, **fragments):
+    """Prepare template with fragments and bind values to it, in one go."""
+    return bind(prepare(template, **fragments), **(values or {}))
+
+def day_range(column, day_from="day_from", day_until="day_until"):
+    """Return a condition on column for the days from day_from until day_until, inclusive.
+
+    day_from and day_until name the values to bind, which should be dates.
+    """
+    return "{column} >= %({day_from})s AND {column} < %({day_until})s + 1".format(
+        column=column, day_from=day_from, day_until=day_until)
+
+def days(day_from, day_until):
+    """Return the values to bind for a day_range."""
+    return {"day_from": day(day_from), "day_until": day(day_until)}
+
+def next_day(value):
+    return day(value) + timedelta(days=1)
@@ -0,0 +1,256 @@
+#
+# Generate synthetic event files to load instead of production data.
+#
+# Writes a day's worth of activity, flow and email events, plus the daily
+# account counts, for each of a run of days. The files are laid out and
+# named like the keys under the production S3 prefixes, so a directory
+# of them can be uploaded to a bucket as-is, and their columns come from
+# the import scripts themselves, so they always match what COPY expects.
+#
+# The numbers are random but shaped like the real thing: every user has a
+# few devices, flows can start late and finish the next day, some flows
+# are continuations of earlier ones and some users are in experiments.
+#
+
+from datetime import datetime, timedelta
+from os import path
+import argparse
+import csv
+import os
+import random
+
+EVENTS_PER_FLOW = 6
+USERS_PER_ROW = 0.1
+
+ACTIVITY_TYPES = ("account.signed", "account.keyfetch", "account.login", "device.created",
+                  "sync.complete", "account.reset")
+FLOW_STEPS = ("flow.signin.view", "flow.signin.engage", "flow.signin.submit", "flow.have-account",
+              "flow.signup.view", "flow.signup.engage", "flow.signup.submit")
+EMAIL_TYPES = ("sent", "delivered", "delivered", "delivered", "bounced", "complaint")
+EXPERIMENTS = (("mailcheck", ("control", "treatment")),
+               ("syncCheckbox", ("control", "treatment", "treatment-b")))
+
+BROWSERS = (("Firefox", ("55", "56", "57")), ("Chrome", ("61", "62")),
+            ("Safari", ("10", "11")), ("Mobile Safari", ("11",)))
+OPERATING_SYSTEMS = ("Windows 10", "Windows 7", "Mac OS X", "Linux", "Android", "iOS")
+SERVICES = ("sync", "", "amo", "pocket", "notes")
+CONTEXTS = ("fx_desktop_v3", "fx_fennec_v1", "fx_ios_v1", "web", "")
+ENTRYPOINTS = ("menupanel", "preferences", "synced-tabs", "")
+LOCALES = ("en-US", "en-US", "en-US", "de", "fr", "es-ES", "pt-BR", "ru")
+DOMAINS = ("gmail.com", "yahoo.com", "hotmail.com", "other")
+TEMPLATES = ("verifyEmail", "verifyLoginEmail", "recoveryEmail", "newDeviceLoginEmail")
+
+def hex_id(rng, length):
+    return "".join(rng.choice("0123456789abcdef") for _ in range(length))
+
+def event_columns():
+    """Return the columns of each event type's files, after the timestamp, in order."""
+    import import_activity_events
+    import import_email_events
+    import import_flow_events
+    return {
+        "activity": import_activity_events.COLUMNS,
+        "flow": import_flow_events.TEMPORARY_COLUMNS,
+        "email": import_email_events.COLUMNS,
+    }
+
+def file_names(day):
+    """Return the path of each event type's file for day, relative to the output directory."""
+    import import_activity_events
+    import import_counts
+    import import_email_events
+    import import_flow_events
+    return {
+        "activity": import_activity_events.S3_PREFIX + "-" + day + ".csv",
+        "flow": import_flow_events.S3_PREFIX + "-" + day + ".csv",
+        "email": import_email_events.S3_PREFIX + "-" + day + ".csv",
+        "counts": import_counts.S3_URI.format(day=day)[len("s3://" + import_counts.S3_BUCKET + "/"):],
+    }
+
+class User(object):
+    def __init__(self, rng):
+        self.uid = hex_id(rng, 32)
+        self.locale = rng.choice(LOCALES)
+        self.devices = []
+        for _ in range(rng.choice((1, 1, 1, 2, 2, 3))):
+            browser, versions = rng.choice(BROWSERS)
+            self.devices.append({
+                "device_id": hex_id(rng, 32),
+                "ua_browser": browser,
+                "ua_version": rng.choice(versions),
+                "ua_os": rng.choice(OPERATING_SYSTEMS),
+            })
+        self.experiment = None
+        self.flows = []
+
+class Generator(object):
+    """Generates the events of a population of users, a day at a time."""
+
+    def __init__(self, rows_per_day, flows_per_uid=2.0, continuation_rate=0.1,
+                 experiment_rate=0.05, seed=None):
+        self.rng = random.Random(seed)
+        self.rows_per_day = rows_per_day
+        self.continuation_rate = continuation_rate
+        self.experiment_rate = experiment_rate
+        self.users = [User(self.rng) for _ in range(max(int(rows_per_day * USERS_PER_ROW), 1))]
+        for user in self.users:
+            if self.rng.random() < experiment_rate:
+                experiment, cohorts = self.rng.choice(EXPERIMENTS)
+                user.experiment = (experiment, self.rng.choice(cohorts))
+        # Roughly as many flow events as activity events, spread over
+        # flows_per_uid flows for each user who starts one.
+        self.flows_per_day = max(rows_per_day // EVENTS_PER_FLOW, 1)
+        self.flows_per_uid = flows_per_uid
+        # Events of flows that carry on past midnight, for the next day's file.
+        self.spilled = []
+
+    def timestamp(self, day):
+        return int((datetime.strptime(day, "%Y-%m-%d") - datetime(1970, 1, 1)).total_seconds()
+                   + self.rng.randint(0, 86399))
+
+    def activity(self, day):
+        for _ in range(self.rows_per_day):
+            user = self.rng.choice(self.users)
+            device = self.rng.choice(user.devices)
+            yield dict(device, timestamp=self.timestamp(day), uid=user.uid,
+                       type=self.rng.choice(ACTIVITY_TYPES), service=self.rng.choice(SERVICES))
+
+    def flow(self, day, user):
+        """Return the events of one flow that begins on day, in time order."""
+        flow_id = hex_id(self.rng, 64)
+        device = self.rng.choice(user.devices)
+        begin = self.timestamp(day)
+        metadata = dict(device, flow_id=flow_id, locale=user.locale,
+                        context=self.rng.choice(CONTEXTS),
+                        entrypoint=self.rng.choice(ENTRYPOINTS),
+                        service=self.rng.choice(SERVICES))
+        if self.rng.random() < 0.2:
+            metadata.update(utm_campaign="fxa-embedded-form", utm_medium="referral",
+                            utm_source="firstrun", utm_content="fx-" + device["ua_version"])
+        events = [dict(metadata, type="flow.begin", timestamp=begin, flow_time=0)]
+        flow_time = 0
+        signed_in = False
+        for step in range(self.rng.randint(1, EVENTS_PER_FLOW - 1)):
+            flow_time += self.rng.randint(1000, 600000)
+            event_type = self.rng.choice(FLOW_STEPS)
+            signed_in = signed_in or event_type.endswith(".submit")
+            events.append(dict(metadata, type=event_type, flow_time=flow_time,
+                               uid=user.uid if signed_in else ""))
+        if user.flows and self.rng.random() < self.continuation_rate:
+            events.append(dict(metadata, type="flow.continued." + self.rng.choice(user.flows),
+                               flow_time=flow_time + 1000))
+        if user.experiment is not None:
+            events.append(dict(metadata, type="flow.experiment.{0}.{1}".format(*user.experiment),
+                               flow_time=self.rng.randint(0, flow_time + 1), uid=user.uid))
+        if signed_in and self.rng.random() < 0.7:
+            flow_time += self.rng.randint(1000, 60000)
+            if self.rng.random() < 0.3:
+                events.append(dict(metadata, type="account.created", flow_time=flow_time, uid=user.uid))
+            events.append(dict(metadata, type="flow.complete", flow_time=flow_time + 1, uid=user.uid))
+        for event in events:
+            event["timestamp"] = begin + event["flow_time"] // 1000
+        user.flows = (user.flows + [flow_id])[-3:]
+        return events
+
+    def flows(self, day):
+        """Return the flow events that happened on day, including earlier days' spill."""
+        next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1))
+        day_end = int((next_day - datetime(1970, 1, 1)).total_seconds())
+        events, self.spilled = self.spilled, []
+        active = self.rng.sample(self.users, min(len(self.users),
+                                                 int(self.flows_per_day / self.flows_per_uid) + 1))
+        for _ in range(self.flows_per_day):
+            for event in self.flow(day, self.rng.choice(active)):
+                if event["timestamp"] < day_end:
+                    events.append(event)
+                else:
+                    self.spilled.append(event)
+        return events
+
+    def email(self, day, flows):
+        """Return email events for a sample of the day's flows."""
+        flow_ids = list(set(event["flow_id"] for event in flows if event["type"] == "flow.begin"))
+        for flow_id in self.rng.sample(flow_ids, len(flow_ids) // 3):
+            for _ in range(self.rng.randint(1, 3)):
+                email_type = self.rng.choice(EMAIL_TYPES)
+                yield {
+                    "timestamp": self.timestamp(day),
+                    "flow_id": flow_id,
+                    "domain": self.rng.choice(DOMAINS),
+                    "template": self.rng.choice(TEMPLATES),
+                    "type": email_type,
+                    "bounced": "Permanent" if email_type == "bounced" else "",
+                    "complaint": "abuse" if email_type == "complaint" else "",
+                    "locale": self.rng.choice(LOCALES),
+                }
+
+def write_rows(filename, rows, columns):
+    """Write rows as headerless CSV, timestamp first, returning how many there were."""
+    directory = path.dirname(filename)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    count = 0
+    with open(filename, "wb") as output:
+        writer = csv.writer(output)
+        for row in rows:
+            writer.writerow([row["timestamp"]] + [row.get(column, "") for column in columns])
+            count += 1
+    return count
+
+def generate(directory, day_until, days, rows_per_day, flows_per_uid=2.0, continuation_rate=0.1,
+             experiment_rate=0.05, seed=None):
+    """Write days of files, ending with day_until, under directory.
+
+    Returns a dict of event type -> number of rows written.
+    """
+    generator = Generator(rows_per_day, flows_per_uid, continuation_rate, experiment_rate, seed)
+    columns = dict((event_type, [column.strip() for column in event_type_columns.split(",")])
+                   for event_type, event_type_columns in event_columns().items())
+    counts = {"activity": 0, "flow": 0, "email": 0, "counts": 0}
+    last = datetime.strptime(day_until, "%Y-%m-%d")
+    accounts = len(generator.users) * 10
+    for offset in range(days - 1, -1, -1):
+        day = (last - timedelta(days=offset)).strftime("%Y-%m-%d")
+        names = file_names(day)
+        print "GENERATING", day
+        flows = generator.flows(day)
+        counts["activity"] += write_rows(path.join(directory, names["activity"]),
+                                         generator.activity(day), columns["activity"])
+        counts["flow"] += write_rows(path.join(directory, names["flow"]),
+                                     sorted(flows, key=lambda event: event["timestamp"]),
+                                     columns["flow"])
+        counts["email"] += write_rows(path.join(directory, names["email"]),
+                                      generator.email(day, flows), columns["email"])
+        accounts += generator.rng.randint(0, rows_per_day // 100 + 1)
+        counts["counts"] += write_rows(path.join(directory, names["counts"]),
+                                       [{"timestamp": day, "accounts": accounts,
+                                         "verified_accounts": int(accounts * 0.9)}],
+                                       ["accounts", "verified_accounts"])
+    return counts
+
+def add_arguments(parser):
+    parser.add_argument("--day-until", default=(datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d"),
+                        help="last day to generate (default: yesterday)")
+    parser.add_argument("--days", type=int, default=7,
+                        help="number of days to generate")
+    parser.add_argument("--rows-per-day", type=int, default=10000,
+                        help="activity events per day; flow and email volumes follow from it")
+    parser.add_argument("--flows-per-uid", type=float, default=2.0,
+                        help="average number of flows each active user goes through in a day")
+    parser.add_argument("--continuation-rate", type=float, default=0.1,
+                        help="fraction of flows that continue one of the user's earlier flows")
+    parser.add_argument("--experiment-rate", type=float, default=0.05,
+                        help="fraction of users enrolled in an experiment")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed, for repeatable data")
+
+def generate_from_args(directory, args):
+    return generate(directory, args.day_until, args.days, args.rows_per_day, args.flows_per_uid,
+                    args.continuation_rate, args.experiment_rate, args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic event files laid out like the S3 bucket")
+    parser.add_argument("directory", help="where to write the files")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print generate_from_args(args.directory, args)
@@ -0,0 +1,101 @@
+#
+# The local stand-ins for Redshift and S3 that the tests run against.
+#
+# These are the ones benchmark.py uses: a scratch schema in the Postgres
+# database given by BENCHMARK_DB and a moto mock of the bucket. Import
+# this before any of the scripts, because they read their settings when
+# they're imported. Tests are skipped if moto isn't installed or the
+# database can't be reached.
+#
+
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+
+LISTING_CACHE_DIR = tempfile.mkdtemp()
+benchmark.configure_environment(LISTING_CACHE_DIR)
+
+import boto.s3
+import postgres
+import psycopg2
+
+import backends
+import import_events
+import s3_listing
+import synthetic_data
+import tracing
+
+try:
+    from moto import mock_s3_deprecated
+except ImportError:
+    mock_s3_deprecated = None
+
+DAY_UNTIL = "2017-06-08"
+
+TracedCursor = tracing.TracedCursor
+
+def unavailable():
+    """Return why the tests can't run here, or None if they can."""
+    if mock_s3_deprecated is None:
+        return "needs moto"
+    try:
+        psycopg2.connect(import_events.DB_URI).close()
+    except psycopg2.Error as error:
+        return "needs a database at BENCHMARK_DB: " + str(error).strip()
+    return None
+
+class LocalTestCase(unittest.TestCase):
+    """Starts each test with an empty schema, bucket and listing cache."""
+
+    def setUp(self):
+        reason = unavailable()
+        if reason:
+            self.skipTest(reason)
+        self.directory = tempfile.mkdtemp()
+        shutil.rmtree(LISTING_CACHE_DIR, ignore_errors=True)
+        self.relist()
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        benchmark.isolate_mock_requests()
+        self.bucket = boto.s3.connect_to_region("us-west-2").create_bucket(import_events.S3_BUCKET,
+                                                                           location="us-west-2")
+        self.db = postgres.Postgres(import_events.DB_URI)
+        self.reset()
+        # The scripts create their pools with tracing.TracedCursor.
+        tracing.TracedCursor = backends.make_cursor_factory(tracing, self.bucket)
+
+    def tearDown(self):
+        tracing.TracedCursor = TracedCursor
+        self.mock.stop()
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        """Return a connection pool that runs Redshift SQL, as the scripts' do."""
+        return postgres.Postgres(import_events.DB_URI, cursor_factory=tracing.TracedCursor)
+
+    def relist(self):
+        """Forget the listings made so far, as the next run of a script would."""
+        s3_listing.listings.clear()
+
+    def reset(self):
+        """Drop everything the scripts have created, to import again from scratch."""
+        self.db.run(benchmark.Q_RESET_SCHEMA)
+        self.db.run(backends.Q_CREATE_STRTOL)
+
+    def generate(self, days=4, rows_per_day=2000, seed=1, **options):
+        """Write synthetic data up to DAY_UNTIL and upload it to the bucket."""
+        counts = synthetic_data.generate(path.join(self.directory, "data"), DAY_UNTIL, days,
+                                         rows_per_day, seed=seed, **options)
+        benchmark.upload(self.bucket, path.join(self.directory, "data"))
+        return counts
+
+    def rows(self, query, **parameters):
+        return sorted(self.db.all(query, parameters))
+
+    def assertSameRows(self, query, expected_query, **parameters):
+        rows = self.rows(query, **parameters)
+        self.assertTrue(rows, "no rows from " + query)
+        self.assertEqual(rows, self.rows(expected_query, **parameters))
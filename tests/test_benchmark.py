@@ -0,0 +1,53 @@
+#
+# The benchmark runs every step and reports on them.
+#
+
+from tests import local
+
+from os import path
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+
+import benchmark
+import tracing
+
+STEPS = ["activity", "flow", "email", "counts", "daily_summary"]
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        reason = local.unavailable()
+        if reason:
+            self.skipTest(reason)
+        self.directory = tempfile.mkdtemp()
+        self.argv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self.argv
+        tracing.TracedCursor = local.TracedCursor
+        shutil.rmtree(self.directory)
+
+    def benchmark(self, name, *options):
+        output = path.join(self.directory, name + ".json")
+        local.s3_listing.listings.clear()
+        sys.argv = ["benchmark.py", "--days", "3", "--rows-per-day", "500", "--seed", "1",
+                    "--day-until", local.DAY_UNTIL, "--output", output] + list(options)
+        benchmark.main()
+        with open(output) as results:
+            return json.load(results)
+
+    def test_reports_every_step(self):
+        results = self.benchmark("first")
+        self.assertEqual([step["name"] for step in results["steps"]], STEPS)
+        for step in results["steps"]:
+            self.assertTrue(step["input_rows"] > 0, step["name"])
+            self.assertTrue(step["statements"] > 0, step["name"])
+            self.assertTrue(step["stages"], step["name"])
+        # A second run can be compared with the first.
+        second = self.benchmark("second", "--engine", "stream", "--preload", "gzip",
+                                "--compare", path.join(self.directory, "first.json"))
+        self.assertEqual([step["input_rows"] for step in second["steps"]],
+                         [step["input_rows"] for step in results["steps"]])
@@ -0,0 +1,143 @@
+#
+# The daily summary tables against the queries they used to come from.
+#
+# daily_activity_per_device is now filled by the activity import and
+# daily_multi_device_users from a sliding window of recent devices, so
+# both are compared with the original recomputation from the events.
+# Postgres has no HyperLogLog, so the active user sketches are checked
+# with sets of uids standing in for them, which count exactly.
+#
+
+from tests import local
+
+import calculate_daily_summary
+import import_activity_events
+
+Q_BASELINE_DEVICES = """
+    SELECT DISTINCT
+      timestamp::DATE as day,
+      uid, device_id, service, ua_browser, ua_version, ua_os
+    FROM activity_events{suffix}
+    WHERE device_id != ''
+"""
+
+Q_BASELINE_MD_USERS = """
+    SELECT DISTINCT
+      present.day, present.uid, present.device_id AS device_now, past.device_id AS device_prev
+    FROM ({devices}) AS present
+    INNER JOIN ({devices}) AS past
+    ON
+      present.uid = past.uid
+      AND present.device_id != past.device_id
+      AND past.day <= present.day
+      AND past.day >= (present.day - '7 days'::INTERVAL)
+"""
+
+Q_DEVICES = """
+    SELECT day, uid, device_id, service, ua_browser, ua_version, ua_os
+    FROM daily_activity_per_device{suffix}
+"""
+
+Q_MD_USERS = """
+    SELECT day, uid, device_now, device_prev
+    FROM daily_multi_device_users{suffix}
+"""
+
+# Exact stand-ins for Redshift's HLL functions.
+Q_CREATE_HLL = """
+    CREATE DOMAIN hllsketch AS TEXT[];
+    CREATE FUNCTION sketch_of(uids TEXT[]) RETURNS TEXT[] AS $$
+      SELECT ARRAY(SELECT DISTINCT uid FROM UNNEST(uids) AS uid ORDER BY uid)
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION hll_cardinality(sketch TEXT[]) RETURNS BIGINT AS $$
+      SELECT COUNT(DISTINCT uid) FROM UNNEST(sketch) AS uid
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE AGGREGATE hll(TEXT) (SFUNC = ARRAY_APPEND, STYPE = TEXT[], FINALFUNC = hll_cardinality);
+    CREATE AGGREGATE hll_create_sketch(TEXT) (SFUNC = ARRAY_APPEND, STYPE = TEXT[], FINALFUNC = sketch_of);
+    CREATE AGGREGATE hll_combine(TEXT[]) (SFUNC = ARRAY_CAT, STYPE = TEXT[], FINALFUNC = sketch_of);
+"""
+
+Q_BASELINE_SKETCHES = """
+    SELECT timestamp::DATE AS day, service, ua_os, ua_browser, COUNT(DISTINCT uid) AS user_count
+    FROM activity_events{suffix}
+    GROUP BY 1, 2, 3, 4
+"""
+
+Q_BASELINE_ROLLUPS = """
+    SELECT ends.day, {window_days} AS window_days, events.service, events.ua_os, events.ua_browser,
+      COUNT(DISTINCT events.uid) AS user_count
+    FROM (
+      SELECT DISTINCT timestamp::DATE AS day
+      FROM activity_events{suffix}
+    ) AS ends
+    INNER JOIN activity_events{suffix} AS events
+    ON
+      events.timestamp::DATE > ends.day - {window_days}
+      AND events.timestamp::DATE <= ends.day
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+Q_SKETCHES = """
+    SELECT day, service, ua_os, ua_browser, user_count
+    FROM daily_active_user_sketches{suffix}
+"""
+
+Q_ROLLUPS = """
+    SELECT day, window_days, service, ua_os, ua_browser, user_count
+    FROM active_user_rollups{suffix}
+    WHERE window_days = {window_days}
+"""
+
+Q_GET_DAYS = """
+    SELECT MIN(timestamp)::DATE AS day_first, MAX(timestamp)::DATE AS day_until
+    FROM activity_events{suffix};
+"""
+
+class DailySummaryTest(local.LocalTestCase):
+
+    def assertMatchesBaseline(self):
+        for suffix in calculate_daily_summary.TABLE_SUFFIXES:
+            devices = Q_BASELINE_DEVICES.format(suffix=suffix)
+            self.assertSameRows(Q_DEVICES.format(suffix=suffix), devices)
+            self.assertSameRows(Q_MD_USERS.format(suffix=suffix),
+                                Q_BASELINE_MD_USERS.format(devices=devices))
+
+    def test_matches_baseline(self):
+        self.generate(days=10)
+        import_activity_events.run()
+        calculate_daily_summary.summarize_events()
+        self.assertMatchesBaseline()
+
+    def test_matches_baseline_day_by_day(self):
+        self.generate(days=10)
+        for day_until in ("2017-06-01", "2017-06-04", "2017-06-08"):
+            import_activity_events.run(day_until=day_until)
+            calculate_daily_summary.summarize_events()
+        self.assertMatchesBaseline()
+
+    def test_rebuilt_devices_match_baseline(self):
+        self.generate(days=10)
+        import_activity_events.run()
+        self.db.run("DELETE FROM daily_activity_per_device")
+        calculate_daily_summary.summarize_events(rebuild_devices=True)
+        self.assertMatchesBaseline()
+
+class ActiveUserSketchTest(local.LocalTestCase):
+
+    def summarize(self):
+        db = self.connect()
+        for suffix in calculate_daily_summary.TABLE_SUFFIXES:
+            days = db.one(Q_GET_DAYS.format(suffix=suffix))
+            calculate_daily_summary.summarize_active_users(db, suffix, days.day_first, days.day_until)
+
+    def test_matches_exact_counts(self):
+        self.db.run(Q_CREATE_HLL)
+        self.generate(days=10, rows_per_day=1000)
+        for day_until in ("2017-06-03", "2017-06-08"):
+            import_activity_events.run(day_until=day_until)
+            self.summarize()
+        for suffix in calculate_daily_summary.TABLE_SUFFIXES:
+            self.assertSameRows(Q_SKETCHES.format(suffix=suffix), Q_BASELINE_SKETCHES.format(suffix=suffix))
+            for window_days in calculate_daily_summary.ROLLUP_WINDOWS:
+                self.assertSameRows(Q_ROLLUPS.format(suffix=suffix, window_days=window_days),
+                                    Q_BASELINE_ROLLUPS.format(suffix=suffix, window_days=window_days))
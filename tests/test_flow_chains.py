@@ -0,0 +1,95 @@
+#
+# Continued flows resolved into chains, a range at a time.
+#
+
+from tests import local
+
+import import_flow_events
+import journal
+import sql
+
+SAMPLE_RATES = ({"suffix": ""},)
+
+Q_INSERT_FLOW = """
+    INSERT INTO flow_metadata (flow_id, begin_time, duration, export_date, continued_from)
+    VALUES (%(flow_id)s, %(day)s::TIMESTAMP, 1000, %(day)s, %(continued_from)s);
+"""
+
+Q_CHAINS = """
+    SELECT flow_id, root_flow_id, chain_depth
+    FROM flow_chains;
+"""
+
+Q_CHAIN_TOTALS = """
+    SELECT root_flow_id, flows, chain_depth, total_duration, first_date, last_date
+    FROM flow_chain_totals;
+"""
+
+# Each flow continues the one before it: one chain of seven flows over
+# three days. A range's updates also touch the days either side of it,
+# so only the first day's flows are out of reach of the last day's.
+DAYS = ("2017-06-06", "2017-06-07", "2017-06-08")
+
+FLOWS = (
+    ("2017-06-06", "f0", None),
+    ("2017-06-06", "f1", "f0"),
+    ("2017-06-06", "f2", "f1"),
+    ("2017-06-07", "f3", "f2"),
+    ("2017-06-08", "f4", "f3"),
+    ("2017-06-08", "f5", "f4"),
+    ("2017-06-08", "f6", "f5"),
+)
+
+class FlowChainsTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(FlowChainsTest, self).setUp()
+        self.pool = self.connect()
+        import_flow_events.before_import(self.pool, SAMPLE_RATES)
+        journal.create_table(self.pool)
+        self.addCleanup(setattr, import_flow_events, "MAX_CHAIN_JUMPS", import_flow_events.MAX_CHAIN_JUMPS)
+
+    def import_range(self, day, flows):
+        """Add flows to flow_metadata as day's, and update the chains as its range would."""
+        for flow_id, continued_from in flows:
+            self.pool.run(Q_INSERT_FLOW, {"flow_id": flow_id, "day": day, "continued_from": continued_from})
+        with self.pool.get_connection() as connection:
+            stages = journal.Stages(connection, "flow", day, day)
+            import_flow_events.update_chains(stages, sql.days(day, day), SAMPLE_RATES)
+            stages.finish()
+
+    def import_day(self, day):
+        self.import_range(day, [(flow_id, continued_from) for flow_day, flow_id, continued_from in FLOWS
+                                if flow_day == day])
+
+    def assertOneChain(self):
+        self.assertEqual([tuple(row) for row in self.rows(Q_CHAINS)],
+                         [("f" + str(depth), "f0", depth) for depth in range(len(FLOWS))])
+        totals = [tuple(row) for row in self.rows(Q_CHAIN_TOTALS)]
+        self.assertEqual([(root, flows, depth, duration, str(first), str(last))
+                          for root, flows, depth, duration, first, last in totals],
+                         [("f0", 7, 6, 7000, "2017-06-06", "2017-06-08")])
+
+    def test_long_chain_in_one_range(self):
+        # Jumping halves the distance left, so 3 jumps resolve links up to
+        # 8 flows from their root.
+        import_flow_events.MAX_CHAIN_JUMPS = 3
+        self.import_range("2017-06-08", [(flow_id, continued_from) for _, flow_id, continued_from in FLOWS])
+        self.assertEqual([tuple(row) for row in self.rows(Q_CHAINS)],
+                         [("f" + str(depth), "f0", depth) for depth in range(len(FLOWS))])
+
+    def test_chain_continued_from_previous_ranges(self):
+        # The last range's links join the chain that the earlier ranges
+        # left, then jump along their own chain to its root.
+        for day in DAYS:
+            self.import_day(day)
+        self.assertOneChain()
+
+    def test_chain_continued_into_next_ranges(self):
+        # Imported newest first, as import_events does, the later flows
+        # form a chain of their own until the ranges with their root move it.
+        for day in reversed(DAYS):
+            self.import_day(day)
+            if day == DAYS[-1]:
+                self.assertEqual(set(row.root_flow_id for row in self.rows(Q_CHAINS)), set(["f3"]))
+        self.assertOneChain()
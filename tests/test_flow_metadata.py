@@ -0,0 +1,250 @@
+#
+# The flow metadata and experiments against the queries they used to come from.
+#
+# Every sample rate's tables are now updated from one aggregate of the
+# range's flows, so they are compared with tables built by the original
+# hook, which ran its own queries for each rate and each day. Those are
+# copied here as they were, except that they read the typed timestamp
+# and sample cohort of the staged table instead of recomputing them.
+# They are compared a day at a time: with --backfill, a range's flows
+# also take the events from its later days, not just the next one.
+#
+
+from tests import local
+
+import import_events
+import import_flow_events
+
+Q_BASELINE_CLEAR_DAY = """
+    DELETE FROM flow_{table}{suffix}
+    WHERE export_date = '{day}';
+"""
+
+Q_BASELINE_INSERT_METADATA = """
+    INSERT INTO flow_metadata{suffix} (
+      flow_id,
+      begin_time,
+      ua_browser,
+      ua_version,
+      ua_os,
+      context,
+      entrypoint,
+      migration,
+      service,
+      utm_campaign,
+      utm_content,
+      utm_medium,
+      utm_source,
+      utm_term,
+      export_date
+    )
+    SELECT
+      flow_id,
+      timestamp,
+      ua_browser,
+      ua_version,
+      ua_os,
+      context,
+      entrypoint,
+      migration,
+      service,
+      utm_campaign,
+      utm_content,
+      utm_medium,
+      utm_source,
+      utm_term,
+      '{day}'::DATE
+    FROM {table_name}
+    WHERE sample < {percent}
+    AND type = 'flow.begin';
+"""
+
+Q_BASELINE_DELETE_BEGIN_EVENTS = """
+    DELETE FROM {table_name}
+    WHERE timestamp::DATE <= '{day}'
+    AND type = 'flow.begin';
+"""
+
+Q_BASELINE_UPDATE_METADATA = """
+    UPDATE flow_metadata{suffix}
+    SET
+      duration = events.flow_time,
+      locale = events.locale,
+      uid = events.uid
+    FROM (
+      SELECT
+        flow_id,
+        MAX(flow_time) AS flow_time,
+        MAX(locale) AS locale,
+        MAX(uid) AS uid
+      FROM {table_name}
+      WHERE {table_name}.timestamp::DATE = '{day}'
+        OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
+      GROUP BY flow_id
+    ) AS events
+    WHERE flow_metadata{suffix}.flow_id = events.flow_id;
+"""
+
+Q_BASELINE_UPDATE_COMPLETED = """
+    UPDATE flow_metadata{suffix}
+    SET completed = TRUE
+    FROM (
+      SELECT flow_id
+      FROM {table_name}
+      WHERE type = 'flow.complete'
+        AND (
+          {table_name}.timestamp::DATE = '{day}'
+          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
+        )
+    ) AS complete
+    WHERE flow_metadata{suffix}.flow_id = complete.flow_id;
+"""
+
+Q_BASELINE_UPDATE_NEW_ACCOUNT = """
+    UPDATE flow_metadata{suffix}
+    SET new_account = TRUE
+    FROM (
+      SELECT flow_id
+      FROM {table_name}
+      WHERE type = 'account.created'
+        AND (
+          {table_name}.timestamp::DATE = '{day}'
+          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
+        )
+    ) AS created
+    WHERE flow_metadata{suffix}.flow_id = created.flow_id;
+"""
+
+Q_BASELINE_UPDATE_CONTINUED_FROM = """
+    UPDATE flow_metadata{suffix}
+    SET continued_from = SUBSTRING(continued.type, 16, 64)
+    FROM (
+      SELECT flow_id, type
+      FROM {table_name}
+      WHERE type LIKE 'flow.continued.%'
+        AND (
+          {table_name}.timestamp::DATE = '{day}'
+          OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
+        )
+    ) AS continued
+    WHERE flow_metadata{suffix}.flow_id = continued.flow_id;
+"""
+
+Q_BASELINE_DELETE_CONTINUED_EVENTS = """
+    DELETE FROM {table_name}
+    WHERE timestamp::DATE <= '{day}'
+    AND type LIKE 'flow.continued.%';
+"""
+
+Q_BASELINE_INSERT_EXPERIMENTS = """
+    INSERT INTO flow_experiments{suffix} (
+      experiment,
+      cohort,
+      timestamp,
+      flow_id,
+      uid,
+      export_date
+    )
+    SELECT
+      SPLIT_PART(type, '.', 3) AS experiment,
+      SPLIT_PART(type, '.', 4) AS cohort,
+      timestamp,
+      flow_id,
+      uid,
+      '{day}'::DATE
+    FROM {table_name}
+    WHERE sample < {percent}
+    AND type LIKE 'flow.experiment.%';
+"""
+
+Q_BASELINE_UPDATE_EXPERIMENTS = """
+    UPDATE flow_experiments{suffix}
+    SET uid = events.uid
+    FROM (
+      SELECT flow_id, MAX(uid) AS uid
+      FROM {table_name}
+      WHERE {table_name}.timestamp::DATE = '{day}'
+        OR {table_name}.timestamp::DATE = '{day}'::DATE + '1 day'::INTERVAL
+      GROUP BY flow_id
+    ) AS events
+    WHERE flow_experiments{suffix}.flow_id = events.flow_id;
+"""
+
+Q_BASELINE_DELETE_EXPERIMENT_EVENTS = """
+    DELETE FROM {table_name}
+    WHERE timestamp::DATE <= '{day}'
+    AND type LIKE 'flow.experiment.%';
+"""
+
+Q_ROWS = """
+    SELECT *
+    FROM {table}{suffix};
+"""
+
+# The days with flows that continued others and with flows in experiments,
+# for the comparisons to cover more than one of each.
+Q_COVERAGE = """
+    SELECT
+      COUNT(DISTINCT CASE WHEN continued_from IS NOT NULL THEN export_date END) AS continued_days,
+      (SELECT COUNT(DISTINCT export_date) FROM flow_experiments WHERE uid IS NOT NULL) AS experiment_days
+    FROM flow_metadata;
+"""
+
+def baseline_after_day(db, day, staged_table_name, permanent_table_name, sample_rates):
+    """The original hook, which updated each rate's tables from its own events table."""
+    for rate in sample_rates:
+        values = {"suffix": rate["suffix"], "day": day, "percent": rate["percent"],
+                  "table_name": permanent_table_name.format(suffix=rate["suffix"])}
+        staged = dict(values, table_name=staged_table_name)
+        for query, query_values in (
+                (Q_BASELINE_CLEAR_DAY, dict(values, table="metadata")),
+                (Q_BASELINE_INSERT_METADATA, staged),
+                (Q_BASELINE_DELETE_BEGIN_EVENTS, values),
+                (Q_BASELINE_UPDATE_METADATA, values),
+                (Q_BASELINE_UPDATE_COMPLETED, values),
+                (Q_BASELINE_UPDATE_NEW_ACCOUNT, values),
+                (Q_BASELINE_UPDATE_CONTINUED_FROM, values),
+                (Q_BASELINE_DELETE_CONTINUED_EVENTS, values),
+                (Q_BASELINE_CLEAR_DAY, dict(values, table="experiments")),
+                (Q_BASELINE_INSERT_EXPERIMENTS, staged),
+                (Q_BASELINE_UPDATE_EXPERIMENTS, values),
+                (Q_BASELINE_DELETE_EXPERIMENT_EVENTS, values)):
+            db.run(query.format(**query_values))
+
+class FlowMetadataTest(local.LocalTestCase):
+
+    def import_tables(self, after_range, **options):
+        """Import the flow events from scratch with after_range, returning
+        the rows of every rate's metadata and experiments tables.
+        """
+        self.reset()
+        import_events.run(s3_prefix=import_flow_events.S3_PREFIX,
+                          event_type="flow",
+                          temp_schema=import_flow_events.TEMPORARY_SCHEMA,
+                          temp_columns=import_flow_events.TEMPORARY_COLUMNS,
+                          perm_schema=import_flow_events.EVENT_SCHEMA,
+                          perm_columns=import_flow_events.EVENT_COLUMNS,
+                          id_column="flow_id",
+                          before_import=import_flow_events.before_import,
+                          after_range=after_range,
+                          ordered_hooks=True,
+                          **options)
+        return dict((table + rate["suffix"], self.rows(Q_ROWS.format(table=table, suffix=rate["suffix"])))
+                    for table in ("flow_metadata", "flow_experiments")
+                    for rate in import_events.SAMPLE_RATES)
+
+    def assertMatchesBaseline(self, **options):
+        self.generate(days=6)
+        expected_tables = self.import_tables(import_events.each_day(baseline_after_day))
+        coverage = self.db.one(Q_COVERAGE)
+        self.assertTrue(coverage.continued_days > 1 and coverage.experiment_days > 1, coverage)
+        tables = self.import_tables(import_flow_events.after_range, **options)
+        for table in sorted(expected_tables):
+            self.assertTrue(expected_tables[table], "nothing in " + table)
+            self.assertEqual(tables[table], expected_tables[table], table + " differs")
+
+    def test_matches_baseline(self):
+        self.assertMatchesBaseline()
+
+    def test_matches_baseline_with_jobs(self):
+        self.assertMatchesBaseline(jobs=3)
@@ -0,0 +1,74 @@
+#
+# Importing the daily account counts.
+#
+
+from tests import local
+
+import re
+
+import import_counts
+import tracing
+
+Q_COUNTS = """
+    SELECT day, accounts, verified_accounts
+    FROM counts;
+"""
+
+class ImportCountsTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(ImportCountsTest, self).setUp()
+        # Note the name of every manifest written.
+        self.manifests = []
+        new_key = self.bucket.new_key
+
+        def note_manifest(key_name):
+            if key_name.endswith(".manifest"):
+                self.manifests.append(key_name)
+            return new_key(key_name)
+        self.bucket.new_key = note_manifest
+
+    def note_copies(self):
+        """Note the MAXERROR of every COPY the scripts run in self.maxerrors."""
+        self.maxerrors = []
+        test = self
+
+        class Cursor(tracing.TracedCursor):
+
+            def execute(self, sql, parameters=None):
+                match = re.search(r"MAXERROR AS (\d+)", sql)
+                if match is not None:
+                    test.maxerrors.append(int(match.group(1)))
+                return super(Cursor, self).execute(sql, parameters)
+        tracing.TracedCursor = Cursor
+
+    def staged_keys(self):
+        return [key.name for key in self.bucket.list(prefix=import_counts.S3_STAGING_PREFIX)]
+
+    def test_imports_every_day(self):
+        self.generate(days=3)
+        import_counts.import_events(s3=self.bucket)
+        rows = self.rows(Q_COUNTS)
+        self.assertEqual([str(row.day) for row in rows], ["2017-06-06", "2017-06-07", "2017-06-08"])
+        self.assertEqual(self.staged_keys(), [])
+
+    def test_force_reload(self):
+        self.generate(days=3)
+        import_counts.import_events(s3=self.bucket)
+        rows = self.rows(Q_COUNTS)
+        self.relist()
+        import_counts.import_events(s3=self.bucket)
+        self.assertEqual(len(self.manifests), 1)
+        self.relist()
+        import_counts.import_events(force_reload=True, s3=self.bucket)
+        self.assertEqual(self.rows(Q_COUNTS), rows)
+        self.assertEqual(self.staged_keys(), [])
+        # Each run writes a manifest of its own.
+        self.assertEqual(len(set(self.manifests)), 2)
+
+    def test_maxerror_per_file(self):
+        # The one COPY allows as many bad lines as a COPY per file did.
+        self.generate(days=3)
+        self.note_copies()
+        import_counts.import_events(s3=self.bucket)
+        self.assertEqual(self.maxerrors, [3 * import_counts.MAXERROR_PER_FILE])
@@ -0,0 +1,95 @@
+#
+# Importing events with --jobs and --dedup.
+#
+
+from tests import local
+
+from os import path
+
+import import_activity_events
+import import_email_events
+import import_events
+import synthetic_data
+
+Q_COUNT_EVENTS = """
+    SELECT COUNT(*)
+    FROM activity_events
+    WHERE timestamp::DATE = %(day)s;
+"""
+
+Q_ROWS = """
+    SELECT *
+    FROM {table}{suffix};
+"""
+
+Q_LEDGER = """
+    SELECT event_type, day, sample_rate, s3_key, etag, row_count
+    FROM load_ledger;
+"""
+
+class ConcurrentImportTest(local.LocalTestCase):
+
+    def import_tables(self, tables, **options):
+        """Import the activity and email events from scratch, returning the
+        rows of every table given and of the load ledger.
+        """
+        self.reset()
+        self.relist()
+        import_activity_events.run(**options)
+        import_email_events.run(**options)
+        rows = dict((table + rate["suffix"], self.rows(Q_ROWS.format(table=table, suffix=rate["suffix"])))
+                    for table in tables for rate in import_events.SAMPLE_RATES)
+        rows["load_ledger"] = self.rows(Q_LEDGER)
+        return rows
+
+    def test_concurrent_import_matches_sequential(self):
+        self.generate(days=6)
+        tables = ("activity_events", "daily_activity_per_device", "email_events")
+        expected_tables = self.import_tables(tables, jobs=1)
+        for jobs, backfill in ((3, 1), (2, 2)):
+            actual_tables = self.import_tables(tables, jobs=jobs, backfill=backfill)
+            for table in sorted(expected_tables):
+                self.assertTrue(expected_tables[table], "nothing in " + table)
+                self.assertEqual(actual_tables[table], expected_tables[table],
+                                 "{0} differs with {1} jobs".format(table, jobs))
+
+class DedupTest(local.LocalTestCase):
+
+    def duplicate(self, day, rows):
+        """Append copies of the first rows of day's activity file and upload it again.
+
+        Returns the number of distinct rows in the file.
+        """
+        key_name = synthetic_data.file_names(day)["activity"]
+        filename = path.join(self.directory, "data", key_name)
+        with open(filename) as events:
+            lines = events.readlines()
+        with open(filename, "a") as events:
+            events.writelines(lines[:rows])
+        self.bucket.new_key(key_name).set_contents_from_filename(filename)
+        return len(set(lines))
+
+    def count(self, day):
+        return self.db.one(Q_COUNT_EVENTS, {"day": day})
+
+    def test_duplicates_within_load(self):
+        self.generate(days=2)
+        distinct = self.duplicate(local.DAY_UNTIL, 100)
+        import_activity_events.run(dedup=True)
+        self.assertEqual(self.count(local.DAY_UNTIL), distinct)
+
+    def test_duplicates_across_runs(self):
+        self.generate(days=2)
+        import_activity_events.run(dedup=True)
+        # The file changes, so the next run imports the day again, with
+        # its duplicates.
+        distinct = self.duplicate(local.DAY_UNTIL, 100)
+        self.relist()
+        import_activity_events.run(dedup=True)
+        self.assertEqual(self.count(local.DAY_UNTIL), distinct)
+
+    def test_duplicates_kept_without_dedup(self):
+        self.generate(days=2)
+        distinct = self.duplicate(local.DAY_UNTIL, 100)
+        import_activity_events.run()
+        self.assertEqual(self.count(local.DAY_UNTIL), distinct + 100)
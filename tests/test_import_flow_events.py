@@ -0,0 +1,53 @@
+#
+# Flow imports give the same tables however they are run.
+#
+
+from tests import local
+
+import import_events
+import import_flow_events
+
+TABLES = ("flow_metadata", "flow_experiments", "flow_funnel_daily", "flow_chains", "flow_chain_totals")
+
+Q_ROWS = """
+    SELECT *
+    FROM {table}{suffix};
+"""
+
+# What the synthetic data needs to have for the comparisons to mean much.
+Q_COVERAGE = """
+    SELECT
+      COUNT(CASE WHEN continued_from IS NOT NULL AND continued_from != '' THEN 1 END) AS continued,
+      COUNT(CASE WHEN completed AND (begin_time + duration * '1 millisecond'::INTERVAL)::DATE
+                                    > begin_time::DATE THEN 1 END) AS completed_next_day,
+      (SELECT COUNT(*) FROM flow_experiments) AS experiments
+    FROM flow_metadata;
+"""
+
+class ImportFlowEventsTest(local.LocalTestCase):
+
+    def import_tables(self, **options):
+        """Import the flow events from scratch, returning the rows of every table they fill."""
+        self.reset()
+        import_flow_events.run(**options)
+        return dict((table + rate["suffix"], self.rows(Q_ROWS.format(table=table, suffix=rate["suffix"])))
+                    for table in TABLES for rate in import_events.SAMPLE_RATES)
+
+    def assertSameTables(self, tables, expected_tables):
+        for table in sorted(expected_tables):
+            self.assertTrue(expected_tables[table] or not table.startswith("flow_metadata"),
+                            "nothing in " + table)
+            self.assertEqual(tables[table], expected_tables[table], table + " differs")
+
+    def test_concurrent_import_matches_sequential(self):
+        self.generate(days=6)
+        self.assertSameTables(self.import_tables(jobs=3), self.import_tables(jobs=1))
+
+    def test_stream_matches_sql(self):
+        self.generate(days=6)
+        tables = self.import_tables(engine="stream")
+        expected_tables = self.import_tables(engine="sql")
+        coverage = self.db.one(Q_COVERAGE)
+        self.assertTrue(coverage.continued and coverage.completed_next_day and coverage.experiments,
+                        coverage)
+        self.assertSameTables(tables, expected_tables)
@@ -0,0 +1,107 @@
+#
+# Interrupted ranges resume at their first unfinished stage.
+#
+
+from tests import local
+
+import import_events
+import import_flow_events
+import journal
+
+TABLES = ("flow_events", "flow_metadata", "flow_experiments", "flow_funnel_daily", "flow_chains",
+          "flow_chain_totals")
+
+Q_ROWS = """
+    SELECT *
+    FROM {table}{suffix};
+"""
+
+Q_LEDGER = """
+    SELECT event_type, day, sample_rate, s3_key, etag, row_count
+    FROM load_ledger;
+"""
+
+# Without a day_from, a run starts from the newest day loaded so far,
+# which would leave out the days the interrupted run never got to.
+DAY_FROM = "2017-06-01"
+
+class Interrupted(Exception):
+    pass
+
+class ResumeTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(ResumeTest, self).setUp()
+        self.Stages = journal.Stages
+        self.addCleanup(setattr, journal, "Stages", journal.Stages)
+        self.ran = []
+
+    def run_stages(self, fail_at=None):
+        """Have import_events run its stages with journal.Stages, failing
+        in the stage called fail_at, after its queries but before it commits,
+        and noting the name of every stage that runs in self.ran.
+        """
+        test = self
+
+        def interrupt(cursor):
+            raise Interrupted(fail_at)
+
+        class Stages(self.Stages):
+
+            def stage(self, name, queries, uses=()):
+                if name == fail_at:
+                    queries = list(queries) + [interrupt]
+                ran = super(Stages, self).stage(name, queries, uses)
+                if ran:
+                    test.ran.append((self.day_from, name))
+                return ran
+
+        journal.Stages = Stages
+
+    def tables(self):
+        tables = dict((table + rate["suffix"], self.rows(Q_ROWS.format(table=table, suffix=rate["suffix"])))
+                      for table in TABLES for rate in import_events.SAMPLE_RATES)
+        tables["load_ledger"] = self.rows(Q_LEDGER)
+        return tables
+
+    def assertResumes(self, fail_at):
+        self.generate(days=4)
+        import_flow_events.run(day_from=DAY_FROM)
+        expected_tables = self.tables()
+
+        self.reset()
+        self.relist()
+        self.run_stages(fail_at)
+        self.assertRaises(Interrupted, import_flow_events.run, day_from=DAY_FROM)
+        # The newest day failed, so it's the only one begun.
+        open_ranges = journal.get_open_ranges(self.db, "flow")
+        self.assertEqual(open_ranges.keys(), [(local.DAY_UNTIL, local.DAY_UNTIL)])
+        finished = open_ranges[(local.DAY_UNTIL, local.DAY_UNTIL)]
+        self.assertEqual(finished, set(name for day, name in self.ran))
+        self.assertNotIn(fail_at, finished)
+
+        self.ran = []
+        self.relist()
+        self.run_stages()
+        import_flow_events.run(day_from=DAY_FROM)
+        resumed = set(name for day, name in self.ran if day == local.DAY_UNTIL)
+        self.assertIn(fail_at, resumed)
+        self.assertFalse(resumed.intersection(finished), "finished stages ran again")
+        self.assertEqual(journal.get_open_ranges(self.db, "flow"), {})
+        tables = self.tables()
+        for table in sorted(expected_tables):
+            self.assertTrue(expected_tables[table] or not table.startswith("flow_metadata"),
+                            "nothing in " + table)
+            self.assertEqual(tables[table], expected_tables[table], table + " differs")
+
+    def test_resumes_after_events_insert(self):
+        # The staged table has to be loaded again.
+        self.assertResumes("flow_events_sampled_50")
+
+    def test_resumes_after_metadata_update(self):
+        # The staged table and the flow aggregate have to be built again.
+        self.assertResumes("flow_metadata_sampled_50 update")
+
+    def test_resumes_after_chains(self):
+        # Only stages that need neither are left.
+        self.assertResumes("flow_chains")
@@ -0,0 +1,102 @@
+#
+# A run on the local backend, exported and loaded into Redshift, leaves
+# the tables as a run on Redshift would.
+#
+
+from tests import local
+
+from os import path
+
+import backends
+import calculate_daily_summary
+import import_activity_events
+import import_counts
+import import_email_events
+import import_events
+import import_flow_events
+import load_exports
+
+LOCAL_SCHEMA = "fxa_local"
+
+Q_RESET_LOCAL_SCHEMA = """
+    DROP SCHEMA IF EXISTS {schema} CASCADE;
+    CREATE SCHEMA {schema};
+""".format(schema=LOCAL_SCHEMA)
+
+Q_DROP_LOCAL_SCHEMA = "DROP SCHEMA IF EXISTS {schema} CASCADE;".format(schema=LOCAL_SCHEMA)
+
+Q_ROWS = """
+    SELECT {columns}
+    FROM {table}
+    WHERE {condition};
+"""
+
+Q_DELETE_DAY = """
+    DELETE FROM {table}
+    WHERE {day_column}::DATE = %(day)s
+    AND {condition};
+"""
+
+# The ledger's load times differ from one run to the next.
+LEDGER_COLUMNS = "event_type, day, sample_rate, s3_key, etag, row_count"
+
+class LoadExportsTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(LoadExportsTest, self).setUp()
+        self.db.run(Q_RESET_LOCAL_SCHEMA)
+        self.addCleanup(self.db.run, Q_DROP_LOCAL_SCHEMA)
+        self.addCleanup(setattr, backends, "LOCAL_DB", backends.LOCAL_DB)
+        backends.LOCAL_DB = import_events.DB_URI + "?options=-csearch_path%3D" + LOCAL_SCHEMA
+        self.exports = path.join(self.directory, "exports")
+
+    def run_scripts(self, **options):
+        self.relist()
+        import_activity_events.run(**options)
+        calculate_daily_summary.summarize_events(**options)
+        import_flow_events.run(**options)
+        import_email_events.run(**options)
+        import_counts.import_events(**options)
+
+    def tables(self, exports):
+        return dict((path.join(path.basename(export_directory), export["file"]), self.rows(Q_ROWS.format(
+            columns=LEDGER_COLUMNS if export["table"] == "load_ledger" else "*",
+            table=export["table"], condition=export["condition"])))
+                    for export_directory, export in exports)
+
+    def assertLoads(self, export_from=None):
+        """Export a local run from export_from and load it into Redshift
+        after a run there, with the newest day left out.
+        """
+        self.generate(days=4)
+        self.run_scripts(backend="postgres", export_directory=self.exports, export_from=export_from)
+        exports = load_exports.get_exports(self.exports)
+        self.assertEqual(sorted(path.basename(export_directory) for export_directory, export in exports
+                                if export["table"] == "load_ledger"),
+                         ["activity", "counts", "email", "flow"])
+        # Nothing was written to Redshift.
+        self.assertEqual(self.db.all("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()"), [])
+
+        self.run_scripts()
+        expected_tables = self.tables(exports)
+        for export_directory, export in exports:
+            self.db.run(Q_DELETE_DAY.format(table=export["table"], day_column=export["day_column"],
+                                            condition=export["condition"]),
+                        {"day": local.DAY_UNTIL})
+        load_exports.load_exports(self.exports)
+        tables = self.tables(exports)
+        for table in sorted(expected_tables):
+            self.assertTrue(expected_tables[table], "nothing in " + table)
+            self.assertEqual(tables[table], expected_tables[table], table + " differs")
+        for table in ("activity/activity_events", "activity/daily_activity_per_device",
+                      "daily_summary/daily_multi_device_users", "flow/flow_metadata", "flow/flow_experiments",
+                      "flow/flow_funnel_daily", "email/email_events", "counts/counts", "flow/load_ledger"):
+            self.assertIn(table + ".csv.gz", tables)
+        return exports
+
+    def test_loads_local_run(self):
+        self.assertLoads()
+
+    def test_export_from(self):
+        exports = self.assertLoads(export_from="2017-06-07")
+        self.assertEqual(min(export["day_from"] for export_directory, export in exports), "2017-06-07")
@@ -0,0 +1,69 @@
+#
+# Picking VACUUM and ANALYZE from table statistics.
+#
+
+from collections import namedtuple
+import unittest
+
+import maintenance
+
+# A row of Q_GET_REDSHIFT_TABLE_INFO.
+TableInfo = namedtuple("TableInfo", "total_rows deleted_rows unsorted stats_off")
+
+def svv_table_info(tbl_rows, estimated_visible_rows, unsorted, stats_off):
+    """Return what Q_GET_REDSHIFT_TABLE_INFO selects from a row of svv_table_info."""
+    return TableInfo(tbl_rows, tbl_rows - estimated_visible_rows, unsorted, stats_off)
+
+class PlanTest(unittest.TestCase):
+
+    def plan(self, info, **thresholds):
+        mode, analyze, reasons = maintenance.plan(info, dict(maintenance.THRESHOLDS, **thresholds))
+        return mode, analyze
+
+    def test_empty_tables_are_left_alone(self):
+        self.assertEqual(maintenance.plan(None), (None, False, ["no statistics, table is empty"]))
+        self.assertEqual(self.plan(svv_table_info(0, 0, None, None)), (None, False))
+
+    def test_healthy_table(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 990, 2.0, 3.0)), (None, False))
+
+    def test_deleted_rows(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 900, 0.0, 0.0)), ("DELETE ONLY", False))
+
+    def test_unsorted_rows(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 1000, 40.0, 0.0)), ("SORT ONLY", False))
+
+    def test_deleted_and_unsorted_rows(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 900, 40.0, 0.0)), ("FULL", False))
+
+    def test_stale_statistics(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 1000, 0.0, 25.0)), (None, True))
+        self.assertEqual(self.plan(svv_table_info(1000, 900, 40.0, 25.0)), ("FULL", True))
+
+    def test_thresholds_are_inclusive(self):
+        self.assertEqual(self.plan(svv_table_info(1000, 950, 5.0, 10.0)), ("FULL", True))
+        self.assertEqual(self.plan(svv_table_info(1000, 951, 4.9, 9.9)), (None, False))
+
+    def test_thresholds_can_be_overridden(self):
+        info = svv_table_info(1000, 900, 40.0, 25.0)
+        self.assertEqual(self.plan(info, deleted=20, unsorted=50, stats_off=30), (None, False))
+        self.assertEqual(self.plan(info, deleted=10, unsorted=40, stats_off=25), ("FULL", True))
+
+    def test_postgres_has_no_sortedness(self):
+        self.assertEqual(self.plan(TableInfo(1000, 0, None, 0)), (None, False))
+
+    def test_reasons(self):
+        mode, analyze, reasons = maintenance.plan(svv_table_info(1000, 900, 2.0, 25.0))
+        self.assertEqual(reasons, ["deleted 10.0% >= 5.0%", "unsorted 2.0% < 5.0%", "stats_off 25.0% >= 10.0%"])
+
+class VacuumStatementTest(unittest.TestCase):
+
+    def test_redshift(self):
+        for mode in ("FULL", "DELETE ONLY", "SORT ONLY"):
+            self.assertEqual(maintenance.vacuum_statement(mode, "flow_events", True),
+                             "VACUUM " + mode + " flow_events;")
+
+    def test_postgres(self):
+        self.assertEqual(maintenance.vacuum_statement("FULL", "flow_events", False), "VACUUM FULL flow_events;")
+        self.assertEqual(maintenance.vacuum_statement("DELETE ONLY", "flow_events", False), "VACUUM  flow_events;")
+        self.assertEqual(maintenance.vacuum_statement("SORT ONLY", "flow_events", False), None)
@@ -0,0 +1,169 @@
+#
+# Monthly partitions, and importing into tables that were partitioned later.
+#
+
+from tests import local
+
+from os import path
+import random
+
+import import_activity_events
+import import_events
+import import_flow_events
+import partitions
+import synthetic_data
+
+Q_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS partitioned_events (
+      day DATE NOT NULL SORTKEY ENCODE RAW,
+      uid VARCHAR(64) ENCODE zstd
+    );
+"""
+
+Q_INSERT_DAY = """
+    INSERT INTO {table} (day, uid)
+    VALUES (%(day)s, %(uid)s);
+"""
+
+Q_DAYS = """
+    SELECT day
+    FROM {table}
+    ORDER BY day;
+"""
+
+Q_ROWS = """
+    SELECT *
+    FROM {table}{suffix};
+"""
+
+Q_LEDGER = """
+    SELECT event_type, day, sample_rate, s3_key, etag, row_count
+    FROM load_ledger;
+"""
+
+TABLE = "partitioned_events"
+
+class PartitionTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(PartitionTest, self).setUp()
+        self.pool = self.connect()
+
+    def insert(self, table, *days):
+        for day in days:
+            self.pool.run(Q_INSERT_DAY.format(table=table), {"day": day, "uid": "u" + day})
+
+    def days(self, table=TABLE):
+        return [day.strftime("%Y-%m-%d") for day in self.pool.all(Q_DAYS.format(table=table))]
+
+    def test_ensure_partition(self):
+        partition = partitions.ensure_partition(self.pool, TABLE, Q_CREATE_TABLE, "2017-06-08")
+        self.assertEqual(partition, TABLE + "_p201706")
+        self.insert(partition, "2017-06-01", "2017-06-08")
+        # Once it exists, it's left as it is.
+        self.assertEqual(partitions.ensure_partition(self.pool, TABLE, Q_CREATE_TABLE, "2017-06-30"), partition)
+        partitions.ensure_partition(self.pool, TABLE, Q_CREATE_TABLE, "2017-07-01")
+        self.insert(TABLE + "_p201707", "2017-07-01")
+        self.assertEqual(partitions.get_partitions(self.pool, TABLE),
+                         [TABLE + "_p201706", TABLE + "_p201707"])
+        # The table itself is now a view of its partitions.
+        self.assertTrue(partitions.is_partitioned(self.pool, TABLE))
+        self.assertEqual(self.days(), ["2017-06-01", "2017-06-08", "2017-07-01"])
+
+    def test_migrate(self):
+        self.pool.run(Q_CREATE_TABLE)
+        self.insert(TABLE, "2017-05-31")
+        partitions.migrate(self.pool, TABLE)
+        partitions.migrate(self.pool, TABLE)
+        partitions.ensure_partition(self.pool, TABLE, Q_CREATE_TABLE, "2017-06-01")
+        self.insert(TABLE + "_p201706", "2017-06-01")
+        self.assertEqual(partitions.get_partitions(self.pool, TABLE),
+                         [TABLE + "_p000000", TABLE + "_p201706"])
+        self.assertEqual(self.days(), ["2017-05-31", "2017-06-01"])
+        # The legacy partition can hold any day.
+        self.assertEqual(partitions.suffixes(self.pool, TABLE, True, "2017-06-01", "2017-06-08"),
+                         ["_p000000", "_p201706"])
+        self.assertEqual(partitions.suffixes(self.pool, TABLE, True, "2017-07-01", "2017-07-01"),
+                         ["_p000000"])
+        self.assertEqual(partitions.suffixes(self.pool, TABLE, False, "2017-06-01", "2017-06-08"), [""])
+
+    def test_expire(self):
+        self.pool.run(Q_CREATE_TABLE)
+        self.insert(TABLE, "2017-03-31", "2017-05-31")
+        partitions.migrate(self.pool, TABLE)
+        for month, days in (("201704", ("2017-04-01", "2017-04-30")),
+                            ("201705", ("2017-05-01", "2017-05-14", "2017-05-15")),
+                            ("201706", ("2017-06-01",))):
+            partitions.ensure_partition(self.pool, TABLE, Q_CREATE_TABLE, days[0])
+            self.insert(TABLE + "_p" + month, *days)
+        trimmed = partitions.expire(self.pool, TABLE, "day", "2017-05-15")
+        # Older months are dropped and the cutoff's month is trimmed, along
+        # with the legacy partition, until it has nothing left before it.
+        self.assertEqual(trimmed, [TABLE + "_p000000", TABLE + "_p201705"])
+        self.assertEqual(partitions.get_partitions(self.pool, TABLE),
+                         [TABLE + "_p000000", TABLE + "_p201705", TABLE + "_p201706"])
+        self.assertEqual(self.days(), ["2017-05-15", "2017-05-31", "2017-06-01"])
+        trimmed = partitions.expire(self.pool, TABLE, "day", "2017-06-01")
+        self.assertEqual(trimmed, [])
+        self.assertEqual(partitions.get_partitions(self.pool, TABLE), [TABLE + "_p201706"])
+        self.assertEqual(self.days(), ["2017-06-01"])
+        # The view needs something to select from, so the last partition
+        # stays, emptied instead.
+        trimmed = partitions.expire(self.pool, TABLE, "day", "2017-08-01")
+        self.assertEqual(trimmed, [TABLE + "_p201706"])
+        self.assertEqual(partitions.get_partitions(self.pool, TABLE), [TABLE + "_p201706"])
+        self.assertEqual(self.days(), [])
+
+class MigratedImportTest(local.LocalTestCase):
+
+    def reupload(self, file_type, day):
+        """Upload day's file again with its lines shuffled, so that its ETag
+        changes but its rows don't.
+        """
+        key_name = synthetic_data.file_names(day)[file_type]
+        filename = path.join(self.directory, "data", key_name)
+        with open(filename) as events:
+            lines = events.readlines()
+        random.Random(0).shuffle(lines)
+        self.bucket.new_key(key_name).set_contents_from_string("".join(lines))
+        self.relist()
+
+    def tables(self, tables):
+        rows = dict((table + rate["suffix"], self.rows(Q_ROWS.format(table=table, suffix=rate["suffix"])))
+                    for table in tables for rate in import_events.SAMPLE_RATES)
+        rows["load_ledger"] = self.rows(Q_LEDGER)
+        return rows
+
+    def reimport(self, run, file_type, tables, **options):
+        """Import from scratch, then import local.DAY_UNTIL again with options,
+        returning the rows of every table given.
+        """
+        self.reset()
+        self.generate(days=4)
+        self.relist()
+        run()
+        self.reupload(file_type, local.DAY_UNTIL)
+        run(**options)
+        return self.tables(tables)
+
+    def assertReimports(self, run, file_type, tables):
+        """Check that a day imported again after the tables were partitioned
+        is replaced in the legacy partition, not duplicated in its month's.
+        """
+        expected_tables = self.reimport(run, file_type, tables)
+        actual_tables = self.reimport(run, file_type, tables, partitioned=True)
+        for table in sorted(expected_tables):
+            self.assertTrue(expected_tables[table] or not table.startswith("flow_metadata"),
+                            "nothing in " + table)
+            self.assertEqual(actual_tables[table], expected_tables[table], table + " differs")
+        for table in tables:
+            self.assertTrue(partitions.is_partitioned(self.db, table), table + " isn't partitioned")
+            self.assertEqual(partitions.get_partitions(self.db, table), [table + "_p000000", table + "_p201706"])
+
+    def test_reimport_activity(self):
+        self.assertReimports(import_activity_events.run, "activity",
+                             ("activity_events", "daily_activity_per_device"))
+
+    def test_reimport_flow(self):
+        self.assertReimports(import_flow_events.run, "flow",
+                             ("flow_events", "flow_metadata", "flow_experiments"))
@@ -0,0 +1,127 @@
+#
+# Summarizing query plans and comparing them with a baseline.
+#
+
+import unittest
+
+import plans
+
+# The aggregate is broadcast to every node, and has never been analyzed.
+BROADCAST_PLAN = """XN Hash Join DS_BCAST_INNER  (cost=1.25..500.50 rows=100 width=8)
+  Hash Cond: (("outer".flow_id)::text = ("inner".flow_id)::text)
+  ->  XN Seq Scan on flow_metadata  (cost=0.00..100.00 rows=10000 width=8)
+  ->  XN Hash  (cost=1.00..1.00 rows=100 width=8)
+        ->  XN Seq Scan on flow_aggregate flows  (cost=0.00..1.00 rows=100 width=8)
+----- Tables missing statistics: flow_aggregate -----
+----- Update statistics by running the ANALYZE command on these tables -----""".split("\n")
+
+# The same join once the tables line up on their distribution keys.
+COLLOCATED_PLAN = """XN Hash Join DS_DIST_NONE  (cost=1.25..150.50 rows=100 width=8)
+  Hash Cond: (("outer".flow_id)::text = ("inner".flow_id)::text)
+  ->  XN Seq Scan on flow_metadata  (cost=0.00..100.00 rows=10000 width=8)
+  ->  XN Hash  (cost=1.00..1.00 rows=100 width=8)
+        ->  XN Seq Scan on flow_aggregate flows  (cost=0.00..1.00 rows=100 width=8)""".split("\n")
+
+SCAN_PLAN = ["XN Seq Scan on flow_events  (cost=0.00..40.00 rows=4000 width=8)"]
+
+UPDATE = "UPDATE flow_metadata"
+DELETE = "DELETE FROM flow_events"
+
+def explained(stage, statement, plan, event_type="flow"):
+    """Return a statement as tracing records it with --explain."""
+    return {"event_type": event_type, "stage": stage, "statement": statement, "plan": plan}
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_broadcast_join(self):
+        summary = plans.summarize(BROADCAST_PLAN)
+        self.assertEqual(summary["cost"], 500.5)
+        self.assertEqual(summary["node_types"], {"Hash Join": 399.5, "Seq Scan": 101.0, "Hash": 0.0})
+        self.assertEqual(summary["redistribution"], ["DS_BCAST_INNER"])
+        self.assertEqual(summary["broadcast"], ["flow_aggregate"])
+        self.assertEqual(summary["missing_statistics"], ["flow_aggregate"])
+
+    def test_collocated_join(self):
+        summary = plans.summarize(COLLOCATED_PLAN)
+        self.assertEqual(summary["cost"], 150.5)
+        self.assertEqual(summary["redistribution"], ["DS_DIST_NONE"])
+        self.assertEqual(summary["broadcast"], [])
+        self.assertEqual(summary["missing_statistics"], [])
+
+    def test_no_plan(self):
+        self.assertEqual(plans.summarize([])["cost"], 0.0)
+
+    def test_explainable_statements(self):
+        self.assertTrue(plans.is_explainable("SELECT 1;"))
+        self.assertTrue(plans.is_explainable("  UPDATE flow_metadata SET uid = NULL;"))
+        self.assertFalse(plans.is_explainable("COPY flow_events FROM 's3://bucket/key';"))
+        self.assertFalse(plans.is_explainable("DELETE FROM a; DELETE FROM b;"))
+        self.assertFalse(plans.is_explainable("SELECT tablename FROM pg_tables;"))
+
+class StagePlansTest(unittest.TestCase):
+
+    def test_keeps_the_most_expensive_run(self):
+        stages = plans.stage_plans([
+            explained("flow_metadata update", UPDATE, COLLOCATED_PLAN),
+            explained("flow_metadata update", UPDATE, BROADCAST_PLAN),
+            explained("flow_metadata update", UPDATE, COLLOCATED_PLAN),
+            explained("flow_events delete", DELETE, SCAN_PLAN),
+        ])
+        self.assertEqual([stage["stage"] for stage in stages], ["flow_metadata update", "flow_events delete"])
+        update = stages[0]
+        self.assertEqual(update["cost"], 500.5)
+        self.assertEqual(update["broadcast"], ["flow_aggregate"])
+        self.assertEqual([(statement["statement"], statement["runs"], statement["cost"])
+                          for statement in update["statements"]], [(UPDATE, 3, 500.5)])
+        self.assertEqual(update["node_types"][0], ("Hash Join", 399.5))
+
+    def test_adds_up_statements(self):
+        stages = plans.stage_plans([
+            explained("flow_events delete", DELETE, SCAN_PLAN),
+            explained("flow_events delete", UPDATE, COLLOCATED_PLAN),
+        ])
+        self.assertEqual(stages[0]["cost"], 190.5)
+        self.assertEqual(stages[0]["node_types"][0], ("Seq Scan", 141.0))
+
+class CompareTest(unittest.TestCase):
+
+    def compare(self, statements, baseline_statements, threshold=2):
+        return plans.compare(plans.stage_plans(statements), plans.stage_plans(baseline_statements),
+                             threshold)
+
+    def test_unchanged(self):
+        statements = [explained("flow_metadata update", UPDATE, BROADCAST_PLAN)]
+        self.assertEqual(self.compare(statements, statements), [])
+
+    def test_started_broadcasting(self):
+        regressions = self.compare([explained("flow_metadata update", UPDATE, BROADCAST_PLAN)],
+                                   [explained("flow_metadata update", UPDATE, COLLOCATED_PLAN)])
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0]["event_type"], "flow")
+        self.assertEqual(regressions[0]["stage"], "flow_metadata update")
+        self.assertEqual(regressions[0]["changes"], ["cost went from 150 to 500", "started broadcasting flow_aggregate",
+                                                     "statistics missing for flow_aggregate"])
+
+    def test_cost_threshold(self):
+        statements = [explained("flow_metadata update", UPDATE, BROADCAST_PLAN)]
+        baseline = [explained("flow_metadata update", UPDATE, COLLOCATED_PLAN)]
+        changes = self.compare(statements, baseline, threshold=4)[0]["changes"]
+        self.assertNotIn("cost went from 150 to 500", changes)
+        self.assertIn("cost went from 150 to 500", self.compare(statements, baseline, threshold=3)[0]["changes"])
+
+    def test_improvements_are_not_regressions(self):
+        self.assertEqual(self.compare([explained("flow_metadata update", UPDATE, COLLOCATED_PLAN)],
+                                      [explained("flow_metadata update", UPDATE, BROADCAST_PLAN)]), [])
+
+    def test_new_stages_are_left_out(self):
+        self.assertEqual(self.compare([explained("flow_metadata update", UPDATE, BROADCAST_PLAN),
+                                       explained("flow_metadata update", UPDATE, BROADCAST_PLAN, "email")],
+                                      [explained("flow_events delete", DELETE, SCAN_PLAN)]), [])
+
+    def test_free_baselines_count_as_one(self):
+        regressions = self.compare([explained("flow_events delete", DELETE, ["Result  (cost=0.00..1.50 rows=1 width=0)"])],
+                                   [explained("flow_events delete", DELETE, ["Result  (cost=0.00..0.00 rows=1 width=0)"])])
+        self.assertEqual(regressions, [])
+        regressions = self.compare([explained("flow_events delete", DELETE, ["Result  (cost=0.00..3.00 rows=1 width=0)"])],
+                                   [explained("flow_events delete", DELETE, ["Result  (cost=0.00..0.00 rows=1 width=0)"])])
+        self.assertEqual(regressions[0]["changes"], ["cost went from 0 to 3"])
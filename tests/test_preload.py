@@ -0,0 +1,165 @@
+#
+# Preloaded slices hold what the day's file did, in every format.
+#
+
+from tests import local
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import backends
+import import_activity_events
+import import_events
+import preload
+import synthetic_data
+
+LINES = [
+    "1496880000,Firefox,55,Linux,{uid},account.login,sync,{device}".format(uid=str(index) * 32,
+                                                                          device=str(index) * 32)
+    for index in range(10)
+] + ["1496880001,,,,ffff,account.reset,,"]
+
+COLUMNS = ["timestamp", "ua_browser", "ua_version", "ua_os", "uid", "type", "service", "device_id"]
+
+def has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+def needs(file_format):
+    """Skip tests of formats whose package isn't installed."""
+    module = {"zstd": "zstandard", "parquet": "pyarrow"}.get(file_format)
+    if module and not has_module(module):
+        return unittest.skip("needs " + module)
+    return lambda test: test
+
+Q_EVENTS = """
+    SELECT *
+    FROM activity_events;
+"""
+
+class SplitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, file_format):
+        paths = preload.split(iter(LINES), self.directory, "events", 3, file_format,
+                              COLUMNS, ("timestamp",))
+        self.assertEqual(len(paths), 3)
+        lines = []
+        for slice_path in paths:
+            self.assertTrue(slice_path.endswith(preload.EXTENSIONS[file_format]))
+            with open(slice_path, "rb") as data:
+                csv_data = backends.decode(data.read(), preload.COPY_OPTIONS[file_format].upper())
+            lines.extend(csv_data.splitlines())
+        # Slices are filled round robin.
+        self.assertEqual(lines, LINES[0::3] + LINES[1::3] + LINES[2::3])
+
+    def test_csv(self):
+        self.round_trip("csv")
+
+    def test_gzip(self):
+        self.round_trip("gzip")
+
+    @needs("zstd")
+    def test_zstd(self):
+        self.round_trip("zstd")
+
+    @needs("parquet")
+    def test_parquet(self):
+        self.round_trip("parquet")
+
+    @needs("parquet")
+    def test_parquet_truncates_and_rejects(self):
+        lines = [
+            LINES[0],
+            # Too long for ua_browser, with a two-byte character across the end.
+            "1496880002," + "F" * 39 + "\xc3\xa9x,55,Linux,aaaa,account.login,sync,bbbb",
+            # COPY would reject each of these from a CSV file.
+            "yesterday,Firefox,55,Linux,aaaa,account.login,sync,bbbb",
+            "1496880003,Firefox,55,Linux,aaaa,account.login,sync",
+            "1496880004,Firefox,55,Linux,aaaa,account.login,sync,bbbb,cccc",
+        ]
+        widths = {"ua_browser": 40, "ua_version": 40, "ua_os": 40, "uid": 64, "type": 30,
+                  "service": 40, "device_id": 32}
+        paths = preload.split(iter(lines), self.directory, "events", 1, "parquet",
+                              COLUMNS, ("timestamp",), widths)
+        with open(paths[0], "rb") as data:
+            csv_data = backends.decode(data.read(), "PARQUET")
+        self.assertEqual(csv_data.splitlines(), [
+            LINES[0],
+            "1496880002," + "F" * 39 + ",55,Linux,aaaa,account.login,sync,bbbb",
+        ])
+
+    @needs("parquet")
+    def test_parquet_maxerror(self):
+        lines = LINES + ["yesterday,,,,ffff,account.reset,,"] * preload.MAXERROR
+        preload.split(iter(lines), self.directory, "events", 3, "parquet", COLUMNS, ("timestamp",))
+        self.assertRaises(ValueError, preload.split, iter(lines + lines[-1:]), self.directory, "events", 3,
+                          "parquet", COLUMNS, ("timestamp",))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, preload.split, iter(LINES), self.directory, "events", 3, "bzip2")
+
+class UploadTest(local.LocalTestCase):
+
+    def test_manifest(self):
+        paths = preload.split(iter(LINES), self.directory, "events", 2, "gzip")
+        entries = preload.upload(self.bucket, paths, "staging/")
+        manifest = json.loads(json.dumps(preload.manifest(entries)))
+        self.assertEqual(preload.key_names(manifest["entries"]),
+                         ["staging/events.0000.csv.gz", "staging/events.0001.csv.gz"])
+        for entry, slice_path in zip(manifest["entries"], paths):
+            self.assertTrue(entry["url"].startswith("s3://" + self.bucket.name + "/"))
+            self.assertTrue(entry["mandatory"])
+            key = self.bucket.get_key(preload.key_names([entry])[0])
+            self.assertEqual(entry["meta"]["content_length"], key.size)
+            with open(slice_path, "rb") as data:
+                self.assertEqual(key.get_contents_as_string(), data.read())
+
+    def import_events(self, **options):
+        """Import the activity events from scratch, returning the rows loaded."""
+        self.reset()
+        import_activity_events.run(**options)
+        return self.rows(Q_EVENTS)
+
+    def assertPreloadMatches(self, file_format):
+        self.generate(days=2, rows_per_day=500)
+        expected = self.import_events()
+        self.assertTrue(expected)
+        self.assertEqual(self.import_events(preload_format=file_format, slices=3), expected)
+        # The slices and manifests are cleaned up after COPY.
+        self.assertEqual([key.name for key in self.bucket.list(prefix=import_events.S3_STAGING_PREFIX)], [])
+
+    def test_import_csv(self):
+        self.assertPreloadMatches("csv")
+
+    def test_import_gzip(self):
+        self.assertPreloadMatches("gzip")
+
+    @needs("zstd")
+    def test_import_zstd(self):
+        self.assertPreloadMatches("zstd")
+
+    @needs("parquet")
+    def test_import_parquet(self):
+        self.assertPreloadMatches("parquet")
+
+    @needs("parquet")
+    def test_import_parquet_with_bad_lines(self):
+        self.generate(days=1, rows_per_day=100)
+        key = self.bucket.get_key(synthetic_data.file_names(local.DAY_UNTIL)["activity"])
+        key.set_contents_from_string(key.get_contents_as_string() +
+                                     "1496880000," + "F" * 50 + ",55,Linux,ffff,account.login,sync,ffff\n"
+                                     "yesterday,Firefox,55,Linux,ffff,account.login,sync,ffff\n")
+        rows = self.import_events(preload_format="parquet", slices=3)
+        self.assertEqual(len(rows), 101)
+        self.assertEqual([row.ua_browser for row in rows if row.uid == "ffff"], ["F" * 40])
@@ -0,0 +1,138 @@
+#
+# The whole pipeline in one process gives the same tables as the scripts.
+#
+
+from tests import local
+
+import unittest
+
+import calculate_daily_summary
+import import_activity_events
+import import_counts
+import import_email_events
+import import_flow_events
+import maintenance
+import postgres
+import run_pipeline
+
+Q_TABLES = """
+    SELECT tablename
+    FROM pg_tables
+    WHERE schemaname = current_schema()
+    AND tablename NOT IN ('load_ledger', 'import_journal');
+"""
+
+Q_ROWS = """
+    SELECT *
+    FROM {table};
+"""
+
+Q_LEDGER = """
+    SELECT event_type, day, sample_rate, s3_key, etag, row_count
+    FROM load_ledger;
+"""
+
+class RunPipelineTest(local.LocalTestCase):
+
+    def setUp(self):
+        super(RunPipelineTest, self).setUp()
+        self.steps = []
+        self.maintained = []
+        self.pools = 0
+        for module, name in ((import_activity_events, "run"),
+                             (calculate_daily_summary, "summarize_events"),
+                             (maintenance, "maintain"),
+                             (postgres, "Postgres")):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+
+    def note_calls(self):
+        """Note when the activity import and the summary start and finish in
+        self.steps, what maintain really maintains in self.maintained and
+        how many pools are created in self.pools.
+        """
+        test = self
+
+        def noting(name, function):
+            def call(*args, **kwargs):
+                test.steps.append(("start", name))
+                function(*args, **kwargs)
+                test.steps.append(("finish", name))
+            return call
+        import_activity_events.run = noting("activity", import_activity_events.run)
+        calculate_daily_summary.summarize_events = noting("daily_summary",
+                                                          calculate_daily_summary.summarize_events)
+
+        maintain = maintenance.maintain
+
+        def noting_maintain(db, table_names, *args, **kwargs):
+            if maintenance.deferred is None:
+                test.maintained.append(list(table_names))
+            maintain(db, table_names, *args, **kwargs)
+        maintenance.maintain = noting_maintain
+
+        Postgres = postgres.Postgres
+
+        def counting_pools(*args, **kwargs):
+            test.pools += 1
+            return Postgres(*args, **kwargs)
+        postgres.Postgres = counting_pools
+
+    def tables(self):
+        tables = dict((table, self.rows(Q_ROWS.format(table=table))) for table in self.rows(Q_TABLES))
+        tables["load_ledger"] = self.rows(Q_LEDGER)
+        return tables
+
+    def test_matches_scripts(self):
+        self.generate(days=4)
+        import_activity_events.run()
+        calculate_daily_summary.summarize_events()
+        import_flow_events.run()
+        import_email_events.run()
+        import_counts.import_events(s3=self.bucket)
+        expected_tables = self.tables()
+
+        self.reset()
+        self.relist()
+        self.note_calls()
+        run_pipeline.run(concurrency=3, jobs=2, refresh_listing=False, partitioned=False)
+        tables = self.tables()
+        self.assertEqual(sorted(tables), sorted(expected_tables))
+        for table in sorted(expected_tables):
+            self.assertEqual(tables[table], expected_tables[table], table + " differs")
+        for table in ("activity_events", "daily_activity_per_device", "flow_metadata", "email_events",
+                      "counts"):
+            self.assertTrue(tables[table], "nothing in " + table)
+
+        # The summary only starts once the activity import has finished.
+        self.assertEqual([step for step in self.steps if step[1] == "activity" or step[1] == "daily_summary"],
+                         [("start", "activity"), ("finish", "activity"),
+                          ("start", "daily_summary"), ("finish", "daily_summary")])
+        # Every step used the one pool.
+        self.assertEqual(self.pools, 1)
+        # Tables were maintained once each, at the end.
+        self.assertEqual(len(self.maintained), 1)
+        self.assertTrue(self.maintained[0])
+        self.assertEqual(len(set(self.maintained[0])), len(self.maintained[0]))
+        self.assertIsNone(maintenance.deferred)
+
+class RunStepsTest(unittest.TestCase):
+
+    def test_skips_after_failure(self):
+        ran = []
+
+        def step(name, fail=False):
+            def run():
+                ran.append(name)
+                if fail:
+                    raise ValueError(name)
+            return run
+        failed = run_pipeline.run_steps((
+            ("a", (), step("a")),
+            ("b", ("a",), step("b", fail=True)),
+            ("c", ("b",), step("c")),
+            ("d", ("a",), step("d")),
+        ), 2)
+        self.assertEqual(sorted(failed), ["b", "c"])
+        self.assertEqual(sorted(ran), ["a", "b", "d"])
+        self.assertEqual(ran[0], "a")
+        self.assertRaises(ValueError, run_pipeline.run_steps, (("e", ("unknown",), step("e")),), 1)
@@ -0,0 +1,42 @@
+#
+# Incremental listings notice re-uploaded keys.
+#
+
+from tests import local
+
+import s3_listing
+
+PREFIX = "fxa-flow/data/flow"
+
+DAYS = ["2017-05-{0:02d}".format(day) for day in range(1, 31)]
+
+class ListingTest(local.LocalTestCase):
+
+    def upload(self, day, contents):
+        self.bucket.new_key(PREFIX + "-" + day + ".csv").set_contents_from_string(contents)
+
+    def etags(self, **options):
+        """List the prefix as a new run would, returning day -> ETag."""
+        self.relist()
+        return dict((entry.day, entry.etag) for entry in s3_listing.list_prefix(self.bucket, PREFIX, **options))
+
+    def setUp(self):
+        super(ListingTest, self).setUp()
+        for day in DAYS:
+            self.upload(day, day)
+
+    def test_lists_everything_first(self):
+        self.assertEqual(sorted(self.etags()), DAYS)
+
+    def test_notices_recent_reuploads(self):
+        before = self.etags()
+        self.upload(DAYS[-2], "changed")
+        after = self.etags()
+        self.assertNotEqual(after[DAYS[-2]], before[DAYS[-2]])
+
+    def test_notices_older_reuploads_when_refreshed(self):
+        before = self.etags()
+        self.upload(DAYS[0], "changed")
+        self.assertEqual(self.etags()[DAYS[0]], before[DAYS[0]])
+        self.assertNotEqual(self.etags(refresh_days=0)[DAYS[0]], before[DAYS[0]])
+        self.assertNotEqual(self.etags(refresh=True)[DAYS[0]], before[DAYS[0]])
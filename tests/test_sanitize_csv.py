@@ -0,0 +1,42 @@
+#
+# Sanitizing CSV lines.
+#
+
+from cStringIO import StringIO
+import unittest
+
+import sanitize_csv
+
+class SanitizeTest(unittest.TestCase):
+
+    def sanitize(self, text, rules=(), fields=3, pad=False, keep_long=False):
+        clean = StringIO()
+        rejects = StringIO()
+        counts = sanitize_csv.sanitize(StringIO(text), clean, rejects, rules, fields, pad, keep_long)
+        return clean.getvalue(), rejects.getvalue(), counts
+
+    def test_rejects_wrong_field_counts(self):
+        clean, rejects, counts = self.sanitize("a,b,c\na,b\na,b,c,d\n")
+        self.assertEqual(clean, "a,b,c\n")
+        self.assertEqual(rejects, "field_count\ta,b\nfield_count\ta,b,c,d\n")
+        self.assertEqual(counts, {"clean": 1, "field_count": 2})
+
+    def test_pads_short_lines(self):
+        clean, rejects, counts = self.sanitize("a,b,c\na\na,b,c,d\n", pad=True)
+        self.assertEqual(clean, "a,b,c\na,,\n")
+        self.assertEqual(rejects, "field_count\ta,b,c,d\n")
+
+    def test_keeps_long_lines(self):
+        clean, rejects, counts = self.sanitize("a,b,c\na\na,b,c,d\n", pad=True, keep_long=True)
+        self.assertEqual(clean, "a,b,c\na,,\na,b,c,d\n")
+        self.assertEqual(rejects, "")
+
+    def test_rejects_by_rule(self):
+        clean, rejects, counts = self.sanitize("a,b,c\na,'b',c\na,SELECT *,c\n",
+                                               rules=sanitize_csv.get_rules("flow"))
+        self.assertEqual(clean, "a,b,c\n")
+        self.assertEqual(counts, {"clean": 1, "single_quote": 1, "select": 1})
+
+    def test_reads_lines_across_chunks(self):
+        lines = list(sanitize_csv.read_lines(StringIO("ab,c\nd,ef\ng"), chunk_size=3))
+        self.assertEqual(lines, ["ab,c", "d,ef", "g"])
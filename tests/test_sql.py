@@ -0,0 +1,51 @@
+#
+# Building statements.
+#
+
+from tests import local
+
+from datetime import date, datetime
+import threading
+import unittest
+
+import sql
+
+VALUES = (None, True, False, 0, -7, 10L, 2.5, date(2017, 6, 1), datetime(2017, 6, 1, 3, 4, 5),
+          "plain", "it's", "back\\slash", "trailing\\", u"caf\xe9", "%(not_a_value)s")
+
+Q_VALUE = "SELECT %(value)s AS value;"
+
+class LiteralTest(local.LocalTestCase):
+
+    def test_values_round_trip(self):
+        for value in VALUES:
+            selected = self.db.one(sql.build(Q_VALUE, {"value": value}))
+            if isinstance(value, str):
+                selected = selected.encode("utf8")
+            self.assertEqual(selected, value)
+            self.assertEqual(type(selected) in (int, long), type(value) in (int, long))
+
+    def test_day_arithmetic(self):
+        statement = sql.build("SELECT {range}", sql.days("2017-06-01", "2017-06-02"),
+                              range="%(day_until)s + 1 - %(day_from)s")
+        self.assertEqual(self.db.one(statement), 2)
+
+    def test_unknown_type(self):
+        self.assertRaises(Exception, sql.literal, object())
+
+class PrepareTest(unittest.TestCase):
+
+    def test_prepares_each_statement_once(self):
+        template = "SELECT {column} FROM {table}; -- " + self.id()
+        prepared = []
+
+        def prepare():
+            prepared.append(sql.prepare(template, column="a", table="b"))
+        threads = [threading.Thread(target=prepare) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(prepared), set(["SELECT a FROM b; -- " + self.id()]))
+        self.assertEqual(len(set(id(statement) for statement in prepared)), 1)
+        self.assertEqual(sql.prepare(template, table="b", column="a"), prepared[0])
@@ -0,0 +1,65 @@
+#
+# The synthetic data has what the pipeline needs exercising.
+#
+
+from tests import local
+
+from os import path
+import csv
+import shutil
+import tempfile
+import unittest
+
+import synthetic_data
+
+class SyntheticDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generate(self, name, seed=1):
+        directory = path.join(self.directory, name)
+        counts = synthetic_data.generate(directory, local.DAY_UNTIL, 3, 1000, seed=seed)
+        return directory, counts
+
+    def read(self, directory, day, event_type):
+        with open(path.join(directory, synthetic_data.file_names(day)[event_type])) as rows:
+            return list(csv.reader(rows))
+
+    def read_events(self, directory, day, event_type):
+        """Return day's events of event_type as dicts of column -> value."""
+        columns = ["timestamp"] + [column.strip() for column in
+                                   synthetic_data.event_columns()[event_type].split(",")]
+        return [dict(zip(columns, row)) for row in self.read(directory, day, event_type)]
+
+    def test_same_seed_same_files(self):
+        first, first_counts = self.generate("first")
+        second, second_counts = self.generate("second")
+        self.assertEqual(first_counts, second_counts)
+        for event_type in ("activity", "flow", "email", "counts"):
+            self.assertEqual(self.read(first, local.DAY_UNTIL, event_type),
+                             self.read(second, local.DAY_UNTIL, event_type))
+
+    def test_rows_match_columns(self):
+        directory, counts = self.generate("data")
+        columns = synthetic_data.event_columns()
+        for event_type in ("activity", "flow", "email"):
+            width = len(columns[event_type].split(",")) + 1
+            rows = sum((self.read(directory, day, event_type)
+                        for day in ("2017-06-06", "2017-06-07", "2017-06-08")), [])
+            self.assertEqual(len(rows), counts[event_type])
+            self.assertEqual(set(len(row) for row in rows), set([width]))
+
+    def test_flows_continue_experiment_and_cross_midnight(self):
+        directory, counts = self.generate("data")
+        begun = set(event["flow_id"] for event in self.read_events(directory, "2017-06-07", "flow")
+                    if event["type"] == "flow.begin")
+        events = self.read_events(directory, local.DAY_UNTIL, "flow")
+        types = [event["type"] for event in events]
+        self.assertTrue(any(event_type.startswith("flow.continued.") for event_type in types))
+        self.assertTrue(any(event_type.startswith("flow.experiment.") for event_type in types))
+        self.assertTrue(any(event["type"] == "flow.complete" and event["flow_id"] in begun
+                            for event in events))
@@ -0,0 +1,261 @@
+#
+# Per-statement tracing shared by the scripts.
+#
+# Every statement that goes through a Postgres instance created with
+# cursor_factory=TracedCursor is timed, along with the number of rows it
+# touched. For COPY on Redshift, which doesn't report a row count to the
+# cursor, that comes from pg_last_copy_count().
+#
+# Each statement is recorded with whatever labels are in effect on its
+# thread: the journal stage, event type, days and sample suffix, set by
+# the scripts with the labels context manager. Labels stay on the thread
+# that set them, so scripts run side by side in one process don't mix
+# up each other's; worker pools pass them on with carry_labels. At the end of a run,
+# write_report writes everything as a JSON report and, optionally, a
+# Prometheus textfile of totals per stage for node_exporter to collect.
+#
+# With --explain, each query is EXPLAINed before it runs and the plans of
+# each stage are written out too, and compared with those of an earlier
+# run if --explain-baseline names its file; see plans.py.
+#
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import path
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from postgres.cursors import SimpleNamedTupleCursor
+
+import load_ledger
+import plans
+
+Q_LAST_COPY_COUNT = "SELECT pg_last_copy_count();"
+
+METRIC_PREFIX = "fxa_import"
+
+class Tracer(object):
+    """Collects the timings of one run's statements."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_at = load_ledger.now()
+        self.start_time = time.time()
+        self.statements = []
+        self.explaining = False
+        self.explained = []
+
+    def default_labels(self, **labels):
+        """Add labels to every statement run from now on on this thread."""
+        self.local.labels = dict(self.get_labels(), **labels)
+
+    def get_labels(self):
+        return getattr(self.local, "labels", {})
+
+    @contextmanager
+    def labels(self, **labels):
+        """Add labels to the statements run on this thread within the block."""
+        previous = getattr(self.local, "labels", {})
+        self.local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def carry_labels(self, function):
+        """Wrap function to run with this thread's labels, on whichever thread calls it."""
+        current = self.get_labels()
+
+        def with_labels(*args, **kwargs):
+            with self.labels(**current):
+                return function(*args, **kwargs)
+
+        return with_labels
+
+    def record(self, sql, seconds, rows):
+        statement = dict(self.get_labels(), statement=summarize(sql), seconds=round(seconds, 3), rows=rows)
+        with self.lock:
+            self.statements.append(statement)
+
+    def explain(self, sql, plan):
+        statement = dict(self.get_labels(), statement=summarize(sql), plan=plan)
+        with self.lock:
+            self.explained.append(statement)
+
+    def report(self):
+        return OrderedDict([
+            ("script", script_name()),
+            ("started_at", self.started_at),
+            ("finished_at", load_ledger.now()),
+            ("seconds", round(time.time() - self.start_time, 3)),
+            ("stages", stage_totals(self.statements)),
+            ("statements", self.statements),
+        ])
+
+def stage_totals(statements):
+    """Return the totals for each stage of statements, slowest first.
+
+    Statements that ran outside a journal stage are grouped by what they
+    did instead.
+    """
+    totals = OrderedDict()
+    for statement in statements:
+        key = (statement.get("event_type", ""), statement.get("stage", statement["statement"]))
+        total = totals.setdefault(key, {"event_type": key[0], "stage": key[1],
+                                        "statements": 0, "seconds": 0.0, "rows": 0,
+                                        "slowest": 0.0})
+        total["statements"] += 1
+        total["seconds"] += statement["seconds"]
+        total["slowest"] = max(total["slowest"], statement["seconds"])
+        if statement["rows"] > 0:
+            total["rows"] += statement["rows"]
+    return sorted(totals.values(), key=lambda total: -total["seconds"])
+
+tracer = Tracer()
+
+labels = tracer.labels
+
+default_labels = tracer.default_labels
+
+carry_labels = tracer.carry_labels
+
+def explain_statements(explain_path):
+    """Start EXPLAINing queries if a plans file was asked for.
+
+    Scripts run by run_pipeline pass None, which leaves it as it was.
+    """
+    if explain_path is not None:
+        tracer.explaining = True
+
+class TracedCursor(SimpleNamedTupleCursor):
+    """A cursor that records every statement it executes with the tracer."""
+
+    def execute(self, sql, parameters=None):
+        if tracer.explaining and plans.is_explainable(sql):
+            SimpleNamedTupleCursor.execute(self, plans.Q_EXPLAIN.format(statement=sql), parameters)
+            tracer.explain(sql, [row[0] for row in self.fetchall()])
+        start = time.time()
+        result = SimpleNamedTupleCursor.execute(self, sql, parameters)
+        seconds = time.time() - start
+        rows = self.rowcount
+        if rows < 0 and is_copy(sql):
+            SimpleNamedTupleCursor.execute(self, Q_LAST_COPY_COUNT)
+            rows = self.fetchone()[0]
+        tracer.record(sql, seconds, rows)
+        return result
+
+def is_copy(sql):
+    return sql.lstrip().upper().startswith("COPY ")
+
+# What a statement does and to which table, e.g. "DELETE FROM flow_metadata".
+STATEMENT_TARGET = re.compile(r"^((?:INSERT INTO|DELETE FROM|UPDATE|COPY|ALTER TABLE|ANALYZE|VACUUM(?: FULL| SORT ONLY| DELETE ONLY| REINDEX)?|"
+                              r"CREATE (?:TEMPORARY )?TABLE(?: IF NOT EXISTS)?|DROP TABLE(?: IF EXISTS)?|"
+                              r"CREATE OR REPLACE VIEW) [\w.]+)", re.IGNORECASE)
+
+def summarize(sql):
+    """Shorten a statement to what it does, with whitespace collapsed."""
+    summary = " ".join(sql.split())
+    match = STATEMENT_TARGET.match(summary)
+    if match:
+        return match.group(1)
+    return summary[:80]
+
+def script_name():
+    return path.splitext(path.basename(sys.argv[0]))[0]
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_metrics(report):
+    script = escape(report["script"])
+    lines = []
+
+    def add_metric(name, help_text, samples):
+        lines.append("# HELP {prefix}_{name} {help}".format(prefix=METRIC_PREFIX, name=name, help=help_text))
+        lines.append("# TYPE {prefix}_{name} gauge".format(prefix=METRIC_PREFIX, name=name))
+        for sample_labels, value in samples:
+            lines.append("{prefix}_{name}{{{labels}}} {value}".format(
+                prefix=METRIC_PREFIX, name=name, value=value,
+                labels=",".join("{0}=\"{1}\"".format(label, escape(label_value))
+                                for label, label_value in sample_labels)))
+
+    def stage_samples(field):
+        return [((("script", script), ("event_type", stage["event_type"]), ("stage", stage["stage"])),
+                 stage[field])
+                for stage in report["stages"]]
+
+    add_metric("stage_seconds", "Wall time spent in each stage of the last run.",
+               stage_samples("seconds"))
+    add_metric("stage_rows", "Rows loaded or affected by each stage of the last run.",
+               stage_samples("rows"))
+    add_metric("stage_statements", "Statements run by each stage of the last run.",
+               stage_samples("statements"))
+    add_metric("run_seconds", "Wall time of the last successful run.",
+               [((("script", script),), report["seconds"])])
+    add_metric("last_success_timestamp_seconds", "When the last successful run finished.",
+               [((("script", script),), int(time.time()))])
+    return "\n".join(lines) + "\n"
+
+def write_atomically(filename, content):
+    # node_exporter might read the file at any moment.
+    with open(filename + ".tmp", "w") as output:
+        output.write(content)
+    os.rename(filename + ".tmp", filename)
+
+def write_plans(explain_path, baseline_path=None):
+    """Write the plans of each stage to explain_path, and report the stages
+    that got worse since the plans in baseline_path.
+    """
+    stages = plans.stage_plans(tracer.explained)
+    regressions = []
+    if baseline_path is not None:
+        # Read before writing, in case both are the same file.
+        regressions = plans.compare(stages, plans.load(baseline_path))
+        if regressions:
+            print "PLAN REGRESSIONS SINCE", baseline_path + ":"
+            for stage in regressions:
+                print "  {event_type} {stage}: {changes}".format(
+                    event_type=stage["event_type"], stage=stage["stage"], changes="; ".join(stage["changes"]))
+        else:
+            print "NO PLAN REGRESSIONS SINCE", baseline_path
+    print "WRITING PLANS TO", explain_path
+    write_atomically(explain_path, json.dumps(OrderedDict([
+        ("script", script_name()),
+        ("started_at", tracer.started_at),
+        ("baseline", baseline_path),
+        ("regressions", regressions),
+        ("stages", stages),
+    ]), indent=2) + "\n")
+
+def write_report(report_path=None, textfile_path=None, explain_path=None, baseline_path=None):
+    """Write the run's JSON report, Prometheus textfile and plans, if asked to."""
+    if explain_path is not None:
+        write_plans(explain_path, baseline_path)
+    if report_path is None and textfile_path is None:
+        return
+    report = tracer.report()
+    print "SLOWEST STAGES:"
+    for stage in report["stages"][:5]:
+        print "  {seconds:10.1f}s {rows:12d} rows  {event_type} {stage}".format(**stage)
+    if report_path is not None:
+        print "WRITING TRACE REPORT TO", report_path
+        write_atomically(report_path, json.dumps(report, indent=2) + "\n")
+    if textfile_path is not None:
+        print "WRITING PROMETHEUS METRICS TO", textfile_path
+        write_atomically(textfile_path, format_metrics(report))
+
+def add_arguments(parser):
+    parser.add_argument("--trace-report", metavar="PATH",
+                        help="write the timings and row counts of every statement to PATH as JSON")
+    parser.add_argument("--trace-textfile", metavar="PATH",
+                        help="write per-stage timings to PATH for the Prometheus textfile collector")
+    parser.add_argument("--explain", metavar="PATH",
+                        help="EXPLAIN every query before running it and write the plans of each stage to PATH")
+    parser.add_argument("--explain-baseline", metavar="PATH",
+                        help="with --explain, flag the stages whose plans got more expensive "
+                             "or started broadcasting a table since the plans in PATH")